@@ -0,0 +1,421 @@
+# Benchmarks of the generation, parsing, code generation and evaluation of
+# the trees.
+#
+# The benchmarks run on example.fit and on synthetic .fit files with more
+# primitives (see write_synthetic_fit()). All the workloads are generated
+# from fixed seeds, such that two runs measure the same work. Each
+# measurement is the median time of a few repetitions, normalized by the
+# amount of work (seconds per tree, per expression, per file or per point):
+# lower is better.
+#
+# The results are written as JSON and compared with a baseline file
+# (benchmark_baseline.json by default): a measurement slower than the
+# baseline by more than the threshold is reported as a regression, and the
+# script then exits with status 1. The baseline depends on the machine: it
+# should be updated (--update_baseline) when the machine changes.
+# The fitness evaluation with a primitive cache is also compared with the
+# same evaluation without cache, on the same machine: a cache that makes it
+# slower by more than the threshold is reported as a regression too.
+
+
+import gc
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import collections
+
+import numpy as np
+
+import random_tree
+import tree_from_expression
+import create_eval_source
+import native_eval
+import fitness
+import primitive_cache
+
+
+# directory of the scripts (containing example.fit)
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_BASELINE = os.path.join(SOURCE_DIR, 'benchmark_baseline.json')
+
+# a measurement slower than the baseline by more than this fraction is a
+# regression
+THRESHOLD = 0.25
+
+# number of repetitions of each measurement (the median time is kept)
+REPEAT = 5
+
+# minimum duration (in seconds) of a repetition: short workloads are run
+# several times per repetition
+MIN_TIME = 0.2
+
+# numbers of primitives of the synthetic .fit files
+SYNTHETIC_SIZES = [100, 1000]
+
+# (max depth, population size) of the generation benchmarks
+GENERATION_WORKLOADS = [(4, 2000), (7, 1000), (10, 500)]
+
+# numbers of nodes of the expressions of the parsing and code generation
+# benchmarks
+EXPRESSION_SIZES = [10, 100, 1000]
+
+# number of expressions parsed for each size
+NUM_EXPRESSIONS = 20
+
+# number of points of the evaluation benchmarks
+NUM_POINTS = 100000
+
+# number of points, number of trees and number of nodes of the trees of the
+# cache benchmarks
+CACHE_NUM_POINTS = 20000
+CACHE_NUM_TREES = 4
+CACHE_TREE_SIZE = 100
+
+# number of rows of the small primitive cache (less than the number of
+# primitives of a tree of the cache benchmarks)
+CACHE_SMALL_ROWS = 8
+
+SEED = 1
+
+
+def write_synthetic_fit(fit_filename, num_primitives, seed=SEED):
+    '''
+    Write a .fit file with num_primitives random primitives of all the types
+    (with normalized directions and valid radii and angles).
+    '''
+    rng = random.Random(seed)
+
+    def direction():
+        v = [rng.gauss(0.0, 1.0) for _ in range(3)]
+        norm = math.sqrt(sum(c*c for c in v)) or 1.0
+        return [c / norm for c in v]
+
+    def point():
+        return [rng.uniform(-1.0, 1.0) for _ in range(3)]
+
+    with open(fit_filename, 'w') as f:
+        for i in range(num_primitives):
+            prim_type = ['plane', 'sphere', 'cylinder', 'torus', 'cone', 'ellipsoid'][i % 6]
+            if prim_type == 'plane':
+                parameters = direction() + [rng.uniform(-1.0, 1.0)]
+            elif prim_type == 'sphere':
+                parameters = point() + [rng.uniform(0.1, 1.0)]
+            elif prim_type == 'cylinder':
+                parameters = direction() + point() + [rng.uniform(0.1, 0.5)]
+            elif prim_type == 'torus':
+                parameters = direction() + point() + [rng.uniform(0.05, 0.2),
+                                                      rng.uniform(0.3, 0.8)]
+            elif prim_type == 'cone':
+                parameters = direction() + point() + [rng.uniform(0.1, 1.2)]
+            else:
+                parameters = point() + [rng.uniform(0.1, 1.0) for _ in range(3)] + [
+                    rng.uniform(-math.pi, math.pi) for _ in range(3)]
+            f.write(prim_type + ' ' + ' '.join(repr(p) for p in parameters) + '\n')
+
+
+def median_time(function, repeat):
+    '''
+    Return the wall time of a call to function(): median of repeat
+    repetitions of at least MIN_TIME seconds each, with the garbage collector
+    disabled (as the timeit module). The median is used rather than the best
+    time, which depends on short bursts of speed of some (virtual) machines.
+    '''
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        # number of calls per repetition
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_TIME:
+                break
+            number = number * 2
+        times = [elapsed]
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            times.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    times.sort()
+    return times[len(times) // 2] / number
+
+
+def make_expressions(size, count, seed=SEED):
+    '''
+    Return count expressions with exactly size nodes drawn uniformly (see
+    random_tree.makeuniformtree(); random_tree.setup() must have been
+    called).
+    '''
+    rng = random.Random(seed)
+    return [random_tree.makeuniformtree(size, rng).to_string() for _ in range(count)]
+
+
+#------------------------------------------------------------------------------
+
+
+def benchmark_generation(fit_name, fit_filename, repeat, results):
+    random_tree.setup(fit_filename)
+    for max_depth, pop_size in GENERATION_WORKLOADS:
+        def generate():
+            rng = random.Random(SEED)
+            for _ in range(pop_size):
+                random_tree.makerandomtree(max_depth, random_tree.OPERATION_PROBABILITY, rng)
+        elapsed = median_time(generate, repeat)
+        key = 'generation/%s/max_depth=%d/pop_size=%d/seconds_per_tree' % (
+            fit_name, max_depth, pop_size)
+        results[key] = elapsed / pop_size
+
+
+def benchmark_parsing(fit_name, fit_filename, repeat, results):
+    random_tree.setup(fit_filename)
+    tree_from_expression.PRIMITIVES = [tn.name for tn in random_tree.g_list_terminalnodes]
+    for size in EXPRESSION_SIZES:
+        expressions = make_expressions(size, NUM_EXPRESSIONS)
+
+        def parse():
+            for expression in expressions:
+                prefix = tree_from_expression.construct_tree(expression)
+                tree_from_expression.build_tree(collections.deque(prefix))
+        elapsed = median_time(parse, repeat)
+        length = sum(len(e) for e in expressions) // len(expressions)
+        key = 'parsing/%s/nodes=%d/chars=%d/seconds_per_expression' % (
+            fit_name, size, length)
+        results[key] = elapsed / len(expressions)
+    tree_from_expression.PRIMITIVES = []
+
+
+def benchmark_codegen(fit_name, fit_filename, work_dir, repeat, results):
+    random_tree.setup(fit_filename)
+    prim_list = create_eval_source.read_fit(fit_filename)
+    cpp_filename = os.path.join(work_dir, 'benchmark.cpp')
+    for size in EXPRESSION_SIZES:
+        expression = make_expressions(size, 1)[0]
+        for optimize in (False, True):
+            def generate():
+                create_eval_source.create_eval_cpp(prim_list, expression, cpp_filename,
+                                                   optimize)
+            elapsed = median_time(generate, repeat)
+            key = 'codegen/%s/nodes=%d/optimize=%d/seconds_per_file' % (
+                fit_name, size, int(optimize))
+            results[key] = elapsed
+
+
+def benchmark_evaluation(fit_name, fit_filename, repeat, results):
+    '''
+    Per point cost of the compiled eval() (the compilation is not measured;
+    skipped if no C++ compiler is available).
+    '''
+    random_tree.setup(fit_filename)
+    rng = np.random.RandomState(SEED)
+    points = rng.uniform(-1.0, 1.0, (NUM_POINTS, 3))
+    out = np.empty(NUM_POINTS)
+    for size in EXPRESSION_SIZES:
+        expression = make_expressions(size, 1)[0]
+        try:
+            evaluator = native_eval.load_evaluator(expression, fit_filename)
+        except (OSError, native_eval.subprocess.CalledProcessError) as e:
+            print('Skipping the evaluation benchmarks: %s' % e)
+            return
+        elapsed = median_time(lambda: evaluator.eval_batch(points, out), repeat)
+        key = 'evaluation/%s/nodes=%d/seconds_per_point' % (fit_name, size)
+        results[key] = elapsed / NUM_POINTS
+
+
+def benchmark_cache(fit_name, fit_filename, repeat, results):
+    '''
+    Per point cost of the fitness of a few trees (with all the metrics)
+    without primitive cache, with a cache too small for the trees and with a
+    cache holding all the primitives.
+    '''
+    random_tree.setup(fit_filename)
+    prim_list = create_eval_source.read_fit(fit_filename)
+    expressions = make_expressions(CACHE_TREE_SIZE, CACHE_NUM_TREES)
+    rng = np.random.RandomState(SEED)
+    normals = fitness.normalize(rng.normal(size=(CACHE_NUM_POINTS, 3)))[0]
+    points = 0.5 * normals
+    weights = {'distance': 1.0, 'classification': 1.0, 'normals': 1.0}
+    # rows of values and gradients at the points, and rows of values at the
+    # points offset inside and outside
+    small_memory = CACHE_SMALL_ROWS * 4 * np.dtype(np.float64).itemsize * CACHE_NUM_POINTS
+    for budget, cache_memory in [('none', 0), ('small', 3 * small_memory),
+                                 ('large', primitive_cache.MAX_MEMORY)]:
+        def evaluate():
+            fitness.evaluate_fitness(expressions, prim_list, points, normals, weights,
+                                     cache_memory=cache_memory)
+        elapsed = median_time(evaluate, repeat)
+        key = 'cache/%s/budget=%s/seconds_per_point' % (fit_name, budget)
+        results[key] = elapsed / (CACHE_NUM_TREES * CACHE_NUM_POINTS)
+
+
+def check_cache(results, threshold=THRESHOLD):
+    '''
+    Compare the cache benchmarks with the ones without cache. Return the
+    list of (name, without cache, current, ratio) of the measurements slower
+    than the one without cache by more than threshold.
+    '''
+    regressions = []
+    for name in results:
+        if not name.startswith('cache/') or '/budget=none/' in name:
+            continue
+        parts = name.split('/')
+        reference = results['/'.join(parts[0:2] + ['budget=none'] + parts[3:])]
+        ratio = results[name] / reference if reference > 0 else float('inf')
+        if ratio > 1.0 + threshold:
+            print('%s is %.2f times slower than without cache' % (name, ratio))
+            regressions.append((name, reference, results[name], ratio))
+    return regressions
+
+
+def run_benchmarks(repeat=REPEAT, stages=None):
+    '''
+    Run the benchmarks and return a dictionary name -> measurement.
+    Args:
+        stages: names of the benchmarks to run (generation, parsing, codegen,
+        evaluation, cache), all of them if None
+    '''
+    if stages is None:
+        stages = BENCHMARKS
+    results = collections.OrderedDict()
+    work_dir = tempfile.mkdtemp()
+    try:
+        fits = [('example', os.path.join(SOURCE_DIR, 'example.fit'))]
+        for num_primitives in SYNTHETIC_SIZES:
+            fit_filename = os.path.join(work_dir, 'synthetic%d.fit' % num_primitives)
+            write_synthetic_fit(fit_filename, num_primitives)
+            fits.append(('synthetic%d' % num_primitives, fit_filename))
+
+        for fit_name, fit_filename in fits:
+            if 'generation' in stages:
+                benchmark_generation(fit_name, fit_filename, repeat, results)
+            if 'parsing' in stages:
+                benchmark_parsing(fit_name, fit_filename, repeat, results)
+            if 'codegen' in stages:
+                benchmark_codegen(fit_name, fit_filename, work_dir, repeat, results)
+            # the compilation of the evaluation benchmarks does not depend on
+            # the number of primitives of the file: only example.fit is used
+            if 'evaluation' in stages and fit_name == 'example':
+                benchmark_evaluation(fit_name, fit_filename, repeat, results)
+            if 'cache' in stages and fit_name == 'example':
+                benchmark_cache(fit_name, fit_filename, repeat, results)
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+BENCHMARKS = ['generation', 'parsing', 'codegen', 'evaluation', 'cache']
+
+
+#------------------------------------------------------------------------------
+
+
+def machine_info():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+
+def save_results(results, filename):
+    data = {'machine': machine_info(), 'results': results}
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+
+
+def read_results(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    '''
+    Compare measurements with a baseline. Return the list of
+    (name, baseline, current, ratio) of the regressions (the measurements
+    slower than the baseline by more than threshold).
+    '''
+    regressions = []
+    print('%-72s %12s %12s %7s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name in results:
+        if name not in baseline:
+            print('%-72s %12s %12.4g %7s' % (name, '-', results[name], 'new'))
+            continue
+        ratio = results[name] / baseline[name] if baseline[name] > 0 else float('inf')
+        status = ''
+        if ratio > 1.0 + threshold:
+            status = ' REGRESSION'
+            regressions.append((name, baseline[name], results[name], ratio))
+        print('%-72s %12.4g %12.4g %7.2f%s' % (name, baseline[name], results[name], ratio,
+                                               status))
+    return regressions
+
+
+def main(output_filename=None, baseline_filename=DEFAULT_BASELINE, threshold=THRESHOLD,
+         repeat=REPEAT, stages=None, update_baseline=False):
+    results = run_benchmarks(repeat, stages)
+    if output_filename is not None:
+        save_results(results, output_filename)
+    cache_regressions = check_cache(results, threshold)
+
+    if update_baseline:
+        save_results(results, baseline_filename)
+        print('Baseline saved in ' + baseline_filename)
+        return 1 if cache_regressions else 0
+    if not os.path.exists(baseline_filename):
+        print('No baseline: ' + baseline_filename)
+        for name in results:
+            print('%-72s %12.4g' % (name, results[name]))
+        return 1 if cache_regressions else 0
+
+    regressions = cache_regressions + compare(results, read_results(baseline_filename),
+                                              threshold)
+    if regressions:
+        print('%d regression(s) above %.0f%%' % (len(regressions), 100.0 * threshold))
+        return 1
+    print('No regression above %.0f%%' % (100.0 * threshold))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--output", help="JSON file where the measurements are saved")
+    parser.add_argument(
+        "--baseline", default=DEFAULT_BASELINE,
+        help="JSON file with the baseline measurements; Default: "
+        "benchmark_baseline.json")
+    parser.add_argument(
+        "--threshold", type=float, default=THRESHOLD,
+        help="a measurement slower than the baseline by more than this "
+        "fraction is a regression; Default: 0.25")
+    parser.add_argument(
+        "--repeat", type=int, default=REPEAT,
+        help="number of repetitions of each measurement (the median is "
+        "kept); Default: 5")
+    parser.add_argument(
+        "--stage", action="append", choices=BENCHMARKS,
+        help="run only this benchmark (can be repeated); Default: all")
+    parser.add_argument(
+        "--update_baseline", action="store_true",
+        help="save the measurements as the new baseline instead of comparing "
+        "them")
+
+    args = parser.parse_args()
+
+    sys.exit(main(args.output, args.baseline, args.threshold, args.repeat, args.stage,
+                  args.update_baseline))
@@ -0,0 +1,287 @@
+# Binary population files, with random access to the trees.
+#
+# The trees are stored as the codes of population_store.py (operation codes
+# and primitive indices in prefix order), followed by an index with the
+# offset of each tree. The file is memory-mapped: tree k is read without
+# reading (or parsing) the other trees, whatever the size of the file.
+# The header references the .fit file (by its sha256 hash) and contains the
+# names of the primitives, which replaces list_primitives.txt.
+#
+# Layout (little endian):
+#   magic (8 bytes), sha256 of the .fit file (32 bytes),
+#   number of trees, number of codes, size of the names (uint64 each),
+#   names of the primitives separated by commas (utf-8), padded to a
+#   multiple of 8 bytes,
+#   codes of the trees (int32), padded to a multiple of 8 bytes,
+#   offset of each tree in the codes, followed by the number of codes (int64)
+
+
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+import tempfile
+
+import random_tree
+import population_store
+
+
+MAGIC = b'CSGPOP01'
+
+_HEADER = struct.Struct('<8s32s3Q')
+
+# number of codes buffered before being written
+BUFFER_SIZE = 1024 * 1024
+
+
+def _padding(size):
+    return (8 - size % 8) % 8
+
+
+def fit_digest(fit_filename):
+    '''
+    Return the sha256 hash of a .fit file.
+    '''
+    h = hashlib.sha256()
+    with open(fit_filename, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(data)
+    return h.digest()
+
+
+def is_binary_population(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _check_byteorder():
+    # the codes and offsets are native arrays
+    if sys.byteorder != 'little':
+        raise Exception('Binary population files require a little endian machine')
+
+
+class BinaryPopulationWriter(object):
+    '''
+    Write the trees of a population, one at a time, to a binary population
+    file. Only the offsets of the trees are kept in memory. The file is
+    written under a temporary name and renamed by close().
+    '''
+    def __init__(self, file_name, primitive_names, digest):
+        '''
+        Args:
+            file_name: name of the binary population file
+            primitive_names: names of the primitives (leaves)
+            digest: sha256 hash of the .fit file (see fit_digest())
+        '''
+        _check_byteorder()
+        self.file_name = file_name
+        self.primitive_names = list(primitive_names)
+        self.primitive_index = population_store.create_primitive_index(self.primitive_names)
+        self.digest = digest
+        self.names = ','.join(self.primitive_names).encode('utf-8')
+        self.codes = array.array('i')
+        self.offsets = array.array('q', [0])
+        self.num_codes = 0
+        directory = os.path.dirname(os.path.abspath(file_name))
+        fd, self.temp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+        # the header is written again by close(), with the numbers of trees
+        # and codes
+        self.f.write(self._header())
+        self.f.write(self.names)
+        self.f.write(bytes(_padding(len(self.names))))
+
+    def _header(self):
+        return _HEADER.pack(MAGIC, self.digest, len(self.offsets) - 1, self.num_codes,
+                            len(self.names))
+
+    def _flush(self):
+        self.codes.tofile(self.f)
+        del self.codes[:]
+
+    def _append_codes(self, codes):
+        self.codes.extend(codes)
+        self.num_codes = self.num_codes + len(codes)
+        self.offsets.append(self.num_codes)
+        if len(self.codes) >= BUFFER_SIZE:
+            self._flush()
+
+    def append_expression(self, expression):
+        self._append_codes(population_store.expression_to_codes(expression,
+                                                                self.primitive_index))
+
+    def append_tree(self, tree):
+        self._append_codes(population_store.tree_to_codes(tree, self.primitive_index))
+
+    def close(self):
+        try:
+            self._flush()
+            self.f.write(bytes(_padding(4 * self.num_codes)))
+            self.offsets.tofile(self.f)
+            self.f.seek(0)
+            self.f.write(self._header())
+            self.f.close()
+            os.replace(self.temp_name, self.file_name)
+        finally:
+            if not self.f.closed:
+                self.f.close()
+            if os.path.exists(self.temp_name):
+                os.remove(self.temp_name)
+
+    def abort(self):
+        '''
+        Close and remove the file being written.
+        '''
+        self.f.close()
+        os.remove(self.temp_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BinaryPopulation(object):
+    '''
+    A memory-mapped binary population file.
+    Member variables:
+        digest: sha256 hash of the .fit file of the primitives
+        primitive_names: names of the primitives
+        codes, offsets: views of the arrays of the file (see the top of the
+        file)
+    '''
+    def __init__(self, file_name):
+        _check_byteorder()
+        with open(file_name, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise Exception(file_name + ' is not a binary population file')
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.digest, num_trees, num_codes, names_size = _HEADER.unpack_from(self.mapped)
+        if magic != MAGIC:
+            raise Exception(file_name + ' is not a binary population file')
+        offset = _HEADER.size
+        codes_offset = offset + names_size + _padding(names_size)
+        offsets_offset = codes_offset + 4 * num_codes + _padding(4 * num_codes)
+        if offsets_offset + 8 * (num_trees + 1) != size:
+            raise Exception('Truncated or corrupted binary population file: ' + file_name)
+
+        view = memoryview(self.mapped)
+        names = bytes(view[offset:offset+names_size]).decode('utf-8')
+        self.primitive_names = names.split(',') if names else []
+        self.codes = view[codes_offset:codes_offset+4*num_codes].cast('i')
+        self.offsets = view[offsets_offset:offsets_offset+8*(num_trees+1)].cast('q')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def tree_codes(self, k):
+        if k < 0 or k >= len(self):
+            raise Exception('No tree %d in a population of %d trees' % (k, len(self)))
+        return self.codes[self.offsets[k]:self.offsets[k+1]]
+
+    def to_string(self, k):
+        return population_store.codes_to_string(self.tree_codes(k), self.primitive_names)
+
+    def to_tree(self, k):
+        return population_store.codes_to_tree(self.tree_codes(k), self.primitive_names)
+
+    def expressions(self):
+        for k in range(len(self)):
+            yield self.to_string(k)
+
+    def check_fit(self, fit_filename):
+        '''
+        Raise an exception if the population was not generated from the
+        primitives of fit_filename.
+        '''
+        if fit_digest(fit_filename) != self.digest:
+            raise Exception('The population was not generated from ' + fit_filename)
+
+
+#------------------------------------------------------------------------------
+# Reading of text or binary population files
+
+
+def read_expressions(file_name):
+    '''
+    Yield the expressions of a population file, text (one expression per
+    line, possibly gzip compressed) or binary.
+    '''
+    if is_binary_population(file_name):
+        for expression in BinaryPopulation(file_name).expressions():
+            yield expression
+        return
+    with random_tree.open_population_file(file_name) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                yield line
+
+
+def read_expression(file_name, index=0):
+    '''
+    Return the expression of tree index of a population file, text or
+    binary. For a binary file, the other trees are not read.
+    '''
+    if is_binary_population(file_name):
+        return BinaryPopulation(file_name).to_string(index)
+    if index >= 0:
+        k = 0
+        for expression in read_expressions(file_name):
+            if k == index:
+                return expression
+            k = k + 1
+    raise Exception('No tree %d in %s' % (index, file_name))
+
+
+def check_fit(file_name, fit_filename):
+    '''
+    If file_name is a binary population, check that it was generated from
+    the primitives of fit_filename (the text files do not reference it).
+    '''
+    if is_binary_population(file_name):
+        BinaryPopulation(file_name).check_fit(fit_filename)
+
+
+def write_population(expressions, file_name, primitive_names, fit_filename):
+    '''
+    Save expressions in a binary population file.
+    '''
+    with BinaryPopulationWriter(file_name, primitive_names,
+                                fit_digest(fit_filename)) as writer:
+        for expression in expressions:
+            writer.append_expression(expression)
+
+
+def main(fit_filename, population_filename, primitives_filename, binary_filename):
+    with open(primitives_filename) as f:
+        primitive_names = f.readline().strip().split(',')
+    write_population(read_expressions(population_filename), binary_filename,
+                     primitive_names, fit_filename)
+    print('Number of trees: %d' % len(BinaryPopulation(binary_filename)))
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' model.fit expressions.txt list_primitives.txt population.pop')
+    print('Where:')
+    print('\t model.fit: the file of the primitives used to generate the expressions')
+    print('\t expressions.txt: a file containing one expression per line')
+    print('\t list_primitives.txt: the list of primitive names')
+    print('\t population.pop: the binary population file created')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 5:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -0,0 +1,438 @@
+# Compile expressions (trees) into a flat program and run it over batches of
+# points.
+#
+# A program is a list of instructions in postfix order. Each instruction
+# writes its result in a register; the registers are reused as soon as their
+# value has been consumed, such that the number of registers is the maximum
+# number of pending values (at most the depth of the tree).
+#
+# Instructions:
+#   (OP_LOAD, dst, k)            dst = primitive program.primitives[k]
+#   (OP_UNION, dst, a, b)        dst = set_union(a, b)
+#   (OP_INTERSECTION, dst, a, b) dst = set_intersection(a, b)
+#   (OP_SUBTRACTION, dst, a, b)  dst = set_subtraction(a, b)
+#   (OP_NEGATION, dst, a)        dst = set_negation(a)
+#   (OP_COPY, dst, a)            dst = copy of a
+#   (OP_MOVE, dst, a)            dst = a; a is not used anymore
+#
+# The last two are used for the subtrees shared by several nodes (see
+# simplify.py): their value is computed once and kept in a dedicated register
+# until its last use.
+
+
+import sys
+import hashlib
+import collections
+
+import numpy as np
+
+import random_tree
+import expression_parser
+import evaluate
+import simplify
+import create_eval_source
+import primitive_cache
+import binary_population
+
+
+OP_LOAD = 0
+OP_UNION = 1
+OP_INTERSECTION = 2
+OP_SUBTRACTION = 3
+OP_NEGATION = 4
+OP_COPY = 5
+OP_MOVE = 6
+
+OPCODES = {
+    'union': OP_UNION,
+    'intersection': OP_INTERSECTION,
+    'subtraction': OP_SUBTRACTION,
+    'negation': OP_NEGATION,
+}
+
+OPCODE_NAMES = {
+    OP_LOAD: 'load',
+    OP_UNION: 'union',
+    OP_INTERSECTION: 'intersection',
+    OP_SUBTRACTION: 'subtraction',
+    OP_NEGATION: 'negation',
+    OP_COPY: 'copy',
+    OP_MOVE: 'move',
+}
+
+# number of operands of each operation
+ARITY = {OP_UNION: 2, OP_INTERSECTION: 2, OP_SUBTRACTION: 2, OP_NEGATION: 1}
+
+# maximum number of compiled programs kept in the cache
+PROGRAM_CACHE_SIZE = 10000
+
+
+class Program(object):
+    '''
+    A compiled expression.
+    Member variables:
+        instructions: list of tuples (see the top of the file)
+        num_registers: number of registers needed to run the program
+        primitives: names of the primitives loaded by the program
+    '''
+    def __init__(self, instructions, num_registers, primitives):
+        self.instructions = instructions
+        self.num_registers = num_registers
+        self.primitives = primitives
+
+    def display(self):
+        for instruction in self.instructions:
+            opcode = instruction[0]
+            if opcode == OP_LOAD:
+                print('r%d = %s' % (instruction[1], self.primitives[instruction[2]]))
+            else:
+                operands = ','.join('r%d' % r for r in instruction[2:])
+                print('r%d = %s(%s)' % (instruction[1], OPCODE_NAMES[opcode], operands))
+
+
+class _ProgramBuilder(object):
+    '''
+    Emit the instructions of a program, allocating the registers as a stack:
+    the operands of an operation are the last pending values and its result
+    replaces the first one.
+    '''
+    def __init__(self):
+        self.instructions = []
+        self.primitives = []
+        self.primitive_index = {}
+        self.depth = 0
+        self.num_registers = 0
+        # registers keeping the values of shared subtrees are numbered
+        # -1, -2, ... until the program is complete
+        self.num_saved_registers = 0
+        self.free_saved_registers = []
+
+    def load(self, name):
+        if name not in self.primitive_index:
+            self.primitive_index[name] = len(self.primitives)
+            self.primitives.append(name)
+        self.instructions.append((OP_LOAD, self.depth, self.primitive_index[name]))
+        self.depth = self.depth + 1
+        self.num_registers = max(self.num_registers, self.depth)
+
+    def operation(self, name):
+        opcode = OPCODES[name]
+        arity = ARITY[opcode]
+        if self.depth < arity:
+            raise Exception('Missing arguments for ' + name)
+        dst = self.depth - arity
+        operands = tuple(range(dst, self.depth))
+        self.instructions.append((opcode, dst) + operands)
+        self.depth = dst + 1
+
+    def save(self):
+        '''
+        Copy the last pending value in a saved register and return it.
+        '''
+        if self.free_saved_registers:
+            saved = self.free_saved_registers.pop()
+        else:
+            self.num_saved_registers = self.num_saved_registers + 1
+            saved = -self.num_saved_registers
+        self.instructions.append((OP_COPY, saved, self.depth - 1))
+        return saved
+
+    def restore(self, saved, last_use):
+        '''
+        Push the value of a saved register as a new pending value.
+        '''
+        opcode = OP_COPY
+        if last_use:
+            opcode = OP_MOVE
+            self.free_saved_registers.append(saved)
+        self.instructions.append((opcode, self.depth, saved))
+        self.depth = self.depth + 1
+        self.num_registers = max(self.num_registers, self.depth)
+
+    def program(self):
+        if self.depth != 1:
+            raise Exception('Incomplete expression')
+        instructions = self.instructions
+        if self.num_saved_registers > 0:
+            # saved registers are placed after the stack registers
+            def remap(r):
+                if r < 0:
+                    return self.num_registers - 1 - r
+                return r
+            instructions = []
+            for instruction in self.instructions:
+                opcode = instruction[0]
+                if opcode == OP_LOAD:
+                    instructions.append((opcode, remap(instruction[1]), instruction[2]))
+                else:
+                    instructions.append((opcode,) + tuple(remap(r) for r in instruction[1:]))
+        num_registers = self.num_registers + self.num_saved_registers
+        return Program(instructions, num_registers, self.primitives)
+
+
+def compile_expression(expression):
+    '''
+    Compile an expression (as saved by random_tree.save_population_to_file)
+    without building the corresponding tree.
+    '''
+    builder = _ProgramBuilder()
+    # operations waiting for their arguments: [name, number of missing
+    # arguments]
+    pending = []
+    for symbol in expression_parser.parse_prefix(expression):
+        if expression_parser.is_operation(symbol):
+            pending.append([symbol, expression_parser.ARITY[symbol]])
+            continue
+        builder.load(symbol)
+        # close the operations whose arguments are all computed
+        while pending:
+            pending[-1][1] = pending[-1][1] - 1
+            if pending[-1][1] > 0:
+                break
+            builder.operation(pending.pop()[0])
+    return builder.program()
+
+
+def compile_tree(tree):
+    '''
+    Compile a tree made of node and terminalnode objects. Subtrees shared by
+    several nodes (see simplify.py) are computed once.
+    '''
+    references = simplify.count_references(tree)
+    builder = _ProgramBuilder()
+    # saved register and number of remaining uses of the shared subtrees
+    # already computed
+    saved = {}
+    remaining_uses = {}
+    # post-order traversal with an explicit stack of (node, visited) pairs
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        key = id(current)
+        if key in saved:
+            remaining_uses[key] = remaining_uses[key] - 1
+            builder.restore(saved[key], remaining_uses[key] == 0)
+            continue
+
+        if len(current.children) == 0:
+            builder.load(current.name)
+        elif visited:
+            builder.operation(current.name)
+        else:
+            stack.append((current, True))
+            for c in reversed(current.children):
+                stack.append((c, False))
+            continue
+
+        if references[key] > 1:
+            saved[key] = builder.save()
+            remaining_uses[key] = references[key] - 1
+
+    return builder.program()
+
+
+_program_cache = collections.OrderedDict()
+
+
+def expression_hash(expression):
+    return hashlib.sha1(expression.encode('utf-8')).hexdigest()
+
+
+def get_program(expression, simplified=False):
+    '''
+    Return the compiled program for an expression. Programs are cached by
+    the hash of the expression.
+    Args:
+        simplified: if True, the expression is simplified first (see
+        simplify.py) and its shared subtrees are computed once
+    '''
+    key = (expression_hash(expression), simplified)
+    program = _program_cache.get(key)
+    if program is not None:
+        _program_cache.move_to_end(key)
+        return program
+
+    if simplified:
+        tree = simplify.simplify(random_tree.tree_from_string(expression))
+        program = compile_tree(tree)
+    else:
+        program = compile_expression(expression)
+    _program_cache[key] = program
+    if len(_program_cache) > PROGRAM_CACHE_SIZE:
+        _program_cache.popitem(last=False)
+    return program
+
+
+def clear_program_cache():
+    _program_cache.clear()
+
+
+#------------------------------------------------------------------------------
+
+
+def run_program(program, table, x, y, z, primitive_values=None, gradient=False):
+    '''
+    Run a program at the points with coordinates x, y, z and return the
+    array of values.
+    Args:
+        program: a compiled Program
+        table: primitive table returned by evaluate.create_primitive_table()
+        x, y, z: arrays of coordinates
+        primitive_values: optional function returning the values of a
+        primitive (given by its name) at the points, e.g. read from a
+        primitive_cache.PrimitiveCache, instead of computing them
+        gradient: if True, return the values and the analytic gradients, as
+        an array of shape (4, number of points) (see evaluate.py);
+        primitive_values must then return them too
+    '''
+    # the arrays of the registers are created by the loads and then updated
+    # in place
+    registers = [None] * program.num_registers
+    primitive_function = evaluate.evaluate_primitive
+    if gradient:
+        primitive_function = evaluate.evaluate_primitive_gradient
+
+    primitives = program.primitives
+    for instruction in program.instructions:
+        opcode = instruction[0]
+        dst = instruction[1]
+        if opcode == OP_LOAD:
+            name = primitives[instruction[2]]
+            if primitive_values is not None:
+                # copied: the registers are modified in place
+                registers[dst] = np.array(primitive_values(name), dtype=x.dtype)
+                continue
+            if name not in table:
+                raise Exception('Unknown primitive: ' + name)
+            prim_type, parameters = table[name]
+            registers[dst] = primitive_function(prim_type, parameters, x, y, z)
+            continue
+        if opcode == OP_COPY:
+            registers[dst] = registers[instruction[2]].copy()
+            continue
+        if opcode == OP_MOVE:
+            registers[dst] = registers[instruction[2]]
+            registers[instruction[2]] = None
+            continue
+
+        # the destination is always the first operand: update it in place
+        f = registers[instruction[2]]
+        if opcode == OP_NEGATION:
+            np.negative(f, out=f)
+            continue
+        g = registers[instruction[3]]
+        if opcode == OP_SUBTRACTION:
+            np.negative(g, out=g)
+        # with the gradients, the operand is selected from the values (row 0)
+        # and its whole column is copied
+        f_values = f
+        g_values = g
+        if gradient:
+            f_values = f[0]
+            g_values = g[0]
+        if opcode == OP_UNION:
+            # std::max(f, g)
+            np.copyto(f, g, where=(f_values < g_values))
+        else:
+            # std::min(f, g), std::min(f, -g)
+            np.copyto(f, g, where=(g_values < f_values))
+
+    return registers[0]
+
+
+def evaluate_programs(programs, table, points, dtype=np.float64,
+                      max_memory=evaluate.MAX_MEMORY, cache=None):
+    '''
+    Run several programs at each point of an (N,3) array.
+    Return an array of shape (number of programs, N).
+    Args:
+        cache: optional primitive_cache.PrimitiveCache of the same points,
+        from which the values of the primitives are read
+    '''
+    points = evaluate.check_points(points)
+    num_points = points.shape[0]
+    result = np.empty((len(programs), num_points), dtype=dtype)
+    num_registers = max([p.num_registers for p in programs] + [1])
+    chunk_size = evaluate.compute_chunk_size(
+        num_registers, np.dtype(dtype).itemsize, max_memory)
+
+    if cache is None:
+        for start in range(0, num_points, chunk_size):
+            chunk = np.asarray(points[start:start+chunk_size], dtype=dtype)
+            x, y, z = evaluate.split_coordinates(chunk)
+            for i in range(len(programs)):
+                result[i, start:start+chunk_size] = run_program(programs[i], table, x, y, z)
+        return result
+
+    # with a cache, all the chunks are evaluated for a program before the
+    # next one, such that the rows it uses are not evicted in between
+    for i in range(len(programs)):
+        for start in range(0, num_points, chunk_size):
+            chunk = np.asarray(points[start:start+chunk_size], dtype=dtype)
+            x, y, z = evaluate.split_coordinates(chunk)
+            primitive_values = None
+            if cache.holds(programs[i].primitives):
+                primitive_values = evaluate.cached_values(cache, start, start+chunk_size)
+            result[i, start:start+chunk_size] = run_program(
+                programs[i], table, x, y, z, primitive_values=primitive_values)
+
+    return result
+
+
+def evaluate_population(expressions, prim_list, points, dtype=np.float64,
+                        max_memory=evaluate.MAX_MEMORY, simplified=False,
+                        cache_memory=0, cache_dtype=np.float64):
+    '''
+    Evaluate a list of expressions at each point of an (N,3) array.
+    Return an array of shape (number of expressions, N).
+    Args:
+        simplified: if True, the expressions are simplified before being
+        compiled (see simplify.py)
+        cache_memory: if not 0, the values of the primitives are computed
+        once in a primitive_cache.PrimitiveCache with this memory budget
+        cache_dtype: type of the values stored in the cache
+    '''
+    programs = [get_program(e, simplified) for e in expressions]
+    table = evaluate.create_primitive_table(prim_list, dtype)
+    cache = None
+    if cache_memory > 0:
+        cache = primitive_cache.PrimitiveCache(table, points, cache_memory, cache_dtype)
+    return evaluate_programs(programs, table, points, dtype, max_memory, cache)
+
+
+def read_population(filename):
+    '''
+    Read the expressions (one per line) saved by
+    random_tree.save_population_to_file, or the ones of a binary population
+    file.
+    '''
+    return list(binary_population.read_expressions(filename))
+
+
+def main(fit_filename, population_filename, points_filename, values_filename):
+    prim_list = create_eval_source.read_fit(fit_filename)
+    expressions = read_population(population_filename)
+    points = np.loadtxt(points_filename, ndmin=2)
+    values = evaluate_population(expressions, prim_list, points[:, 0:3],
+                                 cache_memory=primitive_cache.MAX_MEMORY)
+    # one line per expression, one column per point
+    np.savetxt(values_filename, values, fmt='%.17g')
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' model.fit expressions.txt points.txt values.txt')
+    print('Where:')
+    print('\t model.fit: a file containing a list of fitted primitives')
+    print('\t expressions.txt: a file containing one expression per line')
+    print('\t points.txt: a file with one point (x y z) per line')
+    print('\t values.txt: the file where the values are saved (one line per expression)')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 5:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
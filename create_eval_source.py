@@ -4,8 +4,16 @@
 # - generate a .cpp file with the read expression and fitted primitives in eval()
 
 
-import sys
 import re
+import math
+import argparse
+
+import random_tree
+import simplify
+import expression_parser
+import fit_loader
+import binary_population
+import instrumentation
 
 
 def read_fit(fit_filename):
@@ -15,113 +23,522 @@ def read_fit(fit_filename):
     name, type, parameter1, parameter2, ...
     where: name is a string, type is a string, parameters are float
     '''
+    # the file is parsed (and the parameters checked) by fit_loader
+    return fit_loader.load_fit(fit_filename).to_list()
 
-    f = open(fit_filename)
 
-    list_primitives = []
-    count = 0
+def read_expression(exp_filename, index=0):
+    '''
+    Read the expression of tree index of a file written by random_tree.py
+    (one expression per line, or a binary population file).
+    '''
+    return binary_population.read_expression(exp_filename, index)
 
-    for line in f:
-        elements = line.strip().split()
-        if len(elements)==0:
-            continue
 
-        prim_type = elements[0]
-        parameters = []
-        for i in range(1, len(elements)):
-            parameters.append(float(elements[i]))
+def read_expressions(exp_filename):
+    '''
+    Read all the expressions of a file written by random_tree.py (one
+    expression per line, or a binary population file).
+    '''
+    return list(binary_population.read_expressions(exp_filename))
 
-        primitive = []
-        prim_name = prim_type + str(count)
-        primitive.append(prim_name)
-        primitive.append(prim_type)
-        for parameter in parameters:
-            primitive.append(parameter)
 
-        count = count + 1
+def format_float(value):
+    '''
+    Format a float such that it is read back (by Python or a C++ compiler)
+    as exactly the same double.
+    '''
+    return repr(float(value))
 
-        list_primitives.append(primitive)
 
-    f.close()
-    return list_primitives
+def inverse_rotation_matrix(theta, phi, psi):
+    '''
+    Return the 9 coefficients (row major) of the matrix applied by
+    apply_inverse_rotation() in primitives.cpp. The products are computed in
+    the same order as in the C++ code.
+    '''
+    ctheta = math.cos(theta)
+    stheta = math.sin(theta)
+    cphi = math.cos(phi)
+    sphi = math.sin(phi)
+    cpsi = math.cos(psi)
+    spsi = math.sin(psi)
+    return [ctheta*cphi, spsi*stheta*cphi - cpsi*sphi, spsi*stheta*cphi + spsi*sphi,
+            ctheta*sphi, spsi*stheta*sphi + cpsi*cphi, spsi*stheta*cphi - cpsi*sphi,
+            -stheta, spsi*ctheta, cpsi*ctheta]
 
 
-def read_expression(exp_filename):
-    f = open(exp_filename)
-    line = f.readline()
-    line = line.strip()
-    f.close()
-    return line
+def precompute_parameters(prim_type, parameters):
+    '''
+    Replace the parameters of a primitive by the ones expected by
+    primitive_<type>_precomputed() in primitives.cpp, where the values that
+    do not depend on the point are computed once:
+    - cone: axis_dir, center, cos(angle), -sin(angle)
+    - ellipsoid: center, radii, inverse rotation matrix
+    Other primitives are returned unchanged.
+    '''
+    parameters = list(parameters)
+    if prim_type == 'cone':
+        angle = parameters[6]
+        return parameters[0:6] + [math.cos(angle), -math.sin(angle)]
+    if prim_type == 'ellipsoid':
+        theta, phi, psi = parameters[6:9]
+        return parameters[0:6] + inverse_rotation_matrix(theta, phi, psi)
+    return parameters
 
 
-def create_eval_cpp(prim_list, expression, cpp_filename):
-    f = open(cpp_filename, "w")
-    
-    f.write('#include "operations.h"\n')
-    f.write('#include "primitives.h"\n')
-    f.write('\n')
-    f.write('double eval(double x, double y, double z) {')
-    f.write('\n')
-    # generate the list of primitives
-    # one local variable for each instantiated primitive
-    for prim in prim_list:
-        name = prim[0]
-        prim_type = prim[1]
-        # the parameters 
-        f.write('double %s_parameters[] = ' % name)
-        f.write('{')
-        # write the numerical values of the parameters
-        for i in range(2, len(prim)-1):
-            f.write(str(prim[i])+',')
-        f.write(str(prim[-1]))
-        f.write('};\n')
-        # the primitive 
-        f.write('double %s = ' % name)
-        f.write('primitive_%s' % prim_type)
-        f.write('(x,y,z,%s_parameters);\n' % name)
+# primitives with a primitive_<type>_precomputed() variant
+PRECOMPUTED_PRIMITIVES = ['cone', 'ellipsoid']
+
+
+def referenced_primitives(prim_list, expression):
+    '''
+    Return the primitives of prim_list used in the expression (in the order
+    of prim_list).
+    '''
+    names = expression_parser.primitives_in(expression_parser.parse_prefix(expression))
+    return [prim for prim in prim_list if prim[0] in names]
+
 
+def expression_to_cpp(expression):
     # replace union, ... by set_union, ... in expression
     cpp_expression = expression
     cpp_expression = re.sub('union', 'set_union', cpp_expression)
     cpp_expression = re.sub('subtraction', 'set_subtraction', cpp_expression)
     cpp_expression = re.sub('negation', 'set_negation', cpp_expression)
     cpp_expression = re.sub('intersection', 'set_intersection', cpp_expression)
-    
+
     # replace [] by () for the function call symbols
     # [ and ] need to be escaped but not ( and )
-    cpp_expression = re.sub('\[', '(', cpp_expression)
-    cpp_expression = re.sub('\]', ')', cpp_expression)
+    cpp_expression = re.sub(r'\[', '(', cpp_expression)
+    cpp_expression = re.sub(r'\]', ')', cpp_expression)
+    return cpp_expression
 
-    f.write('double model = %s;\n' % cpp_expression)
 
-    f.write('return model;\n')
+CPP_OPERATIONS = {
+    'union': 'set_union',
+    'intersection': 'set_intersection',
+    'subtraction': 'set_subtraction',
+    'negation': 'set_negation',
+}
+
+
+def tree_to_cpp(tree):
+    '''
+    Return the C++ code for a tree (node and terminalnode objects) as a list
+    of statements and an expression. The value of each operation shared by
+    several nodes (see simplify.py) is computed once in a local variable by
+    the statements, given as (variable, expression) pairs (the type of the
+    variables depends on the function they are written in, see
+    write_eval_function()).
+    '''
+    references = simplify.count_references(tree)
+    statements = []
+    code = {}
+    # post-order traversal with an explicit stack of (node, visited) pairs
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        key = id(current)
+        if key in code:
+            continue
+        if len(current.children) == 0:
+            code[key] = current.name
+        elif visited:
+            arguments = ','.join(code[id(c)] for c in current.children)
+            code[key] = '%s(%s)' % (CPP_OPERATIONS[current.name], arguments)
+            if references[key] > 1:
+                variable = 'shared%d' % len(statements)
+                statements.append((variable, code[key]))
+                code[key] = variable
+        else:
+            stack.append((current, True))
+            for c in reversed(current.children):
+                stack.append((c, False))
+    return statements, code[id(tree)]
+
+
+def write_parameters(f, name, parameters, qualifier=''):
+    f.write('%sdouble %s_parameters[] = ' % (qualifier, name))
+    f.write('{')
+    # write the numerical values of the parameters
+    f.write(','.join(format_float(p) for p in parameters))
+    f.write('};\n')
+
+
+def prepare_expression(prim_list, expression, simplified=False):
+    '''
+    Check an expression and return (statements, cpp_expression, expression)
+    where statements and cpp_expression are the C++ code evaluating it (see
+    tree_to_cpp()) and expression is the expression actually evaluated (the
+    simplified one if simplified is True).
+    '''
+    # check the expression before generating code for it
+    expression_parser.parse_prefix(expression, set(prim[0] for prim in prim_list))
+
+    if simplified:
+        tree = simplify.simplify(random_tree.tree_from_string(expression))
+        statements, cpp_expression = tree_to_cpp(tree)
+        # primitives removed by the simplification are not needed anymore
+        return statements, cpp_expression, tree.to_string()
+    return [], expression_to_cpp(expression), expression
+
+
+def write_eval_function(f, function_name, prim_list, statements, cpp_expression,
+                        optimize=False, local_parameters=True, qualifier='',
+                        gradient=False):
+    '''
+    Write a function function_name(x,y,z) evaluating the primitives of
+    prim_list and the C++ expression.
+    Args:
+        optimize: if True, the primitive_<type>_precomputed() variants are
+        called (the parameters must have been precomputed)
+        local_parameters: if True, the parameters of the primitives are
+        written in the function, otherwise they must have been written before
+        qualifier: written before the return type of the function
+        gradient: if True, the function is function_name(x,y,z,gradient):
+        it also writes the gradient of the expression at the point in
+        gradient[3] (the primitives and operations are the value_gradient
+        variants of primitives.h and operations.h)
+    '''
+    value_type = 'double'
+    if gradient:
+        value_type = 'value_gradient'
+        f.write('%sdouble %s(double x, double y, double z, double gradient[3]) {' % (
+            qualifier, function_name))
+    else:
+        f.write('%sdouble %s(double x, double y, double z) {' % (qualifier, function_name))
+    f.write('\n')
+    # generate the list of primitives
+    # one local variable for each instantiated primitive
+    for prim in prim_list:
+        name = prim[0]
+        prim_type = prim[1]
+        primitive_function = 'primitive_%s' % prim_type
+        if optimize and prim_type in PRECOMPUTED_PRIMITIVES:
+            primitive_function = primitive_function + '_precomputed'
+        if gradient:
+            primitive_function = primitive_function + '_gradient'
+        if local_parameters:
+            # the parameters
+            write_parameters(f, name, prim[2:])
+        # the primitive 
+        f.write('%s %s = ' % (value_type, name))
+        f.write(primitive_function)
+        f.write('(x,y,z,%s_parameters);\n' % name)
+
+    for variable, code in statements:
+        f.write('%s %s = %s;\n' % (value_type, variable, code))
+    f.write('%s model = %s;\n' % (value_type, cpp_expression))
+
+    if gradient:
+        for i in range(3):
+            f.write('gradient[%d] = model.gradient[%d];\n' % (i, i))
+        f.write('return model.value;\n')
+    else:
+        f.write('return model;\n')
     f.write('}\n')
 
+
+def write_header(f, system_headers=()):
+    f.write('#include <cstddef>\n')
+    for header in system_headers:
+        f.write('#include <%s>\n' % header)
+    f.write('#include "operations.h"\n')
+    f.write('#include "primitives.h"\n')
+    f.write('\n')
+
+
+def write_shared_parameters(f, prim_list, optimize=False):
+    '''
+    Write the parameters of the primitives as static const data, outside the
+    functions. If optimize is True, the values that do not depend on the
+    point are precomputed.
+    '''
+    for prim in prim_list:
+        parameters = prim[2:]
+        if optimize:
+            parameters = precompute_parameters(prim[1], parameters)
+        write_parameters(f, prim[0], parameters, 'static const ')
+    f.write('\n')
+
+
+def create_eval_cpp(prim_list, expression, cpp_filename, optimize=False,
+                    simplified=False, gradient=False):
+    '''
+    Generate a C++ file with a function eval(x,y,z) evaluating the expression
+    (and eval_grad(x,y,z,gradient) if gradient is True).
+    Args:
+        prim_list: list of primitives as returned by read_fit()
+        expression: the expression for the object
+        cpp_filename: name of the generated file
+        optimize: if True, only the primitives used in the expression are
+        emitted, their parameters are static const data and the values that
+        do not depend on the point are precomputed
+        simplified: if True, the expression is simplified first (see
+        simplify.py) and its shared subtrees are computed once
+        gradient: if True, the functions eval_grad(x,y,z,gradient) and
+        eval_grad_batch() evaluating the expression and its analytic gradient
+        are written too
+    '''
+    statements, cpp_expression, expression = prepare_expression(
+        prim_list, expression, simplified)
+
+    if optimize:
+        prim_list = referenced_primitives(prim_list, expression)
+
+    f = open(cpp_filename, "w")
+    
+    write_header(f)
+
+    if optimize:
+        # the parameters are computed once, outside eval()
+        write_shared_parameters(f, prim_list, optimize=True)
+
+    write_eval_function(f, 'eval', prim_list, statements, cpp_expression,
+                        optimize, local_parameters=not optimize)
+
+    write_eval_batch(f)
+
+    if gradient:
+        f.write('\n')
+        write_eval_function(f, 'eval_grad', prim_list, statements, cpp_expression,
+                            optimize, local_parameters=not optimize, gradient=True)
+        write_eval_grad_batch(f)
+
     f.close()
 
 
-def main(fit_filename, exp_filename, cpp_filename):
-    prim_list = read_fit(fit_filename)
-    expression = read_expression(exp_filename)
-    create_eval_cpp(prim_list, expression, cpp_filename)
+def create_population_cpp(prim_list, expressions, cpp_filename, optimize=False,
+                          simplified=False, gradient=False):
+    '''
+    Generate a single C++ file for a list of expressions, with:
+    - the parameters of the primitives, written once and shared by all the
+      trees
+    - a function eval_<k>(x,y,z) for each expression k, evaluating only the
+      primitives used by this expression
+    - a dispatch table eval_functions[] of these functions
+    - the C functions (see write_eval_population()):
+      num_trees(), eval_tree(k,x,y,z) and eval_all(xyz,n,out)
+    - if gradient is True, a function eval_grad_<k>(x,y,z,gradient) for each
+      expression and the C function eval_tree_grad(k,x,y,z,gradient) (see
+      write_eval_population_gradient())
+    Args: see create_eval_cpp()
+    '''
+    # an empty dispatch table would be a zero-size array
+    if len(expressions) == 0:
+        raise Exception('The population contains no expression')
+    prepared = []
+    used_names = set()
+    for expression in expressions:
+        statements, cpp_expression, expression = prepare_expression(
+            prim_list, expression, simplified)
+        names = expression_parser.primitives_in(expression_parser.parse_prefix(expression))
+        used_names.update(names)
+        prepared.append((statements, cpp_expression, names))
+
+    # the primitive table contains the primitives used by at least one tree
+    shared_list = [prim for prim in prim_list if prim[0] in used_names]
+
+    f = open(cpp_filename, "w")
 
+    # numeric_limits gives the NaN returned for an invalid tree index
+    write_header(f, ['limits'])
+    write_shared_parameters(f, shared_list, optimize)
 
-def usage(progname):
-    print('Usage: ')
-    print(progname + ' model.fit model.txt model.cpp')
-    print('Where:')
-    print('\t model.fit: a file containing a list of fitted primitives')
-    print('\t model.txt: a file containing an expression for the object')
-    print('\t model.cpp: the generated c++ file corresponding to the expression')
+    for k in range(len(prepared)):
+        statements, cpp_expression, names = prepared[k]
+        tree_prim_list = [prim for prim in shared_list if prim[0] in names]
+        write_eval_function(f, 'eval_%d' % k, tree_prim_list, statements,
+                            cpp_expression, optimize, local_parameters=False,
+                            qualifier='static ')
+        f.write('\n')
+        if gradient:
+            write_eval_function(f, 'eval_grad_%d' % k, tree_prim_list, statements,
+                                cpp_expression, optimize, local_parameters=False,
+                                qualifier='static ', gradient=True)
+            f.write('\n')
+
+    write_eval_population(f, len(prepared))
+    if gradient:
+        write_eval_population_gradient(f, len(prepared))
+
+    f.close()
+
+
+def write_eval_population(f, num_trees):
+    '''
+    Write the dispatch table of the functions eval_0 ... eval_<num_trees-1>
+    and the functions with C linkage evaluating them:
+    - num_trees(): the number of trees
+    - eval_tree(k,x,y,z): the value of tree k at a point (NaN if k is not
+      smaller than num_trees())
+    - eval_all(xyz,n,out): the value of every tree at n points stored
+      contiguously (x0,y0,z0,x1,y1,z1,...); the value of tree k at point i is
+      written in out[k*n+i]
+    '''
+    f.write('typedef double (*eval_function)(double, double, double);\n')
+    f.write('\n')
+    f.write('static const eval_function eval_functions[] = {')
+    f.write(','.join('eval_%d' % k for k in range(num_trees)))
+    f.write('};\n')
+    f.write('\n')
+    f.write('extern "C" size_t num_trees() {\n')
+    f.write('return %d;\n' % num_trees)
+    f.write('}\n')
+    f.write('\n')
+    f.write('extern "C" double eval_tree(size_t k, double x, double y, double z) {\n')
+    f.write('if (k >= %d) {\n' % num_trees)
+    f.write('return std::numeric_limits<double>::quiet_NaN();\n')
+    f.write('}\n')
+    f.write('return eval_functions[k](x, y, z);\n')
+    f.write('}\n')
+    f.write('\n')
+    f.write('extern "C" void eval_all(const double* xyz, size_t n, double* out) {\n')
+    f.write('for (size_t k = 0; k < %d; ++k) {\n' % num_trees)
+    f.write('const eval_function eval = eval_functions[k];\n')
+    f.write('double* out_k = out + k*n;\n')
+    f.write('for (size_t i = 0; i < n; ++i) {\n')
+    f.write('const double* p = xyz + 3*i;\n')
+    f.write('out_k[i] = eval(p[0], p[1], p[2]);\n')
+    f.write('}\n')
+    f.write('}\n')
+    f.write('}\n')
+
+
+def write_eval_population_gradient(f, num_trees):
+    '''
+    Write the dispatch table of the functions eval_grad_0 ...
+    eval_grad_<num_trees-1> and the function with C linkage
+    eval_tree_grad(k,x,y,z,gradient) returning the value of tree k at a point
+    and writing its gradient in gradient[3] (NaN for both if k is not smaller
+    than num_trees()).
+    '''
+    f.write('\n')
+    f.write('typedef double (*eval_grad_function)(double, double, double, double*);\n')
+    f.write('\n')
+    f.write('static const eval_grad_function eval_grad_functions[] = {')
+    f.write(','.join('eval_grad_%d' % k for k in range(num_trees)))
+    f.write('};\n')
+    f.write('\n')
+    f.write('extern "C" double eval_tree_grad(size_t k, double x, double y, double z, '
+            'double* gradient) {\n')
+    f.write('if (k >= %d) {\n' % num_trees)
+    f.write('const double nan = std::numeric_limits<double>::quiet_NaN();\n')
+    f.write('gradient[0] = gradient[1] = gradient[2] = nan;\n')
+    f.write('return nan;\n')
+    f.write('}\n')
+    f.write('return eval_grad_functions[k](x, y, z, gradient);\n')
+    f.write('}\n')
+
+
+def write_eval_batch(f):
+    '''
+    Write a function evaluating eval() at n points stored contiguously
+    (x0,y0,z0,x1,y1,z1,...). It has C linkage such that it can be loaded
+    from Python with ctypes (see native_eval.py).
+    '''
+    f.write('\n')
+    f.write('extern "C" void eval_batch(const double* xyz, size_t n, double* out) {\n')
+    f.write('for (size_t i = 0; i < n; ++i) {\n')
+    f.write('const double* p = xyz + 3*i;\n')
+    f.write('out[i] = eval(p[0], p[1], p[2]);\n')
+    f.write('}\n')
+    f.write('}\n')
+
+
+def write_eval_grad_batch(f):
+    '''
+    Write a function evaluating eval_grad() at n points stored contiguously
+    (see write_eval_batch()): the value at point i is written in out[i] and
+    its gradient in gradient[3*i], gradient[3*i+1], gradient[3*i+2].
+    '''
+    f.write('\n')
+    f.write('extern "C" void eval_grad_batch(const double* xyz, size_t n, double* out, '
+            'double* gradient) {\n')
+    f.write('for (size_t i = 0; i < n; ++i) {\n')
+    f.write('const double* p = xyz + 3*i;\n')
+    f.write('out[i] = eval_grad(p[0], p[1], p[2], gradient + 3*i);\n')
+    f.write('}\n')
+    f.write('}\n')
+
+
+def main(fit_filename, exp_filename, cpp_filename, optimize=False,
+         simplified=False, batch=False, index=0, gradient=False,
+         metrics=instrumentation.DISABLED):
+    # the .fit file is read once, also in batch mode
+    with metrics.stage('read_fit'):
+        prim_list = read_fit(fit_filename)
+        binary_population.check_fit(exp_filename, fit_filename)
+    with metrics.stage('read_expressions'):
+        if batch:
+            expressions = read_expressions(exp_filename)
+        else:
+            expressions = [read_expression(exp_filename, index)]
+    if simplified:
+        with metrics.stage('simplify'):
+            report = simplify.SimplificationReport()
+            for expression in expressions:
+                tree = random_tree.tree_from_string(expression)
+                report.add(tree, simplify.simplify(tree))
+        print(report.to_string())
+    with metrics.stage('codegen'):
+        if batch:
+            create_population_cpp(prim_list, expressions, cpp_filename, optimize,
+                                  simplified, gradient)
+        else:
+            create_eval_cpp(prim_list, expressions[0], cpp_filename, optimize,
+                            simplified, gradient)
+
+    metrics.set('trees', len(expressions))
+    if metrics.stage_seconds('codegen') > 0:
+        metrics.set('trees_per_second', len(expressions) / metrics.stage_seconds('codegen'))
+    if metrics.enabled:
+        for expression in expressions:
+            metrics.add_tree(random_tree.tree_from_string(expression))
+    metrics.finish()
 
 
 if __name__ == '__main__':
-    num_args = len(sys.argv)
-    if num_args != 4:
-        usage(sys.argv[0])
-        sys.exit(1)
-
-    fit_filename = sys.argv[1]
-    exp_filename = sys.argv[2]
-    cpp_filename = sys.argv[3]
-    main(fit_filename, exp_filename, cpp_filename)
+    parser = argparse.ArgumentParser()
+
+    # necessary
+    parser.add_argument(
+        "fit_in", help="a file containing a list of fitted primitives")
+    parser.add_argument(
+        "expression_in",
+        help="a file containing an expression for the object (one expression "
+        "per line, or a binary population file)")
+    parser.add_argument(
+        "cpp_out",
+        help="the generated c++ file corresponding to the expression")
+
+    # optional
+    parser.add_argument(
+        "--optimize", action="store_true",
+        help="only emit the primitives used by the expression, with "
+        "precomputed parameters")
+    parser.add_argument(
+        "--simplify", action="store_true",
+        help="simplify the expression and compute shared subtrees once")
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="generate one function per expression of expression_in "
+        "(instead of the first one only) in a single file")
+    parser.add_argument(
+        "--index", type=int, default=0,
+        help="index of the expression of expression_in to use (without "
+        "--batch); Default: 0 (the first one)")
+    parser.add_argument(
+        "--gradient", action="store_true",
+        help="also generate eval_grad(x,y,z,gradient), returning the value and "
+        "writing the analytic gradient of the expression (eval_tree_grad() with "
+        "--batch)")
+    instrumentation.add_arguments(parser, 'codegen')
+
+    args = parser.parse_args()
+
+    main(args.fit_in, args.expression_in, args.cpp_out, optimize=args.optimize,
+         simplified=args.simplify, batch=args.batch, index=args.index,
+         gradient=args.gradient, metrics=instrumentation.create_metrics('create_eval_source.py', args.metrics,
+                                                args.profile, 'codegen'))
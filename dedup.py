@@ -0,0 +1,187 @@
+# Removal of the duplicate trees during the generation of a population.
+#
+# Each tree is identified by its structural hash (see
+# random_tree.compute_structural_hash()), which is the same for trees that
+# are identical up to the order of the children of union and intersection.
+# The hashes of the trees already kept are stored either in a compact hash set
+# (exact, 16 bytes per tree) or in a Bloom filter (fixed memory, but a few
+# distinct trees are wrongly taken for duplicates). Rejected trees are
+# replaced by the next trees of the deterministic stream of random_tree.py,
+# such that the population only depends on the seed.
+
+
+import math
+from array import array
+
+
+# default memory budget (in bytes) of the hash set or Bloom filter
+MAX_MEMORY = 256 * 1024 * 1024
+
+# deduplication modes
+MODES = ('exact', 'bloom')
+
+# initial number of slots of CompactHashSet
+INITIAL_CAPACITY = 1024
+
+# number of bits set for each tree in a BloomFilter
+NUM_HASHES = 7
+
+# the generation stops if this many consecutive blocks contain no new tree
+MAX_BARREN_BLOCKS = 16
+
+
+class CompactHashSet(object):
+    '''
+    Set of 64 bits keys (the beginning of the structural hashes) in an
+    array, with open addressing and linear probing. The array is at most half
+    full; it is doubled when needed, as long as it fits in the memory budget.
+    '''
+    def __init__(self, max_memory=MAX_MEMORY):
+        self.max_memory = max_memory
+        self.capacity = INITIAL_CAPACITY
+        # 0 marks an empty slot
+        self.keys = array('Q', bytes(8 * self.capacity))
+        self.size = 0
+
+    def _insert(self, key):
+        mask = self.capacity - 1
+        i = key & mask
+        while self.keys[i] != 0:
+            if self.keys[i] == key:
+                return False
+            i = (i + 1) & mask
+        self.keys[i] = key
+        return True
+
+    def _grow(self):
+        if 16 * self.capacity > self.max_memory:
+            raise Exception('The hash set of the deduplication exceeds its memory '
+                            'budget (use a larger budget or the bloom mode)')
+        old_keys = self.keys
+        self.capacity = 2 * self.capacity
+        self.keys = array('Q', bytes(8 * self.capacity))
+        for key in old_keys:
+            if key != 0:
+                self._insert(key)
+
+    def add(self, digest):
+        '''
+        Add a structural hash. Return True if it was not in the set.
+        '''
+        key = int.from_bytes(digest[0:8], 'little') or 1
+        if not self._insert(key):
+            return False
+        self.size = self.size + 1
+        if 2 * self.size > self.capacity:
+            self._grow()
+        return True
+
+    def memory(self):
+        return 8 * self.capacity
+
+
+class BloomFilter(object):
+    '''
+    Bloom filter of structural hashes using all the memory budget. A hash
+    that was never added is wrongly found with the probability returned by
+    false_positive_rate().
+    '''
+    def __init__(self, max_memory=MAX_MEMORY, num_hashes=NUM_HASHES):
+        self.num_bits = 8 * max(1, max_memory)
+        self.num_hashes = num_hashes
+        self.bits = bytearray(self.num_bits // 8)
+        self.size = 0
+
+    def add(self, digest):
+        '''
+        Add a structural hash. Return True if it was not found (it is then
+        certainly new).
+        '''
+        # double hashing with the two halves of the digest
+        h1 = int.from_bytes(digest[0:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        new = False
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.num_bits
+            mask = 1 << (bit & 7)
+            if not self.bits[bit >> 3] & mask:
+                new = True
+                self.bits[bit >> 3] |= mask
+        if new:
+            self.size = self.size + 1
+        return new
+
+    def false_positive_rate(self):
+        k = self.num_hashes
+        return (1.0 - math.exp(-float(k) * self.size / self.num_bits)) ** k
+
+    def memory(self):
+        return len(self.bits)
+
+
+class Deduplicator(object):
+    '''
+    Filter of the blocks of trees generated by random_tree.generate_blocks().
+    Member variables:
+        accepted: number of trees kept
+        rejected: number of trees rejected as duplicates
+    '''
+    def __init__(self, mode='exact', max_memory=MAX_MEMORY):
+        if mode == 'exact':
+            self.seen = CompactHashSet(max_memory)
+        elif mode == 'bloom':
+            self.seen = BloomFilter(max_memory)
+        else:
+            raise Exception('Unknown deduplication mode: ' + mode)
+        self.mode = mode
+        self.accepted = 0
+        self.rejected = 0
+
+    def filter_blocks(self, blocks, popsize):
+        '''
+        Yield the blocks of generate_blocks() (created with unbounded=True)
+        with only the trees not seen before, until popsize trees are kept.
+        '''
+        barren_blocks = 0
+        try:
+            for expressions, report, sizes, hashes, depths in blocks:
+                kept_expressions = []
+                kept_sizes = []
+                kept_hashes = []
+                kept_depths = []
+                for i in range(len(expressions)):
+                    if self.accepted + len(kept_expressions) >= popsize:
+                        break
+                    if self.seen.add(hashes[i]):
+                        kept_expressions.append(expressions[i])
+                        kept_sizes.append(sizes[i])
+                        kept_hashes.append(hashes[i])
+                        # the depths are only computed when requested
+                        if depths:
+                            kept_depths.append(depths[i])
+                    else:
+                        self.rejected = self.rejected + 1
+                self.accepted = self.accepted + len(kept_expressions)
+
+                if kept_expressions or self.accepted >= popsize:
+                    barren_blocks = 0
+                else:
+                    barren_blocks = barren_blocks + 1
+                    if barren_blocks >= MAX_BARREN_BLOCKS:
+                        raise Exception('No new tree in %d blocks: cannot generate %d '
+                                        'distinct trees' % (barren_blocks, popsize))
+
+                yield kept_expressions, report, kept_sizes, kept_hashes, kept_depths
+                if self.accepted >= popsize:
+                    return
+        finally:
+            blocks.close()
+
+    def to_string(self):
+        result = ('Deduplication (%s): %d distinct trees kept, %d duplicates rejected, '
+                  '%.1f MB' % (self.mode, self.accepted, self.rejected,
+                               self.seen.memory() / 1e6))
+        if self.mode == 'bloom':
+            result = result + (', false positive rate %.2g%%' % (
+                100.0 * self.seen.false_positive_rate()))
+        return result
@@ -0,0 +1,621 @@
+# Evaluate an expression (tree) over a batch of points with NumPy.
+#
+# The primitives and operations below are vectorized versions of the ones in
+# primitives.cpp and operations.cpp. They perform the same floating point
+# operations in the same order, such that in double precision the values are
+# identical to the ones returned by the generated C++ eval() function.
+#
+# The gradient variants return the value and the analytic gradient at the
+# points as an array of shape (4, number of points): value, d/dx, d/dy, d/dz
+# (the same as the generated C++ eval_grad() function).
+
+
+import sys
+
+import numpy as np
+
+import random_tree
+import simplify
+import create_eval_source
+
+
+# default memory budget (in bytes) for the temporary arrays used while
+# evaluating a chunk of points
+MAX_MEMORY = 256 * 1024 * 1024
+
+# rough upper bound on the number of temporary arrays (of the size of a chunk)
+# alive while evaluating a primitive
+PRIMITIVE_TEMPORARIES = 12
+
+
+#------------------------------------------------------------------------------
+# Primitives (see primitives.cpp).
+# x, y, z are arrays of coordinates; parameters is the tuple returned by
+# prepare_parameters() for the corresponding primitive type.
+
+
+def _dot(a0, a1, a2, b0, b1, b2):
+    # same as compute_dot_product()
+    return a0*b0 + a1*b1 + a2*b2
+
+
+def primitive_plane(x, y, z, parameters):
+    nx, ny, nz, dist = parameters
+    d = _dot(nx, ny, nz, x, y, z) - dist
+    return -d
+
+
+def primitive_sphere(x, y, z, parameters):
+    cx, cy, cz, radius = parameters
+    X = cx - x
+    Y = cy - y
+    Z = cz - z
+    d = np.sqrt(X*X + Y*Y + Z*Z) - radius
+    return -d
+
+
+def primitive_cylinder(x, y, z, parameters):
+    ax, ay, az, px, py, pz, radius = parameters
+    diff0 = x - px
+    diff1 = y - py
+    diff2 = z - pz
+    lamb = _dot(ax, ay, az, diff0, diff1, diff2)
+    v0 = diff0 - lamb*ax
+    v1 = diff1 - lamb*ay
+    v2 = diff2 - lamb*az
+    axis_dist = np.sqrt(_dot(v0, v1, v2, v0, v1, v2))
+    d = axis_dist - radius
+    return -d
+
+
+def primitive_torus(x, y, z, parameters):
+    nx, ny, nz, cx, cy, cz, rminor, rmajor = parameters
+    s0 = x - cx
+    s1 = y - cy
+    s2 = z - cz
+    spin1 = _dot(nx, ny, nz, s0, s1, s2)
+    v0 = s0 - spin1*nx
+    v1 = s1 - spin1*ny
+    v2 = s2 - spin1*nz
+    spin0 = np.sqrt(_dot(v0, v1, v2, v0, v1, v2)) - rmajor
+    d = np.sqrt(spin0*spin0 + spin1*spin1) - rminor
+    return -d
+
+
+def primitive_cone(x, y, z, parameters):
+    # cos(angle) and -sin(angle) are precomputed by prepare_parameters()
+    ax, ay, az, cx, cy, cz, cos_angle, msin_angle = parameters
+    s0 = x - cx
+    s1 = y - cy
+    s2 = z - cz
+    g = _dot(s0, s1, s2, ax, ay, az)
+    slen = np.sqrt(_dot(s0, s1, s2, s0, s1, s2))
+    sqrs = slen*slen
+    f = sqrs - g*g
+    # std::max(f, 0.0)
+    f = np.where(f < 0.0, 0.0, f).astype(f.dtype, copy=False)
+    f = np.sqrt(f)
+    da = cos_angle * f
+    db = msin_angle * g
+    d = np.where((g < 0.0) & ((da-db) < 0.0), np.sqrt(sqrs), da + db)
+    return -d
+
+
+def primitive_ellipsoid(x, y, z, parameters):
+    # the inverse rotation matrix is precomputed by prepare_parameters()
+    cx, cy, cz, rx, ry, rz = parameters[0:6]
+    m = parameters[6:15]
+    xi = x - cx
+    yi = y - cy
+    zi = z - cz
+    pt0 = m[0]*xi + m[1]*yi + m[2]*zi
+    pt1 = m[3]*xi + m[4]*yi + m[5]*zi
+    pt2 = m[6]*xi + m[7]*yi + m[8]*zi
+    q0 = pt0/rx
+    q1 = pt1/ry
+    q2 = pt2/rz
+    return q0*q0 + q1*q1 + q2*q2 - 1.0
+
+
+PRIMITIVE_FUNCTIONS = {
+    'plane': primitive_plane,
+    'sphere': primitive_sphere,
+    'cylinder': primitive_cylinder,
+    'torus': primitive_torus,
+    'cone': primitive_cone,
+    'ellipsoid': primitive_ellipsoid,
+}
+
+
+#------------------------------------------------------------------------------
+# Gradients of the primitives (see the *_gradient() functions of
+# primitives.cpp). Where the gradient is not defined (e.g. at the center of a
+# sphere), it is 0.
+
+
+def _value_gradient(value, g0, g1, g2):
+    result = np.empty((4,) + value.shape, dtype=value.dtype)
+    result[0] = value
+    result[1] = g0
+    result[2] = g1
+    result[3] = g2
+    return result
+
+
+def _quotient(a, b):
+    # a/b, or 0 where b == 0 (same as quotient() in primitives.cpp)
+    a, b = np.broadcast_arrays(a, b)
+    return np.divide(a, b, out=np.zeros(a.shape, dtype=a.dtype), where=(b != 0.0))
+
+
+def primitive_plane_gradient(x, y, z, parameters):
+    nx, ny, nz, dist = parameters
+    return _value_gradient(primitive_plane(x, y, z, parameters), -nx, -ny, -nz)
+
+
+def primitive_sphere_gradient(x, y, z, parameters):
+    cx, cy, cz, radius = parameters
+    X = cx - x
+    Y = cy - y
+    Z = cz - z
+    length = np.sqrt(X*X + Y*Y + Z*Z)
+    d = length - radius
+    return _value_gradient(-d, _quotient(X, length), _quotient(Y, length),
+                           _quotient(Z, length))
+
+
+def primitive_cylinder_gradient(x, y, z, parameters):
+    ax, ay, az, px, py, pz, radius = parameters
+    diff0 = x - px
+    diff1 = y - py
+    diff2 = z - pz
+    lamb = _dot(ax, ay, az, diff0, diff1, diff2)
+    v0 = diff0 - lamb*ax
+    v1 = diff1 - lamb*ay
+    v2 = diff2 - lamb*az
+    axis_dist = np.sqrt(_dot(v0, v1, v2, v0, v1, v2))
+    d = axis_dist - radius
+    # gradient of axis_dist: (v - (a.v) a) / axis_dist
+    av = _dot(ax, ay, az, v0, v1, v2)
+    return _value_gradient(-d, -_quotient(v0 - av*ax, axis_dist),
+                           -_quotient(v1 - av*ay, axis_dist),
+                           -_quotient(v2 - av*az, axis_dist))
+
+
+def primitive_torus_gradient(x, y, z, parameters):
+    nx, ny, nz, cx, cy, cz, rminor, rmajor = parameters
+    s0 = x - cx
+    s1 = y - cy
+    s2 = z - cz
+    spin1 = _dot(nx, ny, nz, s0, s1, s2)
+    v0 = s0 - spin1*nx
+    v1 = s1 - spin1*ny
+    v2 = s2 - spin1*nz
+    spin0norm = np.sqrt(_dot(v0, v1, v2, v0, v1, v2))
+    spin0 = spin0norm - rmajor
+    length = np.sqrt(spin0*spin0 + spin1*spin1)
+    d = length - rminor
+    # gradient of d: (spin0 grad(spin0norm) + spin1 n) / length
+    nv = _dot(nx, ny, nz, v0, v1, v2)
+    gradient = []
+    for v, n in ((v0, nx), (v1, ny), (v2, nz)):
+        u = _quotient(v - nv*n, spin0norm)
+        gradient.append(-_quotient(spin0*u + spin1*n, length))
+    return _value_gradient(-d, *gradient)
+
+
+def primitive_cone_gradient(x, y, z, parameters):
+    ax, ay, az, cx, cy, cz, cos_angle, msin_angle = parameters
+    s0 = x - cx
+    s1 = y - cy
+    s2 = z - cz
+    g = _dot(s0, s1, s2, ax, ay, az)
+    slen = np.sqrt(_dot(s0, s1, s2, s0, s1, s2))
+    sqrs = slen*slen
+    f = sqrs - g*g
+    f = np.where(f < 0.0, 0.0, f).astype(f.dtype, copy=False)
+    f = np.sqrt(f)
+    da = cos_angle * f
+    db = msin_angle * g
+    # distance to the apex
+    apex = (g < 0.0) & ((da-db) < 0.0)
+    d = np.where(apex, np.sqrt(sqrs), da + db)
+    gradient = []
+    for s, a in ((s0, ax), (s1, ay), (s2, az)):
+        # gradient of f: (s - g a) / f
+        df = _quotient(s - g*a, f)
+        gradient.append(np.where(apex, -_quotient(s, slen), -(cos_angle*df + msin_angle*a)))
+    return _value_gradient(-d, *gradient)
+
+
+def primitive_ellipsoid_gradient(x, y, z, parameters):
+    cx, cy, cz, rx, ry, rz = parameters[0:6]
+    m = parameters[6:15]
+    xi = x - cx
+    yi = y - cy
+    zi = z - cz
+    pt0 = m[0]*xi + m[1]*yi + m[2]*zi
+    pt1 = m[3]*xi + m[4]*yi + m[5]*zi
+    pt2 = m[6]*xi + m[7]*yi + m[8]*zi
+    q0 = pt0/rx
+    q1 = pt1/ry
+    q2 = pt2/rz
+    # gradient: 2 M^T (pt / r^2)
+    k0 = q0/rx
+    k1 = q1/ry
+    k2 = q2/rz
+    return _value_gradient(q0*q0 + q1*q1 + q2*q2 - 1.0,
+                           2.0*(k0*m[0] + k1*m[3] + k2*m[6]),
+                           2.0*(k0*m[1] + k1*m[4] + k2*m[7]),
+                           2.0*(k0*m[2] + k1*m[5] + k2*m[8]))
+
+
+PRIMITIVE_GRADIENT_FUNCTIONS = {
+    'plane': primitive_plane_gradient,
+    'sphere': primitive_sphere_gradient,
+    'cylinder': primitive_cylinder_gradient,
+    'torus': primitive_torus_gradient,
+    'cone': primitive_cone_gradient,
+    'ellipsoid': primitive_ellipsoid_gradient,
+}
+
+
+def prepare_parameters(prim_type, parameters, dtype=np.float64):
+    '''
+    Convert the parameters of a primitive (as read from the .fit file) to the
+    tuple expected by the corresponding primitive function. Values that do not
+    depend on the point (trigonometric functions of the angles) are computed
+    once here, as in the code generated by create_eval_source --optimize.
+    '''
+    parameters = create_eval_source.precompute_parameters(prim_type, parameters)
+    return tuple(dtype(p) for p in parameters)
+
+
+#------------------------------------------------------------------------------
+# Operations (see operations.cpp).
+
+
+def set_union(f, g):
+    # std::max(f, g)
+    return np.where(f < g, g, f)
+
+
+def set_intersection(f, g):
+    # std::min(f, g)
+    return np.where(g < f, g, f)
+
+
+def set_subtraction(f, g):
+    return set_intersection(f, -g)
+
+
+def set_negation(f):
+    return -f
+
+
+OPERATION_FUNCTIONS = {
+    'union': set_union,
+    'intersection': set_intersection,
+    'subtraction': set_subtraction,
+    'negation': set_negation,
+}
+
+
+# The same operations on the arrays of values and gradients of the gradient
+# functions: the gradient is the one of the operand selected by the operation.
+
+
+def set_union_gradient(f, g):
+    return np.where(f[0] < g[0], g, f)
+
+
+def set_intersection_gradient(f, g):
+    return np.where(g[0] < f[0], g, f)
+
+
+def set_subtraction_gradient(f, g):
+    return set_intersection_gradient(f, -g)
+
+
+def set_negation_gradient(f):
+    return -f
+
+
+OPERATION_GRADIENT_FUNCTIONS = {
+    'union': set_union_gradient,
+    'intersection': set_intersection_gradient,
+    'subtraction': set_subtraction_gradient,
+    'negation': set_negation_gradient,
+}
+
+
+#------------------------------------------------------------------------------
+
+
+def create_primitive_table(prim_list, dtype=np.float64):
+    '''
+    Map each primitive name to its type and prepared parameters.
+    Args:
+        prim_list: list of primitives as returned by create_eval_source.read_fit
+    '''
+    table = {}
+    for prim in prim_list:
+        name = prim[0]
+        prim_type = prim[1]
+        table[name] = (prim_type, prepare_parameters(prim_type, prim[2:], dtype))
+    return table
+
+
+def evaluate_primitive(prim_type, parameters, x, y, z):
+    if prim_type not in PRIMITIVE_FUNCTIONS:
+        raise Exception('Unknown primitive: ' + prim_type)
+    return PRIMITIVE_FUNCTIONS[prim_type](x, y, z, parameters)
+
+
+def evaluate_primitive_gradient(prim_type, parameters, x, y, z):
+    if prim_type not in PRIMITIVE_GRADIENT_FUNCTIONS:
+        raise Exception('Unknown primitive: ' + prim_type)
+    return PRIMITIVE_GRADIENT_FUNCTIONS[prim_type](x, y, z, parameters)
+
+
+def evaluate_tree(tree, table, x, y, z, shared=None, memo=None,
+                  primitive_values=None, gradient=False):
+    '''
+    Evaluate a tree (node and terminalnode objects) at the points with
+    coordinates x, y, z.
+    Args:
+        shared: optional set of ids of subtrees with several parents (see
+        simplify.shared_subtrees()); their value is computed once and kept
+        in memo
+        primitive_values: optional function returning the values of a
+        primitive (given by its name) at the points, e.g. read from a
+        primitive_cache.PrimitiveCache, instead of computing them
+        gradient: if True, return the values and the gradients (see the top
+        of the file) instead of the values; primitive_values must then return
+        them too
+    '''
+    if memo is None:
+        memo = {}
+    primitive_function = evaluate_primitive
+    operation_functions = OPERATION_FUNCTIONS
+    if gradient:
+        primitive_function = evaluate_primitive_gradient
+        operation_functions = OPERATION_GRADIENT_FUNCTIONS
+
+    # post-order traversal with an explicit stack of (node, visited) pairs;
+    # values contains the values of the subtrees already evaluated whose
+    # parent is not evaluated yet
+    values = []
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        key = id(current)
+        if key in memo:
+            values.append(memo[key])
+            continue
+
+        if len(current.children) == 0:
+            if primitive_values is not None:
+                # copied: the cached values can be overwritten by the next
+                # primitives
+                value = np.array(primitive_values(current.name), dtype=x.dtype)
+            else:
+                if current.name not in table:
+                    raise Exception('Unknown primitive: ' + current.name)
+                prim_type, parameters = table[current.name]
+                value = primitive_function(prim_type, parameters, x, y, z)
+        elif visited:
+            num_children = len(current.children)
+            arguments = values[-num_children:]
+            del values[-num_children:]
+            value = operation_functions[current.name](*arguments)
+        else:
+            stack.append((current, True))
+            for c in reversed(current.children):
+                stack.append((c, False))
+            continue
+
+        if shared is not None and key in shared:
+            memo[key] = value
+        values.append(value)
+
+    return values[0]
+
+
+def compute_depth(tree):
+    '''
+    Depth of a tree, computed without recursion (shared subtrees are visited
+    once).
+    '''
+    depths = {}
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        if id(current) in depths:
+            continue
+        if len(current.children) == 0:
+            depths[id(current)] = 1
+        elif visited:
+            depths[id(current)] = 1 + max(depths[id(c)] for c in current.children)
+        else:
+            stack.append((current, True))
+            for c in current.children:
+                stack.append((c, False))
+    return depths[id(tree)]
+
+
+def primitive_names(tree):
+    '''
+    Set of the names of the primitives used by a tree.
+    '''
+    names = set()
+    visited = set()
+    stack = [tree]
+    while stack:
+        current = stack.pop()
+        if id(current) in visited:
+            continue
+        visited.add(id(current))
+        if len(current.children) == 0:
+            names.add(current.name)
+        else:
+            stack.extend(current.children)
+    return names
+
+
+def compute_chunk_size(num_arrays, itemsize, max_memory=MAX_MEMORY):
+    '''
+    Number of points evaluated at once such that num_arrays temporary arrays
+    (in addition to the coordinates and the primitive temporaries) stay
+    within max_memory bytes.
+    '''
+    arrays_per_point = 3 + num_arrays + PRIMITIVE_TEMPORARIES
+    return max(1, max_memory // (arrays_per_point * itemsize))
+
+
+def split_coordinates(chunk):
+    '''
+    Return contiguous arrays x, y, z from an (N,3) array.
+    '''
+    x = np.ascontiguousarray(chunk[:, 0])
+    y = np.ascontiguousarray(chunk[:, 1])
+    z = np.ascontiguousarray(chunk[:, 2])
+    return x, y, z
+
+
+def check_points(points):
+    points = np.asarray(points)
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise Exception('Expected an array of points of shape (N,3)')
+    return points
+
+
+def evaluate_points(tree, table, points, dtype=np.float64, max_memory=MAX_MEMORY,
+                    cache=None):
+    '''
+    Evaluate a tree at each point of an (N,3) array. Points are processed in
+    chunks so that memory usage stays bounded for large point clouds.
+    Args:
+        tree: a tree made of node and terminalnode objects
+        table: primitive table returned by create_primitive_table()
+        points: array of shape (N,3)
+        dtype: np.float64 (identical to the C++ code) or np.float32
+        max_memory: memory budget in bytes for the temporary arrays
+        cache: optional primitive_cache.PrimitiveCache of the same points,
+        from which the values of the primitives are read
+    '''
+    points = check_points(points)
+    num_points = points.shape[0]
+    result = np.empty(num_points, dtype=dtype)
+    shared = simplify.shared_subtrees(tree)
+    # one pending value per level of the tree and the shared values
+    chunk_size = compute_chunk_size(
+        compute_depth(tree) + len(shared), np.dtype(dtype).itemsize, max_memory)
+    if cache is not None and not cache.holds(primitive_names(tree)):
+        cache = None
+
+    for start in range(0, num_points, chunk_size):
+        chunk = np.asarray(points[start:start+chunk_size], dtype=dtype)
+        x, y, z = split_coordinates(chunk)
+        primitive_values = None
+        if cache is not None:
+            primitive_values = cached_values(cache, start, start+chunk_size)
+        result[start:start+chunk_size] = evaluate_tree(tree, table, x, y, z, shared,
+                                                       primitive_values=primitive_values)
+
+    return result
+
+
+def evaluate_points_gradient(tree, table, points, dtype=np.float64,
+                             max_memory=MAX_MEMORY):
+    '''
+    Same as evaluate_points() with the analytic gradient: return the array
+    of the values, of shape (N,), and the array of the gradients, of shape
+    (N,3).
+    '''
+    points = check_points(points)
+    num_points = points.shape[0]
+    values = np.empty(num_points, dtype=dtype)
+    gradients = np.empty((num_points, 3), dtype=dtype)
+    shared = simplify.shared_subtrees(tree)
+    # each pending value comes with its gradient
+    chunk_size = compute_chunk_size(
+        4 * (compute_depth(tree) + len(shared)), np.dtype(dtype).itemsize, max_memory)
+
+    for start in range(0, num_points, chunk_size):
+        chunk = np.asarray(points[start:start+chunk_size], dtype=dtype)
+        x, y, z = split_coordinates(chunk)
+        result = evaluate_tree(tree, table, x, y, z, shared, gradient=True)
+        values[start:start+chunk_size] = result[0]
+        gradients[start:start+chunk_size] = result[1:4].T
+
+    return values, gradients
+
+
+def cached_values(cache, start, stop):
+    '''
+    Return a function reading the values of the primitives at
+    points[start:stop] from a PrimitiveCache.
+    '''
+    def primitive_values(name):
+        return cache.values(name, start, stop)
+    return primitive_values
+
+
+def evaluate_expression(expression, prim_list, points, dtype=np.float64,
+                        max_memory=MAX_MEMORY):
+    '''
+    Evaluate an expression (as saved by random_tree.save_population_to_file)
+    at each point of an (N,3) array.
+    Args:
+        expression: string representation of the tree
+        prim_list: list of primitives as returned by create_eval_source.read_fit
+        points: array of shape (N,3)
+        dtype: np.float64 (identical to the C++ code) or np.float32
+        max_memory: memory budget in bytes for the temporary arrays
+    '''
+    tree = random_tree.tree_from_string(expression)
+    table = create_primitive_table(prim_list, dtype)
+    return evaluate_points(tree, table, points, dtype, max_memory)
+
+
+def evaluate_expression_gradient(expression, prim_list, points, dtype=np.float64,
+                                 max_memory=MAX_MEMORY):
+    '''
+    Same as evaluate_expression() with the analytic gradient: return the
+    values (N,) and the gradients (N,3) of the expression at the points.
+    '''
+    tree = random_tree.tree_from_string(expression)
+    table = create_primitive_table(prim_list, dtype)
+    return evaluate_points_gradient(tree, table, points, dtype, max_memory)
+
+
+#------------------------------------------------------------------------------
+
+
+def main(fit_filename, exp_filename, points_filename, values_filename,
+         dtype=np.float64):
+    prim_list = create_eval_source.read_fit(fit_filename)
+    expression = create_eval_source.read_expression(exp_filename)
+    points = np.loadtxt(points_filename, ndmin=2)
+    values = evaluate_expression(expression, prim_list, points[:, 0:3], dtype)
+    np.savetxt(values_filename, values, fmt='%.17g')
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' model.fit model.txt points.txt values.txt')
+    print('Where:')
+    print('\t model.fit: a file containing a list of fitted primitives')
+    print('\t model.txt: a file containing an expression for the object')
+    print('\t points.txt: a file with one point (x y z) per line')
+    print('\t values.txt: the file where the values of the expression are saved')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 5:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
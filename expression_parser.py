@@ -0,0 +1,107 @@
+# Parser for the expressions written by random_tree.py, e.g.:
+#   union[sphere2,negation[subtraction[plane0,cone17]]]
+# Grammar:
+#   expression := primitive | operation '[' expression (',' expression)* ']'
+# The number of arguments of each operation is checked.
+#
+# The parser is iterative (no recursion), such that arbitrarily deep
+# expressions can be parsed. It returns the list of symbols in prefix order
+# (pre-order traversal of the tree); together with the number of arguments of
+# each operation (ARITY), this list describes the tree.
+
+
+import re
+
+
+UNARY_OPERATIONS = frozenset(['negation'])
+BINARY_OPERATIONS = frozenset(['union', 'intersection', 'subtraction'])
+OPERATIONS = UNARY_OPERATIONS | BINARY_OPERATIONS
+
+# number of arguments of each operation
+ARITY = {}
+for _name in UNARY_OPERATIONS:
+    ARITY[_name] = 1
+for _name in BINARY_OPERATIONS:
+    ARITY[_name] = 2
+
+_TOKEN = re.compile(r'[^\[\],\s]+|[\[\],]')
+
+
+def tokenize(expression):
+    '''
+    Return the list of tokens of an expression: symbols (names of operations
+    and primitives), '[', ']' and ','. White spaces are ignored.
+    '''
+    return _TOKEN.findall(expression)
+
+
+def parse_prefix(expression, primitives=None):
+    '''
+    Parse an expression and return the list of its symbols in prefix order.
+    Raise an Exception if the expression is not valid.
+    Args:
+        expression: string representation of a tree
+        primitives: optional set of the valid primitive names; if None, any
+        symbol which is not an operation is accepted as a primitive
+    '''
+    tokens = tokenize(expression)
+    num_tokens = len(tokens)
+    prefix = []
+    # operations whose closing bracket has not been read yet:
+    # [name, number of arguments read]
+    stack = []
+    i = 0
+    while True:
+        # an expression is expected at position i
+        if i >= num_tokens:
+            raise Exception('Incomplete expression')
+        symbol = tokens[i]
+        if symbol in ('[', ']', ','):
+            raise Exception("Unexpected '%s' at token %d" % (symbol, i))
+        if i+1 < num_tokens and tokens[i+1] == '[':
+            if symbol not in ARITY:
+                raise Exception('Unknown operation: ' + symbol)
+            prefix.append(symbol)
+            stack.append([symbol, 0])
+            i = i + 2
+            continue
+        if symbol in ARITY:
+            raise Exception('Missing arguments for ' + symbol)
+        if primitives is not None and symbol not in primitives:
+            raise Exception('Unknown primitive: ' + symbol)
+        prefix.append(symbol)
+        i = i + 1
+
+        # an expression has been read: close the operations that are complete
+        while stack:
+            operation = stack[-1]
+            operation[1] = operation[1] + 1
+            if i >= num_tokens:
+                raise Exception('Incomplete expression')
+            if tokens[i] == ',':
+                if operation[1] >= ARITY[operation[0]]:
+                    raise Exception('Too many arguments for ' + operation[0])
+                i = i + 1
+                break
+            if tokens[i] != ']':
+                raise Exception("Expected ',' or ']' at token %d" % i)
+            if operation[1] != ARITY[operation[0]]:
+                raise Exception('Missing arguments for ' + operation[0])
+            stack.pop()
+            i = i + 1
+        else:
+            # the root is complete
+            if i != num_tokens:
+                raise Exception('Unexpected symbol after the end of the expression')
+            return prefix
+
+
+def is_operation(symbol):
+    return symbol in ARITY
+
+
+def primitives_in(prefix):
+    '''
+    Return the set of primitive names in a list of symbols.
+    '''
+    return set(symbol for symbol in prefix if symbol not in ARITY)
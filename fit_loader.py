@@ -0,0 +1,289 @@
+# Load the .fit files (one fitted primitive per line: type followed by its
+# parameters) into a table shared by the scripts.
+#
+# The primitives are stored by type: the parameters of all the primitives of
+# a type are in one contiguous array of doubles, one row of
+# PRIMITIVE_ARITY[type] values per primitive. The number of parameters of
+# each primitive is checked against the functions of primitives.h.
+#
+# The table can be saved in a binary file next to the .fit file (the
+# "sidecar", <file>.fit.primtable) identified by the hash of the .fit file.
+# When it is up to date, it is memory-mapped instead of parsing the .fit
+# file again: the arrays are views of the mapped file (no copy), such that
+# processes loading the same .fit file share the same memory.
+#
+# Sidecar layout (little endian):
+#   magic (8 bytes), sha256 of the .fit file (32 bytes),
+#   number of primitives, number of primitives of each type (uint64 each),
+#   type code of each primitive (uint8), padded to a multiple of 8 bytes,
+#   row of each primitive in the table of its type (uint32), padded,
+#   parameters of each type in the order of PRIMITIVE_TYPES (float64)
+
+
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+import tempfile
+
+
+# the order of the types is part of the sidecar format: do not change it
+PRIMITIVE_TYPES = ['plane', 'sphere', 'cylinder', 'torus', 'cone', 'ellipsoid']
+
+# number of parameters of each primitive (see primitives.h)
+PRIMITIVE_ARITY = {
+    'plane': 4,
+    'sphere': 4,
+    'cylinder': 7,
+    'torus': 8,
+    'cone': 7,
+    'ellipsoid': 9,
+}
+
+TYPE_CODES = {}
+for _code in range(len(PRIMITIVE_TYPES)):
+    TYPE_CODES[PRIMITIVE_TYPES[_code]] = _code
+
+SIDECAR_SUFFIX = '.primtable'
+
+SIDECAR_MAGIC = b'CSGFIT01'
+
+_HEADER = struct.Struct('<8s32s%dQ' % (1 + len(PRIMITIVE_TYPES)))
+
+
+class PrimitiveTable(object):
+    '''
+    The primitives of a .fit file.
+    Member variables:
+        types: type code (index in PRIMITIVE_TYPES) of each primitive
+        rows: row of each primitive in the parameters of its type
+        parameters: list (indexed by type code) of arrays of doubles with
+        the parameters of the primitives of each type, row after row
+    The arrays are array.array objects or memoryviews of a sidecar file.
+    '''
+    def __init__(self, types, rows, parameters):
+        self.types = types
+        self.rows = rows
+        self.parameters = parameters
+
+    def __len__(self):
+        return len(self.types)
+
+    def type(self, i):
+        return PRIMITIVE_TYPES[self.types[i]]
+
+    def name(self, i):
+        '''
+        Name of primitive i, as used in the expressions (e.g. torus12).
+        '''
+        return self.type(i) + str(i)
+
+    def primitive_parameters(self, i):
+        '''
+        Return the list of parameters of primitive i.
+        '''
+        arity = PRIMITIVE_ARITY[self.type(i)]
+        start = self.rows[i] * arity
+        return self.parameters[self.types[i]][start:start+arity].tolist()
+
+    def count(self, prim_type):
+        '''
+        Number of primitives of a type.
+        '''
+        return len(self.parameters[TYPE_CODES[prim_type]]) // PRIMITIVE_ARITY[prim_type]
+
+    def to_list(self):
+        '''
+        Return the list of primitives as lists made of:
+        name, type, parameter1, parameter2, ...
+        (the format returned by create_eval_source.read_fit).
+        '''
+        rows = [parameters.tolist() for parameters in self.parameters]
+        list_primitives = []
+        for i in range(len(self.types)):
+            code = self.types[i]
+            prim_type = PRIMITIVE_TYPES[code]
+            arity = PRIMITIVE_ARITY[prim_type]
+            start = self.rows[i] * arity
+            list_primitives.append([prim_type + str(i), prim_type] + rows[code][start:start+arity])
+        return list_primitives
+
+
+def parse_fit(text, fit_filename='.fit file'):
+    '''
+    Parse the content of a .fit file and return a PrimitiveTable.
+    Raise an Exception for an unknown primitive type or a wrong number of
+    parameters.
+    '''
+    types = array.array('B')
+    rows = array.array('I')
+    counts = [0] * len(PRIMITIVE_TYPES)
+    # the parameters are collected as strings and converted at the end,
+    # one array per type
+    tokens = [[] for _ in PRIMITIVE_TYPES]
+    line_number = 0
+    for line in text.splitlines():
+        line_number = line_number + 1
+        elements = line.split()
+        if len(elements) == 0:
+            # empty line
+            continue
+        prim_type = elements[0].lower()
+        if prim_type not in TYPE_CODES:
+            raise Exception('Unknown primitive: %s (%s, line %d)' % (
+                elements[0], fit_filename, line_number))
+        arity = PRIMITIVE_ARITY[prim_type]
+        if len(elements) - 1 != arity:
+            raise Exception('%s expects %d parameters, got %d (%s, line %d)' % (
+                prim_type, arity, len(elements) - 1, fit_filename, line_number))
+        code = TYPE_CODES[prim_type]
+        types.append(code)
+        rows.append(counts[code])
+        counts[code] = counts[code] + 1
+        tokens[code].extend(elements[1:])
+
+    parameters = [array.array('d', map(float, t)) for t in tokens]
+    return PrimitiveTable(types, rows, parameters)
+
+
+def sidecar_filename(fit_filename):
+    return fit_filename + SIDECAR_SUFFIX
+
+
+def _padding(size):
+    return (-size) % 8
+
+
+def _file_mode():
+    '''
+    Permissions of a new file created by open() (0666 minus the umask).
+    '''
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def write_sidecar(table, filename, digest):
+    '''
+    Save a PrimitiveTable in a sidecar file. The file is replaced atomically,
+    such that concurrent processes never read a partial file. It gets the
+    permissions of a file created by open() (mkstemp creates it readable by
+    its owner only), such that other users of the .fit file can read it.
+    '''
+    counts = [table.count(prim_type) for prim_type in PRIMITIVE_TYPES]
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(SIDECAR_MAGIC, digest, len(table), *counts))
+            for values in (table.types, table.rows):
+                data = array.array(values.typecode, values).tobytes()
+                f.write(data)
+                f.write(b'\0' * _padding(len(data)))
+            for parameters in table.parameters:
+                f.write(array.array('d', parameters).tobytes())
+        os.chmod(temp_filename, _file_mode())
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def read_sidecar(filename, digest):
+    '''
+    Memory-map a sidecar file and return its PrimitiveTable, or None if the
+    file does not exist, cannot be read (e.g. written by another user without
+    read permission) or does not correspond to digest (the hash of the .fit
+    file).
+    '''
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError:
+        return None
+    header = _HEADER.unpack_from(mapped)
+    if header[0] != SIDECAR_MAGIC or header[1] != digest:
+        mapped.close()
+        return None
+    num_primitives = header[2]
+    counts = header[3:]
+    size = (_HEADER.size + num_primitives + _padding(num_primitives)
+            + 4*num_primitives + _padding(4*num_primitives))
+    for code in range(len(PRIMITIVE_TYPES)):
+        size = size + 8 * counts[code] * PRIMITIVE_ARITY[PRIMITIVE_TYPES[code]]
+    if size != len(mapped):
+        mapped.close()
+        return None
+
+    view = memoryview(mapped)
+    offset = _HEADER.size
+    types = view[offset:offset+num_primitives]
+    offset = offset + num_primitives + _padding(num_primitives)
+    rows = view[offset:offset+4*num_primitives].cast('I')
+    offset = offset + 4*num_primitives + _padding(4*num_primitives)
+    parameters = []
+    for code in range(len(PRIMITIVE_TYPES)):
+        size = 8 * counts[code] * PRIMITIVE_ARITY[PRIMITIVE_TYPES[code]]
+        parameters.append(view[offset:offset+size].cast('d'))
+        offset = offset + size
+    return PrimitiveTable(types, rows, parameters)
+
+
+def load_fit(fit_filename, use_sidecar=True):
+    '''
+    Load a .fit file and return a PrimitiveTable.
+    Args:
+        fit_filename: name of the .fit file with the primitives information
+        use_sidecar: if True, the table is read from the sidecar file when it
+        is up to date, and the sidecar is written otherwise (if possible)
+    '''
+    with open(fit_filename, 'rb') as f:
+        data = f.read()
+    # the sidecar stores native arrays: only used on little endian machines
+    use_sidecar = use_sidecar and sys.byteorder == 'little'
+
+    digest = hashlib.sha256(data).digest()
+    filename = sidecar_filename(fit_filename)
+    if use_sidecar:
+        table = read_sidecar(filename, digest)
+        if table is not None:
+            return table
+
+    table = parse_fit(data.decode('utf-8'), fit_filename)
+    if use_sidecar:
+        try:
+            write_sidecar(table, filename, digest)
+        except OSError:
+            # e.g. read-only directory: the sidecar is only a cache
+            pass
+    return table
+
+
+def main(fit_filename):
+    table = load_fit(fit_filename)
+    print('Number of primitives: %d' % len(table))
+    for prim_type in PRIMITIVE_TYPES:
+        print('%s: %d' % (prim_type, table.count(prim_type)))
+    print('Table saved in ' + sidecar_filename(fit_filename))
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' model.fit')
+    print('Where:')
+    print('\t model.fit: a file containing a list of fitted primitives')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 2:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1])
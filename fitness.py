@@ -0,0 +1,365 @@
+# Score the trees of a population against a point cloud sampled on the
+# surface of the object (optionally with the outward normals at the points).
+#
+# The error of a tree is the weighted sum of the mean over the points of:
+# - distance: |f(p)|, the value of the tree at the points (0 on the surface)
+# - classification: the fraction of misclassified offset points: p + e*n must
+#   be outside the object (f < 0) and p - e*n inside (f > 0), where n is the
+#   normal and e the offset (requires the normals)
+# - normals: 1 - cos of the angle between n and the normal of the tree,
+#   -grad(f)/|grad(f)| (requires the normals); the analytic gradient is
+#   evaluated with the values (see bytecode.run_program())
+# plus size_penalty times the number of nodes of the tree.
+#
+# The points are processed in chunks. Every term is non-negative, such that
+# the error accumulated over the first chunks (divided by the total number of
+# points) is a lower bound of the final error: with the option k, the
+# evaluation of a tree stops as soon as this lower bound exceeds the error of
+# the k-th best tree scored so far. The scores of the stopped trees are these
+# lower bounds.
+
+
+import heapq
+import argparse
+
+import numpy as np
+
+import evaluate
+import bytecode
+import expression_parser
+import create_eval_source
+import primitive_cache
+
+
+METRICS = ['distance', 'classification', 'normals']
+
+# metrics requiring the normals
+NORMAL_METRICS = ['classification', 'normals']
+
+DEFAULT_WEIGHTS = {'distance': 1.0, 'classification': 0.0, 'normals': 0.0}
+
+# number of points evaluated at once (also the granularity of the early
+# termination)
+CHUNK_SIZE = 8192
+
+# default offset along the normals (classification), relative to the
+# diagonal of the bounding box of the points
+OFFSET = 1e-2
+
+
+class FitnessResult(object):
+    '''
+    The result of evaluate_fitness().
+    Member variables:
+        scores: error of each tree (a lower bound for the stopped trees)
+        metrics: dictionary mapping each metric with a non-zero weight to the
+        array of its mean value for each tree (NaN for the stopped trees)
+        number_nodes: number of nodes of each tree
+        stopped: boolean array, True for the trees whose evaluation stopped
+        early
+    '''
+    def __init__(self, scores, metrics, number_nodes, stopped):
+        self.scores = scores
+        self.metrics = metrics
+        self.number_nodes = number_nodes
+        self.stopped = stopped
+
+    def best(self, k):
+        '''
+        Indices of the k best trees, best first.
+        '''
+        return np.argsort(self.scores, kind='stable')[0:k]
+
+
+def read_point_cloud(points_filename):
+    '''
+    Read a file with one point per line: x y z, or x y z nx ny nz with the
+    normal. Return (points, normals) where normals is None if the file has
+    no normals.
+    '''
+    data = np.loadtxt(points_filename, ndmin=2)
+    if data.shape[1] >= 6:
+        return data[:, 0:3], data[:, 3:6]
+    if data.shape[1] != 3:
+        raise Exception('Expected 3 or 6 values per point in ' + points_filename)
+    return data, None
+
+
+def normalize(vectors):
+    '''
+    Return the unit vectors of an (N,3) array and the mask of the non-zero
+    vectors (the zero vectors are left unchanged).
+    '''
+    norms = np.sqrt((vectors * vectors).sum(axis=1))
+    valid = norms > 0.0
+    result = vectors.copy()
+    result[valid] = vectors[valid] / norms[valid, None]
+    return result, valid
+
+
+def diagonal(points):
+    return float(np.linalg.norm(points.max(axis=0) - points.min(axis=0)))
+
+
+def point_sets(points, normals, offset, weights):
+    '''
+    Return a dictionary mapping names to the (N,3) arrays of points where the
+    trees are evaluated for the metrics with a non-zero weight.
+    '''
+    sets = {'points': points}
+    if weights['classification'] != 0.0:
+        sets['outside'] = points + offset * normals
+        sets['inside'] = points - offset * normals
+    return sets
+
+
+class _Chunk(object):
+    '''
+    The data of a chunk of points shared by the evaluation of all the trees.
+    '''
+    def __init__(self, sets, normals, start, stop, caches):
+        self.start = start
+        self.stop = stop
+        self.num_points = stop - start
+        self.coordinates = {}
+        for name in sets:
+            self.coordinates[name] = evaluate.split_coordinates(sets[name][start:stop])
+        if normals is not None:
+            self.normals = normals[start:stop]
+        self.caches = caches
+
+    def run(self, program, table, name, gradient=False):
+        '''
+        Run a program at the chunk of the point set name (see
+        bytecode.run_program()).
+        '''
+        x, y, z = self.coordinates[name]
+        primitive_values = None
+        if self.caches is not None and self.caches[name].holds(program.primitives):
+            primitive_values = evaluate.cached_values(self.caches[name], self.start,
+                                                      self.stop)
+        return bytecode.run_program(program, table, x, y, z,
+                                    primitive_values=primitive_values, gradient=gradient)
+
+
+def _chunk_errors(program, table, chunk, weights):
+    '''
+    Return a dictionary mapping each metric with a non-zero weight to its sum
+    over the points of a chunk.
+    '''
+    errors = {}
+    if weights['normals'] != 0.0:
+        # the values and the gradients are computed together
+        value_gradient = chunk.run(program, table, 'points', gradient=True)
+        f = value_gradient[0]
+    else:
+        f = chunk.run(program, table, 'points')
+    if weights['distance'] != 0.0:
+        errors['distance'] = float(np.abs(f).sum())
+    if weights['classification'] != 0.0:
+        f_outside = chunk.run(program, table, 'outside')
+        f_inside = chunk.run(program, table, 'inside')
+        misclassified = np.count_nonzero(f_outside >= 0.0) + np.count_nonzero(f_inside <= 0.0)
+        errors['classification'] = 0.5 * misclassified
+    if weights['normals'] != 0.0:
+        gradient = value_gradient[1:4].T
+        # the normal of the tree is -grad(f) (f is positive inside); no
+        # gradient counts as the worst error but one (orthogonal normal)
+        tree_normals, valid = normalize(-gradient)
+        cosine = np.where(valid, (tree_normals * chunk.normals).sum(axis=1), 0.0)
+        errors['normals'] = float((1.0 - cosine).sum())
+    return errors
+
+
+def evaluate_fitness(expressions, prim_list, points, normals=None, weights=None,
+                     size_penalty=0.0, k=None, offset=None, chunk_size=CHUNK_SIZE, simplified=False,
+                     cache_memory=primitive_cache.MAX_MEMORY, cache_dtype=np.float64):
+    '''
+    Compute the error of each expression on a point cloud.
+    Return a FitnessResult.
+    Args:
+        expressions: list of expressions (see bytecode.read_population())
+        prim_list: list of primitives as returned by create_eval_source.read_fit
+        points: array of shape (N,3)
+        normals: optional array of shape (N,3) with the outward normals
+        weights: dictionary mapping metrics (see METRICS) to their
+        non-negative weights; missing metrics have a weight of 0 (default:
+        DEFAULT_WEIGHTS)
+        size_penalty: error added per node of the tree
+        k: if not None, stop evaluating a tree as soon as its error is
+        larger than the one of the k-th best tree
+        offset: offset along the normals (default: OFFSET times the diagonal
+        of the bounding box of the points)
+        chunk_size: number of points evaluated at once
+        simplified: if True, the expressions are simplified before being
+        compiled (see simplify.py)
+        cache_memory: if not 0, the values of the primitives are computed
+        once for all the trees and kept in primitive_cache.PrimitiveCache
+        objects sharing this memory budget (with the gradients at the points,
+        for the normals metric)
+        cache_dtype: type of the values stored in the cache
+    '''
+    if weights is None:
+        weights = DEFAULT_WEIGHTS
+    weights = dict((metric, float(weights.get(metric, 0.0))) for metric in METRICS)
+    # the early stop needs a partial sum of the errors that is a lower bound
+    for metric in METRICS:
+        if weights[metric] < 0.0:
+            raise Exception('The weight of the metric ' + metric + ' must not be negative')
+    if k is not None and k < 1:
+        raise Exception('k must be at least 1')
+    points = evaluate.check_points(points).astype(np.float64)
+    num_points = points.shape[0]
+    if num_points == 0:
+        raise Exception('Empty point cloud')
+    for metric in NORMAL_METRICS:
+        if weights[metric] != 0.0 and normals is None:
+            raise Exception('The metric ' + metric + ' requires the normals')
+    if normals is not None:
+        normals = normalize(evaluate.check_points(normals).astype(np.float64))[0]
+    if offset is None:
+        offset = OFFSET * diagonal(points)
+
+    table = evaluate.create_primitive_table(prim_list)
+    sets = point_sets(points, normals, offset, weights)
+    caches = None
+    if cache_memory > 0:
+        caches = {}
+        for name in sets:
+            # the gradients are needed at the points for the normals metric
+            gradient = name == 'points' and weights['normals'] != 0.0
+            caches[name] = primitive_cache.PrimitiveCache(
+                table, sets[name], cache_memory // len(sets), cache_dtype, gradient)
+    chunks = []
+    for start in range(0, num_points, chunk_size):
+        stop = min(start + chunk_size, num_points)
+        chunks.append(_Chunk(sets, normals, start, stop, caches))
+
+    num_trees = len(expressions)
+    scores = np.zeros(num_trees)
+    stopped = np.zeros(num_trees, dtype=bool)
+    number_nodes = np.zeros(num_trees, dtype=np.int64)
+    metrics = {}
+    for metric in METRICS:
+        if weights[metric] != 0.0:
+            metrics[metric] = np.full(num_trees, np.nan)
+    # errors of the k best trees so far (negated: heapq is a min heap)
+    best = []
+
+    for t in range(num_trees):
+        number_nodes[t] = len(expression_parser.parse_prefix(expressions[t]))
+        program = bytecode.get_program(expressions[t], simplified)
+        threshold = np.inf
+        if k is not None and len(best) >= k:
+            threshold = -best[0]
+
+        sums = dict((metric, 0.0) for metric in metrics)
+        error = size_penalty * number_nodes[t]
+        for chunk in chunks:
+            errors = _chunk_errors(program, table, chunk, weights)
+            for metric in errors:
+                sums[metric] = sums[metric] + errors[metric]
+            # lower bound of the error of the tree
+            error = size_penalty * number_nodes[t] + sum(
+                weights[metric] * sums[metric] for metric in sums) / num_points
+            if error > threshold:
+                stopped[t] = True
+                break
+
+        scores[t] = error
+        if stopped[t]:
+            continue
+        for metric in metrics:
+            metrics[metric][t] = sums[metric] / num_points
+        if k is not None:
+            if len(best) < k:
+                heapq.heappush(best, -error)
+            elif error < -best[0]:
+                heapq.heapreplace(best, -error)
+
+    return FitnessResult(scores, metrics, number_nodes, stopped)
+
+
+def save_scores(filename, result):
+    '''
+    Save one line per tree: score, number of nodes, stopped (0 or 1) and the
+    value of each computed metric.
+    '''
+    names = [metric for metric in METRICS if metric in result.metrics]
+    with open(filename, 'w') as f:
+        f.write('# score nodes stopped %s\n' % ' '.join(names))
+        for t in range(len(result.scores)):
+            values = ['%.17g' % result.scores[t], '%d' % result.number_nodes[t],
+                      '%d' % result.stopped[t]]
+            values.extend('%.17g' % result.metrics[metric][t] for metric in names)
+            f.write(' '.join(values) + '\n')
+
+
+def main(fit_filename, population_filename, points_filename, scores_filename,
+         weights, size_penalty=0.0, k=None, simplified=False,
+         cache_memory=primitive_cache.MAX_MEMORY, cache_dtype=np.float64):
+    prim_list = create_eval_source.read_fit(fit_filename)
+    expressions = bytecode.read_population(population_filename)
+    points, normals = read_point_cloud(points_filename)
+    result = evaluate_fitness(expressions, prim_list, points, normals, weights,
+                              size_penalty, k, simplified=simplified,
+                              cache_memory=cache_memory, cache_dtype=cache_dtype)
+    save_scores(scores_filename, result)
+    print('Number of trees: %d (%d stopped early)' % (
+        len(expressions), np.count_nonzero(result.stopped)))
+    if len(expressions) > 0:
+        t = result.best(1)[0]
+        print('Best tree: %d (error %.17g)' % (t, result.scores[t]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # necessary
+    parser.add_argument(
+        "fit_in", help="a file containing a list of fitted primitives")
+    parser.add_argument(
+        "population_in", help="a file containing one expression per line")
+    parser.add_argument(
+        "points_in",
+        help="a file with one point per line: x y z or x y z nx ny nz")
+    parser.add_argument(
+        "scores_out", help="the file where the scores are saved (one line per tree)")
+
+    # optional
+    parser.add_argument(
+        "--distance", type=float, default=DEFAULT_WEIGHTS['distance'],
+        help="weight of the mean absolute value at the points")
+    parser.add_argument(
+        "--classification", type=float, default=DEFAULT_WEIGHTS['classification'],
+        help="weight of the inside/outside classification error")
+    parser.add_argument(
+        "--normals", type=float, default=DEFAULT_WEIGHTS['normals'],
+        help="weight of the normal error")
+    parser.add_argument(
+        "--size_penalty", type=float, default=0.0,
+        help="error added per node of the tree")
+    parser.add_argument(
+        "--k", type=int,
+        help="stop evaluating the trees worse than the k-th best one (at least 1)")
+    parser.add_argument(
+        "--simplify", action="store_true",
+        help="simplify the expressions before evaluating them")
+    parser.add_argument(
+        "--cache_memory", type=int, default=primitive_cache.MAX_MEMORY // (1024*1024),
+        help="memory (in MB) for the values of the primitives computed once for "
+        "all the trees (0 to disable the cache)")
+    parser.add_argument(
+        "--float32_cache", action="store_true",
+        help="store the values of the primitives in single precision")
+
+    args = parser.parse_args()
+
+    weights = {'distance': args.distance, 'classification': args.classification,
+               'normals': args.normals}
+    cache_dtype = np.float64
+    if args.float32_cache:
+        cache_dtype = np.float32
+    main(args.fit_in, args.population_in, args.points_in, args.scores_out,
+         weights, args.size_penalty, args.k, args.simplify,
+         args.cache_memory * 1024 * 1024, cache_dtype)
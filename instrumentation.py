@@ -0,0 +1,289 @@
+# Metrics of the runs of the scripts (--metrics and --profile options).
+#
+# A Metrics object records the wall time of the stages of a run (read_fit,
+# generation, serialization, parsing, codegen, ...), counters, histograms of
+# the number of nodes and of the depth of the trees, and the peak resident
+# memory. They are saved as JSON at the end of the run. One stage (the "hot"
+# stage of the script) can also be profiled with cProfile. When this stage
+# runs in worker processes, the workers profile their tasks (see
+# profile_call()) and their statistics are merged in the parent process.
+#
+# When the options are not given, the scripts use DISABLED, whose methods do
+# nothing: the scripts only time a few stages per run, and the per-tree work
+# (histograms) is guarded by metrics.enabled.
+
+
+import sys
+import json
+import time
+import pstats
+import cProfile
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: the peak memory is not reported
+    resource = None
+
+
+class _Stage(object):
+    '''
+    Timer of a stage, used as a context manager or with start() and stop().
+    The time of all the uses of a stage is accumulated.
+    '''
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start_time = None
+
+    def start(self):
+        if self.metrics.profiles(self.name) and not self.metrics.profile_workers:
+            self.metrics.profiler.enable()
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        elapsed = time.perf_counter() - self.start_time
+        if self.metrics.profiles(self.name) and not self.metrics.profile_workers:
+            self.metrics.profiler.disable()
+        stage = self.metrics.stages.setdefault(self.name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] = stage['seconds'] + elapsed
+        stage['calls'] = stage['calls'] + 1
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class Metrics(object):
+    '''
+    Metrics of a run of a script.
+    '''
+    enabled = True
+
+    def __init__(self, script, metrics_filename=None, profile_filename=None,
+                 hot_stage=None):
+        '''
+        Args:
+            script: name of the script
+            metrics_filename: JSON file written by finish(), or None
+            profile_filename: file where finish() writes the cProfile
+            statistics of hot_stage (readable with the pstats module), or None
+            hot_stage: name of the profiled stage
+        '''
+        self.script = script
+        self.metrics_filename = metrics_filename
+        self.profile_filename = profile_filename
+        self.hot_stage = hot_stage
+        self.profiler = None
+        if profile_filename is not None:
+            self.profiler = cProfile.Profile()
+        # True if the hot stage is profiled in worker processes
+        self.profile_workers = False
+        # merged pstats.Stats of the workers
+        self.worker_stats = None
+        self.start_time = time.perf_counter()
+        # stage name -> {'seconds': total time, 'calls': number of uses}
+        self.stages = {}
+        self.values = {}
+        # histogram name -> {value: count}
+        self.histograms = {}
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def stage_seconds(self, name):
+        if name not in self.stages:
+            return 0.0
+        return self.stages[name]['seconds']
+
+    def profiles(self, name):
+        '''
+        Return True if the stage name is profiled.
+        '''
+        return self.profiler is not None and name == self.hot_stage
+
+    def add_worker_profile(self, stats):
+        '''
+        Merge the statistics returned by profile_call() in a worker process.
+        Once called, the hot stage is not profiled in this process anymore
+        (it would only measure the wait for the workers).
+        '''
+        self.profile_workers = True
+        if self.worker_stats is None:
+            self.worker_stats = pstats.Stats(_ProfileStats(stats))
+        else:
+            self.worker_stats.add(_ProfileStats(stats))
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def add(self, name, value=1):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def add_to_histogram(self, name, value, count=1):
+        histogram = self.histograms.setdefault(name, {})
+        histogram[value] = histogram.get(value, 0) + count
+
+    def add_tree(self, tree):
+        '''
+        Add the number of nodes and the depth of a tree (node or terminalnode
+        object) to the histograms.
+        '''
+        self.add_to_histogram('number_nodes', tree.compute_number_nodes())
+        self.add_to_histogram('depth', tree.max_depth())
+
+    def to_dict(self):
+        data = {
+            'script': self.script,
+            'argv': sys.argv,
+            'total_seconds': time.perf_counter() - self.start_time,
+            'stages': self.stages,
+            'values': self.values,
+            'histograms': {},
+        }
+        for name in self.histograms:
+            histogram = self.histograms[name]
+            # JSON keys are strings: the values are written in order
+            data['histograms'][name] = dict(
+                (str(value), histogram[value]) for value in sorted(histogram))
+        peak_rss = peak_memory()
+        if peak_rss is not None:
+            data['peak_rss_bytes'], data['peak_rss_children_bytes'] = peak_rss
+        if self.profile_filename is not None:
+            data['profile'] = {'file': self.profile_filename, 'stage': self.hot_stage}
+        return data
+
+    def finish(self):
+        '''
+        Write the metrics and the profile.
+        '''
+        if self.worker_stats is not None:
+            self.worker_stats.dump_stats(self.profile_filename)
+        elif self.profiler is not None:
+            self.profiler.dump_stats(self.profile_filename)
+        if self.metrics_filename is not None:
+            with open(self.metrics_filename, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2)
+                f.write('\n')
+
+
+class _DisabledStage(object):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class DisabledMetrics(object):
+    '''
+    Metrics of a run without --metrics nor --profile: nothing is recorded.
+    '''
+    enabled = False
+
+    _stage = _DisabledStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def stage_seconds(self, name):
+        return 0.0
+
+    def profiles(self, name):
+        return False
+
+    def add_worker_profile(self, stats):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def add(self, name, value=1):
+        pass
+
+    def add_to_histogram(self, name, value, count=1):
+        pass
+
+    def add_tree(self, tree):
+        pass
+
+    def finish(self):
+        pass
+
+
+DISABLED = DisabledMetrics()
+
+
+class _ProfileStats(object):
+    '''
+    Statistics of profile_call() in the form read by pstats.Stats.
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profile_call(function, arguments):
+    '''
+    Call function(*arguments) with cProfile, e.g. in a worker process.
+    Return the result and the statistics (a dictionary that can be sent to
+    the parent process and passed to Metrics.add_worker_profile()).
+    '''
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = function(*arguments)
+    finally:
+        profiler.disable()
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+def create_metrics(script, metrics_filename=None, profile_filename=None, hot_stage=None):
+    '''
+    Return a Metrics object, or DISABLED if neither file is given.
+    '''
+    if metrics_filename is None and profile_filename is None:
+        return DISABLED
+    return Metrics(script, metrics_filename, profile_filename, hot_stage)
+
+
+def peak_memory():
+    '''
+    Return the peak resident memory in bytes (of this process, of its
+    terminated child processes), or None if it is not available.
+    '''
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def add_arguments(parser, hot_stage, profile_note=''):
+    '''
+    Add the --metrics and --profile options to an argparse parser.
+    Args:
+        profile_note: text appended to the help of --profile
+    '''
+    parser.add_argument(
+        "--metrics",
+        help="JSON file where the metrics of the run are saved (wall time of "
+        "each stage, peak memory, histograms of the number of nodes and depth "
+        "of the trees)")
+    parser.add_argument(
+        "--profile",
+        help="file where the cProfile statistics of the %s stage are saved "
+        "(read them with python -m pstats)%s" % (hot_stage, profile_note))
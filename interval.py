@@ -0,0 +1,419 @@
+# Interval arithmetic for the trees: bound the values of a tree over an
+# axis-aligned box without sampling it.
+#
+# An interval is a pair (lo, hi) of floats or of NumPy arrays (one value per
+# box, such that many boxes are bounded at once). The primitives and
+# operations below are interval versions of the ones in evaluate.py (and
+# primitives.cpp, operations.cpp): for every point of the box, the value
+# returned by eval() is in [lo, hi]. The bounds are conservative, not tight:
+# the interval of a primitive can be larger than its actual range over the
+# box. They are widened by a small margin (see ROUNDING_MARGIN) to account
+# for the rounding errors of the point evaluation in double precision.
+#
+# The operations map exactly to intervals:
+#   union = max, intersection = min, negation = -, subtraction(f,g) = min(f,-g)
+# When the interval of one child of a max/min is entirely above (or below)
+# the other one, the operation always returns the same child over the box and
+# the other child can be removed (see prune()).
+
+
+import sys
+
+import numpy as np
+
+import random_tree
+import simplify
+import evaluate
+import create_eval_source
+
+
+# relative margin added to the intervals of the primitives; it covers the
+# rounding errors of the evaluation in double precision (the square root of
+# the cone loses half of the significant digits when its argument is close
+# to 0)
+ROUNDING_MARGIN = 1e-7
+
+
+#------------------------------------------------------------------------------
+# Interval arithmetic.
+
+
+def interval_add(a, b):
+    return a[0] + b[0], a[1] + b[1]
+
+
+def interval_sub(a, b):
+    return a[0] - b[1], a[1] - b[0]
+
+
+def interval_neg(a):
+    return -a[1], -a[0]
+
+
+def interval_scale(c, a):
+    # c is a float
+    if c >= 0.0:
+        return c*a[0], c*a[1]
+    return c*a[1], c*a[0]
+
+
+def interval_square(a):
+    lo, hi = a
+    lo2 = lo*lo
+    hi2 = hi*hi
+    # 0 is the minimum when the interval contains 0
+    contains_zero = (lo < 0.0) & (hi > 0.0)
+    square_lo = np.where(contains_zero, 0.0, np.minimum(lo2, hi2))
+    return square_lo, np.maximum(lo2, hi2)
+
+
+def interval_sqrt(a):
+    return np.sqrt(np.maximum(a[0], 0.0)), np.sqrt(np.maximum(a[1], 0.0))
+
+
+def interval_max(a, b):
+    return np.maximum(a[0], b[0]), np.maximum(a[1], b[1])
+
+
+def interval_min(a, b):
+    return np.minimum(a[0], b[0]), np.minimum(a[1], b[1])
+
+
+def interval_hull(a, b):
+    return np.minimum(a[0], b[0]), np.maximum(a[1], b[1])
+
+
+def interval_linear(row, v):
+    '''
+    Interval of row[0]*v[0] + row[1]*v[1] + row[2]*v[2] where row contains
+    floats and v three intervals.
+    '''
+    result = interval_scale(row[0], v[0])
+    result = interval_add(result, interval_scale(row[1], v[1]))
+    return interval_add(result, interval_scale(row[2], v[2]))
+
+
+def interval_norm2(v):
+    '''
+    Interval of the norm of a vector of three intervals.
+    '''
+    squared = interval_add(interval_square(v[0]), interval_square(v[1]))
+    return interval_sqrt(interval_add(squared, interval_square(v[2])))
+
+
+def _projection(a):
+    '''
+    Rows of the matrix I - a a^T: v = s - (a.s) a = (I - a a^T) s.
+    Computing v from this matrix gives tighter intervals than from (a.s).
+    '''
+    return [[float(i == j) - a[i]*a[j] for j in range(3)] for i in range(3)]
+
+
+def _translate(box, c):
+    # intervals of the coordinates of p - c
+    x, y, z = box
+    return [(x[0] - c[0], x[1] - c[0]),
+            (y[0] - c[1], y[1] - c[1]),
+            (z[0] - c[2], z[1] - c[2])]
+
+
+#------------------------------------------------------------------------------
+# Primitives (see evaluate.py).
+# box is a list of three intervals (x, y, z); parameters is the tuple returned
+# by evaluate.prepare_parameters() for the corresponding primitive type.
+
+
+def primitive_plane(box, parameters):
+    nx, ny, nz, dist = parameters
+    d = interval_linear((nx, ny, nz), box)
+    return interval_neg((d[0] - dist, d[1] - dist))
+
+
+def primitive_sphere(box, parameters):
+    cx, cy, cz, radius = parameters
+    d = interval_norm2(_translate(box, (cx, cy, cz)))
+    return interval_neg((d[0] - radius, d[1] - radius))
+
+
+def primitive_cylinder(box, parameters):
+    ax, ay, az, px, py, pz, radius = parameters
+    diff = _translate(box, (px, py, pz))
+    v = [interval_linear(row, diff) for row in _projection((ax, ay, az))]
+    d = interval_norm2(v)
+    return interval_neg((d[0] - radius, d[1] - radius))
+
+
+def primitive_torus(box, parameters):
+    nx, ny, nz, cx, cy, cz, rminor, rmajor = parameters
+    s = _translate(box, (cx, cy, cz))
+    spin1 = interval_linear((nx, ny, nz), s)
+    v = [interval_linear(row, s) for row in _projection((nx, ny, nz))]
+    spin0 = interval_norm2(v)
+    spin0 = (spin0[0] - rmajor, spin0[1] - rmajor)
+    d = interval_sqrt(interval_add(interval_square(spin0), interval_square(spin1)))
+    return interval_neg((d[0] - rminor, d[1] - rminor))
+
+
+def primitive_cone(box, parameters):
+    ax, ay, az, cx, cy, cz, cos_angle, msin_angle = parameters
+    s = _translate(box, (cx, cy, cz))
+    g = interval_linear((ax, ay, az), s)
+    sqrs = interval_add(interval_add(interval_square(s[0]), interval_square(s[1])),
+                        interval_square(s[2]))
+    f = interval_sqrt(interval_sub(sqrs, interval_square(g)))
+    da = interval_scale(cos_angle, f)
+    db = interval_scale(msin_angle, g)
+    apex = interval_sqrt(sqrs)
+    side = interval_add(da, db)
+    # d = sqrt(sqrs) if g < 0 and da - db < 0, da + db otherwise
+    difference = interval_sub(da, db)
+    always_apex = (g[1] < 0.0) & (difference[1] < 0.0)
+    never_apex = (g[0] >= 0.0) | (difference[0] >= 0.0)
+    both = interval_hull(apex, side)
+    d_lo = np.where(always_apex, apex[0], np.where(never_apex, side[0], both[0]))
+    d_hi = np.where(always_apex, apex[1], np.where(never_apex, side[1], both[1]))
+    return interval_neg((d_lo, d_hi))
+
+
+def primitive_ellipsoid(box, parameters):
+    cx, cy, cz, rx, ry, rz = parameters[0:6]
+    m = parameters[6:15]
+    xi = _translate(box, (cx, cy, cz))
+    val = (-1.0, -1.0)
+    for row, r in ((m[0:3], rx), (m[3:6], ry), (m[6:9], rz)):
+        q = interval_scale(1.0 / r, interval_linear(row, xi))
+        val = interval_add(val, interval_square(q))
+    return val
+
+
+PRIMITIVE_FUNCTIONS = {
+    'plane': primitive_plane,
+    'sphere': primitive_sphere,
+    'cylinder': primitive_cylinder,
+    'torus': primitive_torus,
+    'cone': primitive_cone,
+    'ellipsoid': primitive_ellipsoid,
+}
+
+
+def bound_primitive(prim_type, parameters, box):
+    '''
+    Return the interval of the values of a primitive over the box, widened
+    by the rounding margin.
+    '''
+    if prim_type not in PRIMITIVE_FUNCTIONS:
+        raise Exception('Unknown primitive: ' + prim_type)
+    lo, hi = PRIMITIVE_FUNCTIONS[prim_type](box, parameters)
+    scale = 1.0 + max(abs(float(p)) for p in parameters)
+    for coordinate in box:
+        scale = scale + np.maximum(np.abs(coordinate[0]), np.abs(coordinate[1]))
+    margin = ROUNDING_MARGIN * (scale + np.maximum(np.abs(lo), np.abs(hi)))
+    return lo - margin, hi + margin
+
+
+#------------------------------------------------------------------------------
+# Operations (see evaluate.py).
+
+
+def set_union(f, g):
+    return interval_max(f, g)
+
+
+def set_intersection(f, g):
+    return interval_min(f, g)
+
+
+def set_subtraction(f, g):
+    return interval_min(f, interval_neg(g))
+
+
+def set_negation(f):
+    return interval_neg(f)
+
+
+OPERATION_FUNCTIONS = {
+    'union': set_union,
+    'intersection': set_intersection,
+    'subtraction': set_subtraction,
+    'negation': set_negation,
+}
+
+
+#------------------------------------------------------------------------------
+
+
+def split_box(box):
+    '''
+    Return the list of the intervals (x, y, z) of a box given as an array of
+    shape (2,3) (min corner, max corner), or of several boxes given as an
+    array of shape (M,2,3).
+    '''
+    box = np.asarray(box, dtype=np.float64)
+    if box.shape[-2:] != (2, 3):
+        raise Exception('Expected a box of shape (2,3) or (M,2,3)')
+    return [(box[..., 0, i], box[..., 1, i]) for i in range(3)]
+
+
+def bound(tree, table, box):
+    '''
+    Return an interval (lo, hi) containing the values of a tree over a box.
+    Args:
+        tree: a tree made of node and terminalnode objects
+        table: primitive table returned by evaluate.create_primitive_table()
+        box: array of shape (2,3) with the min and max corners of the box, or
+        of shape (M,2,3) for M boxes (lo and hi are then arrays of size M)
+    '''
+    intervals = split_box(box)
+    # post-order traversal with an explicit stack, as evaluate_tree(); the
+    # intervals of the subtrees with several parents are computed once
+    shared = simplify.shared_subtrees(tree)
+    memo = {}
+    values = []
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        key = id(current)
+        if key in memo:
+            values.append(memo[key])
+            continue
+
+        if len(current.children) == 0:
+            if current.name not in table:
+                raise Exception('Unknown primitive: ' + current.name)
+            prim_type, parameters = table[current.name]
+            value = bound_primitive(prim_type, parameters, intervals)
+        elif visited:
+            num_children = len(current.children)
+            arguments = values[-num_children:]
+            del values[-num_children:]
+            value = OPERATION_FUNCTIONS[current.name](*arguments)
+        else:
+            stack.append((current, True))
+            for c in reversed(current.children):
+                stack.append((c, False))
+            continue
+
+        if key in shared:
+            memo[key] = value
+        values.append(value)
+
+    return values[0]
+
+
+def _pruned_operation(operations, current, children, intervals):
+    '''
+    Return (tree, interval) for an operation whose children are pruned and
+    have the given intervals (single box).
+    '''
+    if current.name == 'negation':
+        value = set_negation(intervals[0])
+    else:
+        f, g = intervals
+        if current.name == 'subtraction':
+            g = interval_neg(g)
+        if current.name == 'union':
+            # max(f,g) is f when f >= g everywhere, g when g > f everywhere
+            if f[0] >= g[1]:
+                return children[0], intervals[0]
+            if g[0] > f[1]:
+                return children[1], intervals[1]
+            value = interval_max(f, g)
+        else:
+            # min(f,g) is f when f <= g everywhere, g when g < f everywhere
+            if f[1] <= g[0]:
+                return children[0], intervals[0]
+            if g[1] < f[0]:
+                if current.name == 'subtraction':
+                    negation = random_tree.node(operations['negation'], [children[1]])
+                    return negation, g
+                return children[1], intervals[1]
+            value = interval_min(f, g)
+
+    if all(children[i] is current.children[i] for i in range(len(children))):
+        return current, value
+    return random_tree.node(operations[current.name], list(children)), value
+
+
+def prune(tree, table, box):
+    '''
+    Return (pruned_tree, lo, hi) where pruned_tree has the same values as the
+    tree at every point of a box and [lo, hi] contains these values. The
+    children of the union, intersection and subtraction nodes that are never
+    selected over the box are removed. Unchanged subtrees are shared with the
+    input tree, which is not modified.
+    If lo > 0 (or hi < 0), the box is entirely inside (outside) the object.
+    Args: see bound(), box has the shape (2,3)
+    '''
+    intervals = split_box(box)
+    if np.ndim(intervals[0][0]) != 0:
+        raise Exception('prune() expects a single box of shape (2,3)')
+    operations = {}
+    for fw in random_tree.create_list_operations():
+        operations[fw.name] = fw
+
+    # post-order traversal with an explicit stack; pruned[id(n)] is the pair
+    # (pruned subtree, interval) of the subtree n
+    pruned = {}
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        key = id(current)
+        if key in pruned:
+            continue
+        if len(current.children) == 0:
+            if current.name not in table:
+                raise Exception('Unknown primitive: ' + current.name)
+            prim_type, parameters = table[current.name]
+            lo, hi = bound_primitive(prim_type, parameters, intervals)
+            pruned[key] = (current, (float(lo), float(hi)))
+        elif visited:
+            children = [pruned[id(c)][0] for c in current.children]
+            child_intervals = [pruned[id(c)][1] for c in current.children]
+            new_tree, (lo, hi) = _pruned_operation(operations, current, children,
+                                                   child_intervals)
+            pruned[key] = (new_tree, (float(lo), float(hi)))
+        else:
+            stack.append((current, True))
+            for c in reversed(current.children):
+                stack.append((c, False))
+
+    new_tree, (lo, hi) = pruned[id(tree)]
+    return new_tree, lo, hi
+
+
+#------------------------------------------------------------------------------
+
+
+def main(fit_filename, exp_filename, box):
+    prim_list = create_eval_source.read_fit(fit_filename)
+    expression = create_eval_source.read_expression(exp_filename)
+    tree = random_tree.tree_from_string(expression)
+    table = evaluate.create_primitive_table(prim_list)
+    pruned_tree, lo, hi = prune(tree, table, box)
+    print('Range: [%.17g, %.17g]' % (lo, hi))
+    if lo > 0.0:
+        print('The box is inside the object')
+    elif hi < 0.0:
+        print('The box is outside the object')
+    print('Number of nodes: %d -> %d' % (simplify.count_nodes(tree),
+                                         simplify.count_nodes(pruned_tree)))
+    print('Pruned expression: ' + pruned_tree.to_string())
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' model.fit model.txt xmin ymin zmin xmax ymax zmax')
+    print('Where:')
+    print('\t model.fit: a file containing a list of fitted primitives')
+    print('\t model.txt: a file containing an expression for the object')
+    print('\t xmin ... zmax: the corners of the box')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 9:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    coordinates = [float(a) for a in sys.argv[3:9]]
+    main(sys.argv[1], sys.argv[2], [coordinates[0:3], coordinates[3:6]])
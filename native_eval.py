@@ -0,0 +1,234 @@
+# Evaluate an expression with the C++ code generated by create_eval_source.py.
+#
+# The generated source is compiled with the system C++ compiler into a shared
+# library, loaded with ctypes, and its eval_batch() function is called on
+# NumPy arrays (without copying them when they are already contiguous arrays
+# of doubles). Its eval_grad_batch() function also returns the analytic
+# gradients.
+# The libraries are kept in a cache directory. They are identified by a hash
+# of the expression, the .fit file and the sources used to build them, such
+# that evaluating the same tree again does not recompile it.
+
+
+import os
+import sys
+import types
+import ctypes
+import hashlib
+import tempfile
+import subprocess
+
+import numpy as np
+
+import create_eval_source
+
+
+# directory containing operations.{h,cpp} and primitives.{h,cpp}
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# sources compiled with the generated file (the Python modules used to
+# generate it are given by generator_sources())
+SOURCES = ['operations.h', 'operations.cpp', 'primitives.h', 'primitives.cpp']
+
+# default cache directory; can be changed with the environment variable
+# RANDOM_CSG_CACHE
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'random_csg_tree')
+
+CXX_FLAGS = ['-O3', '-fPIC', '-shared']
+
+
+def get_cache_dir():
+    return os.environ.get('RANDOM_CSG_CACHE', CACHE_DIR)
+
+
+def get_compiler():
+    return os.environ.get('CXX', 'c++')
+
+
+def generator_sources():
+    '''
+    Return the sorted file names of the modules of SOURCE_DIR used to
+    generate the code: create_eval_source.py and the modules it imports,
+    directly or not (e.g. the parsing of the expressions and the names of the
+    primitives).
+    '''
+    sources = set()
+    pending = [create_eval_source]
+    while pending:
+        module = pending.pop()
+        filename = getattr(module, '__file__', None)
+        if filename is None or os.path.dirname(os.path.abspath(filename)) != SOURCE_DIR:
+            continue
+        source = os.path.basename(filename)
+        if source in sources:
+            continue
+        sources.add(source)
+        for value in vars(module).values():
+            if isinstance(value, types.ModuleType):
+                pending.append(value)
+    return sorted(sources)
+
+
+def compute_key(expression, fit_filename, optimize=True):
+    '''
+    Hash of everything the compiled library depends on.
+    '''
+    h = hashlib.sha256()
+    h.update(expression.encode('utf-8'))
+    h.update(b'\0')
+    with open(fit_filename, 'rb') as f:
+        h.update(f.read())
+    for source in SOURCES + generator_sources():
+        h.update(b'\0')
+        with open(os.path.join(SOURCE_DIR, source), 'rb') as f:
+            h.update(f.read())
+    h.update(b'\0')
+    h.update(' '.join([get_compiler()] + CXX_FLAGS + [str(optimize)]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def build_library(expression, fit_filename, optimize=True):
+    '''
+    Return the path of the shared library evaluating the expression, compiling
+    it if it is not in the cache yet.
+    '''
+    cache_dir = get_cache_dir()
+    key = compute_key(expression, fit_filename, optimize)
+    library_filename = os.path.join(cache_dir, 'eval_%s.so' % key)
+    if os.path.exists(library_filename):
+        return library_filename
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    prim_list = create_eval_source.read_fit(fit_filename)
+    build_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        cpp_filename = os.path.join(build_dir, 'eval.cpp')
+        create_eval_source.create_eval_cpp(prim_list, expression, cpp_filename, optimize,
+                                           gradient=True)
+        temp_library = os.path.join(build_dir, 'eval.so')
+        command = [get_compiler()] + CXX_FLAGS + [
+            '-I' + SOURCE_DIR, cpp_filename,
+            os.path.join(SOURCE_DIR, 'operations.cpp'),
+            os.path.join(SOURCE_DIR, 'primitives.cpp'),
+            '-o', temp_library]
+        subprocess.check_call(command)
+        # atomic: concurrent builds of the same library are harmless
+        os.replace(temp_library, library_filename)
+    finally:
+        for filename in os.listdir(build_dir):
+            os.remove(os.path.join(build_dir, filename))
+        os.rmdir(build_dir)
+
+    return library_filename
+
+
+class NativeEvaluator(object):
+    '''
+    Wrapper around a compiled library exporting eval_batch() and
+    eval_grad_batch().
+    '''
+    def __init__(self, library_filename):
+        self.library = ctypes.CDLL(library_filename)
+        self.eval_batch_function = self.library.eval_batch
+        self.eval_batch_function.restype = None
+        self.eval_batch_function.argtypes = [
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+        self.eval_grad_batch_function = self.library.eval_grad_batch
+        self.eval_grad_batch_function.restype = None
+        self.eval_grad_batch_function.argtypes = [
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_void_p]
+
+    def eval_batch(self, points, out=None):
+        '''
+        Evaluate the expression at each point of an (N,3) array.
+        Args:
+            points: array of shape (N,3); not copied if it is a C-contiguous
+            array of float64
+            out: optional C-contiguous float64 array of size N for the result
+        '''
+        points = check_points(points)
+        num_points = points.shape[0]
+        out = check_output(out, (num_points,))
+        self.eval_batch_function(points.ctypes.data, num_points, out.ctypes.data)
+        return out
+
+    def eval_grad_batch(self, points, out=None, gradient=None):
+        '''
+        Evaluate the expression and its analytic gradient at each point of an
+        (N,3) array. Return the values (N,) and the gradients (N,3).
+        Args:
+            points: see eval_batch()
+            out: optional C-contiguous float64 array of size N for the values
+            gradient: optional C-contiguous float64 array of shape (N,3) for
+            the gradients
+        '''
+        points = check_points(points)
+        num_points = points.shape[0]
+        out = check_output(out, (num_points,))
+        gradient = check_output(gradient, (num_points, 3))
+        self.eval_grad_batch_function(points.ctypes.data, num_points, out.ctypes.data,
+                                      gradient.ctypes.data)
+        return out, gradient
+
+
+def check_points(points):
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise Exception('Expected an array of points of shape (N,3)')
+    return points
+
+
+def check_output(out, shape):
+    '''
+    Return a new float64 array of the given shape if out is None, otherwise
+    check that out can be written by the library.
+    '''
+    if out is None:
+        return np.empty(shape, dtype=np.float64)
+    if out.dtype != np.float64 or out.shape != shape or not out.flags['C_CONTIGUOUS']:
+        raise Exception('Expected a contiguous float64 array of shape %s' % (shape,))
+    return out
+
+
+# libraries already loaded in this process
+_evaluators = {}
+
+
+def load_evaluator(expression, fit_filename, optimize=True):
+    '''
+    Return a NativeEvaluator for the expression, building the library if
+    needed.
+    '''
+    library_filename = build_library(expression, fit_filename, optimize)
+    if library_filename not in _evaluators:
+        _evaluators[library_filename] = NativeEvaluator(library_filename)
+    return _evaluators[library_filename]
+
+
+def main(fit_filename, exp_filename, points_filename, values_filename):
+    expression = create_eval_source.read_expression(exp_filename)
+    evaluator = load_evaluator(expression, fit_filename)
+    points = np.loadtxt(points_filename, ndmin=2)
+    values = evaluator.eval_batch(points[:, 0:3])
+    np.savetxt(values_filename, values, fmt='%.17g')
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' model.fit model.txt points.txt values.txt')
+    print('Where:')
+    print('\t model.fit: a file containing a list of fitted primitives')
+    print('\t model.txt: a file containing an expression for the object')
+    print('\t points.txt: a file with one point (x y z) per line')
+    print('\t values.txt: the file where the values of the expression are saved')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 5:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -0,0 +1,363 @@
+# Adaptive sampling of the field of a tree near its zero level set (the
+# surface of the object), with an octree.
+#
+# The box is divided recursively in 8 cells, down to max_level (a grid of
+# 2^max_level cells along each axis). A cell is only divided if its interval
+# (see interval.py) contains 0, i.e. if the surface may cross it: the empty
+# space and the inside of the object are skipped. At prune_level, the tree is
+# pruned for each remaining cell (see interval.prune()), such that the
+# smaller cells are bounded and sampled with a smaller tree.
+#
+# The leaf cells (at max_level) that may contain the surface are sampled at
+# their corners. A corner shared by neighbouring cells is evaluated once: the
+# corners are identified by their index on the grid of the corners,
+# key = (i*(n+1) + j)*(n+1) + k with n = 2^max_level.
+#
+# A mesh of the surface can be extracted from the leaf cells with marching
+# tetrahedra: each cell is split in 6 tetrahedra around its diagonal from
+# corner 0 to corner 7, which gives a consistent (watertight) triangulation
+# between neighbouring cells.
+
+
+import argparse
+
+import numpy as np
+
+import random_tree
+import evaluate
+import interval
+import create_eval_source
+
+
+# default number of levels of the octree (2^MAX_LEVEL cells along each axis)
+MAX_LEVEL = 7
+
+# default level at which the tree is pruned for each cell
+PRUNE_LEVEL = 3
+
+# offsets of the 8 children of a cell, and of the 8 corners of a cell:
+# corner c is at (c & 1, (c >> 1) & 1, (c >> 2) & 1)
+CORNER_OFFSETS = np.array([[c & 1, (c >> 1) & 1, (c >> 2) & 1] for c in range(8)],
+                          dtype=np.int64)
+
+# the 6 tetrahedra of a cell (corner indices), around the diagonal 0-7
+TETRAHEDRA = np.array([[0, 1, 3, 7], [0, 3, 2, 7], [0, 2, 6, 7],
+                       [0, 6, 4, 7], [0, 4, 5, 7], [0, 5, 1, 7]], dtype=np.int64)
+
+
+class OctreeSamples(object):
+    '''
+    The result of sample().
+    Member variables:
+        box_min: min corner of the sampled box
+        step: size of the leaf cells along each axis
+        max_level: the leaf cells are on a grid of 2^max_level cells
+        cells: (K,3) array with the indices (i,j,k) of the leaf cells that
+        may contain the surface
+        cell_values: (K,8) array with the values at the corners of these
+        cells
+        keys: sorted array with the keys of the sampled corners
+        values: values of the tree at these corners
+        num_bounds: number of cells bounded with interval arithmetic
+    '''
+    def __init__(self, box_min, step, max_level, cells, cell_values, keys, values,
+                 num_bounds):
+        self.box_min = box_min
+        self.step = step
+        self.max_level = max_level
+        self.cells = cells
+        self.cell_values = cell_values
+        self.keys = keys
+        self.values = values
+        self.num_bounds = num_bounds
+
+    def corner_indices(self, keys):
+        '''
+        Return the (N,3) array of grid indices of corner keys.
+        '''
+        n = (1 << self.max_level) + 1
+        return np.stack([keys // (n*n), (keys // n) % n, keys % n], axis=1)
+
+    def corner_points(self, keys):
+        '''
+        Return the (N,3) array of coordinates of corner keys.
+        '''
+        return self.box_min + self.corner_indices(keys) * self.step
+
+    def points(self):
+        '''
+        Coordinates of the sampled corners (in the order of values).
+        '''
+        return self.corner_points(self.keys)
+
+    def num_evaluations(self):
+        return len(self.keys)
+
+    def num_dense_evaluations(self):
+        '''
+        Number of evaluations needed to sample every corner of the grid.
+        '''
+        return ((1 << self.max_level) + 1) ** 3
+
+
+def corner_keys(cells, max_level):
+    '''
+    Return the (K,8) array of keys of the corners of the leaf cells.
+    '''
+    n = (1 << max_level) + 1
+    corners = cells[:, None, :] + CORNER_OFFSETS[None, :, :]
+    return (corners[:, :, 0] * n + corners[:, :, 1]) * n + corners[:, :, 2]
+
+
+def cell_boxes(cells, box_min, cell_size):
+    '''
+    Return the (K,2,3) array of boxes of cells of the given size.
+    '''
+    lower = box_min + cells * cell_size
+    return np.stack([lower, lower + cell_size], axis=1)
+
+
+def _prune_cells(tree, table, cells, box_min, cell_size):
+    '''
+    Prune the tree for each cell and return a list of (tree, cells), where
+    the cells with the same pruned tree are grouped.
+    '''
+    groups = {}
+    boxes = cell_boxes(cells, box_min, cell_size)
+    for i in range(len(cells)):
+        pruned_tree, lo, hi = interval.prune(tree, table, boxes[i])
+        key = pruned_tree.to_string()
+        if key not in groups:
+            groups[key] = (pruned_tree, [])
+        groups[key][1].append(i)
+    return [(pruned_tree, cells[indices]) for pruned_tree, indices in groups.values()]
+
+
+def sample(tree, table, box, max_level=MAX_LEVEL, prune_level=PRUNE_LEVEL,
+           max_memory=evaluate.MAX_MEMORY):
+    '''
+    Sample the field of a tree near its zero level set.
+    Return an OctreeSamples.
+    Args:
+        tree: a tree made of node and terminalnode objects
+        table: primitive table returned by evaluate.create_primitive_table()
+        box: array of shape (2,3) with the min and max corners of the box
+        max_level: the leaf cells are on a grid of 2^max_level cells
+        prune_level: level at which the tree is pruned for each cell (no
+        pruning if it is larger than max_level)
+        max_memory: memory budget for the evaluation of the corners
+    '''
+    box = np.asarray(box, dtype=np.float64)
+    box_min = box[0]
+    extent = box[1] - box[0]
+    num_bounds = 0
+
+    # the cells that may contain the surface, grouped by (pruned) tree
+    groups = [(tree, np.zeros((1, 3), dtype=np.int64))]
+    for level in range(max_level + 1):
+        cell_size = extent / (1 << level)
+        new_groups = []
+        for group_tree, cells in groups:
+            lo, hi = interval.bound(group_tree, table, cell_boxes(cells, box_min, cell_size))
+            num_bounds = num_bounds + len(cells)
+            cells = cells[(lo <= 0.0) & (hi >= 0.0)]
+            if len(cells) == 0:
+                continue
+            if level == prune_level:
+                new_groups.extend(_prune_cells(group_tree, table, cells, box_min,
+                                               cell_size))
+            else:
+                new_groups.append((group_tree, cells))
+        groups = new_groups
+        if level < max_level:
+            # divide the cells
+            groups = [(group_tree, (2*cells[:, None, :] + CORNER_OFFSETS[None, :, :]).reshape(-1, 3))
+                      for group_tree, cells in groups]
+
+    step = extent / (1 << max_level)
+    if len(groups) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return OctreeSamples(box_min, step, max_level, np.zeros((0, 3), dtype=np.int64),
+                             np.zeros((0, 8)), empty, np.zeros(0), num_bounds)
+
+    # each corner is evaluated once, with the tree of the first group using it
+    # (the pruned trees have the same values in their cells, corners included)
+    cells = np.concatenate([cells for group_tree, cells in groups])
+    group_keys = [corner_keys(cells, max_level) for group_tree, cells in groups]
+    group_ids = np.concatenate([np.full(keys.size, g, dtype=np.int64)
+                                for g, keys in enumerate(group_keys)])
+    all_keys = np.concatenate([keys.ravel() for keys in group_keys])
+    keys, first = np.unique(all_keys, return_index=True)
+    values = np.empty(len(keys))
+    samples = OctreeSamples(box_min, step, max_level, cells, None, keys, values, num_bounds)
+    evaluating_group = group_ids[first]
+    for g in range(len(groups)):
+        selected = np.nonzero(evaluating_group == g)[0]
+        if len(selected) == 0:
+            continue
+        values[selected] = evaluate.evaluate_points(
+            groups[g][0], table, samples.corner_points(keys[selected]),
+            max_memory=max_memory)
+
+    samples.cell_values = values[np.searchsorted(keys, all_keys)].reshape(-1, 8)
+    return samples
+
+
+#------------------------------------------------------------------------------
+
+
+def marching_tetrahedra(samples):
+    '''
+    Extract a triangle mesh of the zero level set from the leaf cells.
+    The inside of the object is where the values are positive; the triangles
+    are oriented with their normal pointing outside.
+    Return (vertices, triangles): (V,3) array of coordinates and (T,3) array
+    of vertex indices.
+    '''
+    keys = corner_keys(samples.cells, samples.max_level)
+    tet_keys = keys[:, TETRAHEDRA].reshape(-1, 4)
+    tet_values = samples.cell_values[:, TETRAHEDRA].reshape(-1, 4)
+    inside = tet_values > 0.0
+    num_inside = inside.sum(axis=1)
+
+    # edges (pairs of positions in the tetrahedra) of the triangles
+    rows = []
+    edges = []
+    # one vertex on one side: one triangle around it
+    single = (num_inside == 1) | (num_inside == 3)
+    single_rows = np.nonzero(single)[0]
+    alone = np.where(num_inside[single_rows, None] == 1, inside[single_rows], ~inside[single_rows])
+    order = np.argsort(~alone, axis=1, kind='stable')
+    s = order[:, 0]
+    rows.append(single_rows)
+    edges.append(np.stack([np.stack([s, order[:, 1]], axis=1),
+                           np.stack([s, order[:, 2]], axis=1),
+                           np.stack([s, order[:, 3]], axis=1)], axis=1))
+    # two vertices on each side: a quad made of two triangles
+    quad_rows = np.nonzero(num_inside == 2)[0]
+    order = np.argsort(~inside[quad_rows], axis=1, kind='stable')
+    a, b, c, d = order[:, 0], order[:, 1], order[:, 2], order[:, 3]
+    ac = np.stack([a, c], axis=1)
+    ad = np.stack([a, d], axis=1)
+    bc = np.stack([b, c], axis=1)
+    bd = np.stack([b, d], axis=1)
+    rows.append(quad_rows)
+    edges.append(np.stack([ac, ad, bd], axis=1))
+    rows.append(quad_rows)
+    edges.append(np.stack([ac, bd, bc], axis=1))
+
+    rows = np.concatenate(rows)
+    edges = np.concatenate(edges)
+    if len(rows) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+    # keys and values at both ends of each edge, ordered by key such that an
+    # edge shared by several triangles gives exactly the same vertex
+    key0 = tet_keys[rows[:, None], edges[:, :, 0]]
+    key1 = tet_keys[rows[:, None], edges[:, :, 1]]
+    value0 = tet_values[rows[:, None], edges[:, :, 0]]
+    value1 = tet_values[rows[:, None], edges[:, :, 1]]
+    swap = key1 < key0
+    key0, key1 = np.where(swap, key1, key0), np.where(swap, key0, key1)
+    value0, value1 = np.where(swap, value1, value0), np.where(swap, value0, value1)
+
+    key0 = key0.ravel()
+    key1 = key1.ravel()
+    num_keys = ((1 << samples.max_level) + 1) ** 3
+    if num_keys * num_keys < (1 << 63):
+        # one integer per edge (faster than unique rows)
+        unused, first, triangles = np.unique(
+            key0 * num_keys + key1, return_index=True, return_inverse=True)
+    else:
+        unused, first, triangles = np.unique(
+            np.stack([key0, key1], axis=1), axis=0, return_index=True,
+            return_inverse=True)
+    triangles = triangles.reshape(-1, 3)
+    v0 = value0.ravel()[first]
+    v1 = value1.ravel()[first]
+    t = v0 / (v0 - v1)
+    p0 = samples.corner_points(key0[first])
+    p1 = samples.corner_points(key1[first])
+    vertices = p0 + (p1 - p0) * t[:, None]
+
+    # orientation: the normal points from the center of the inside vertices
+    # of the tetrahedron to the center of the outside ones
+    tet_points = samples.corner_points(tet_keys[rows].ravel()).reshape(-1, 4, 3)
+    num_inside_rows = num_inside[rows, None].astype(np.float64)
+    weights = np.where(inside[rows], -1.0 / num_inside_rows, 1.0 / (4.0 - num_inside_rows))
+    outward = (tet_points * weights[:, :, None]).sum(axis=1)
+    A = vertices[triangles[:, 0]]
+    B = vertices[triangles[:, 1]]
+    C = vertices[triangles[:, 2]]
+    normals = np.cross(B - A, C - A)
+    flip = (normals * outward).sum(axis=1) < 0.0
+    triangles[flip] = triangles[flip][:, [0, 2, 1]]
+    return vertices, triangles
+
+
+def save_samples(filename, samples):
+    '''
+    Save the sampled corners, one line per point: x y z value.
+    '''
+    data = np.column_stack([samples.points(), samples.values])
+    np.savetxt(filename, data, fmt='%.17g')
+
+
+def save_obj(filename, vertices, triangles):
+    with open(filename, 'w') as f:
+        for v in vertices:
+            f.write('v %.17g %.17g %.17g\n' % (v[0], v[1], v[2]))
+        for t in triangles:
+            f.write('f %d %d %d\n' % (t[0] + 1, t[1] + 1, t[2] + 1))
+
+
+def main(fit_filename, exp_filename, samples_filename, box, max_level=MAX_LEVEL,
+         prune_level=PRUNE_LEVEL, mesh_filename=None):
+    prim_list = create_eval_source.read_fit(fit_filename)
+    expression = create_eval_source.read_expression(exp_filename)
+    tree = random_tree.tree_from_string(expression)
+    table = evaluate.create_primitive_table(prim_list)
+    samples = sample(tree, table, box, max_level, prune_level)
+    print('Leaf cells: %d' % len(samples.cells))
+    print('Evaluations: %d (%.3f%% of a dense grid)' % (
+        samples.num_evaluations(),
+        100.0 * samples.num_evaluations() / samples.num_dense_evaluations()))
+    print('Bounded cells: %d' % samples.num_bounds)
+    save_samples(samples_filename, samples)
+    if mesh_filename is not None:
+        vertices, triangles = marching_tetrahedra(samples)
+        print('Mesh: %d vertices, %d triangles' % (len(vertices), len(triangles)))
+        save_obj(mesh_filename, vertices, triangles)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # necessary
+    parser.add_argument(
+        "fit_in", help="a file containing a list of fitted primitives")
+    parser.add_argument(
+        "expression_in", help="a file containing an expression for the object")
+    parser.add_argument(
+        "samples_out",
+        help="the file where the samples are saved (x y z value per line)")
+
+    # optional
+    parser.add_argument(
+        "--box", type=float, nargs=6, default=[-1.0, -1.0, -1.0, 1.0, 1.0, 1.0],
+        metavar=('XMIN', 'YMIN', 'ZMIN', 'XMAX', 'YMAX', 'ZMAX'),
+        help="the sampled box")
+    parser.add_argument(
+        "--max_level", type=int, default=MAX_LEVEL,
+        help="number of levels of the octree (2^max_level cells along each axis)")
+    parser.add_argument(
+        "--prune_level", type=int, default=PRUNE_LEVEL,
+        help="level at which the tree is pruned for each cell")
+    parser.add_argument(
+        "--mesh_out", help="save a mesh of the surface in this .obj file")
+
+    args = parser.parse_args()
+
+    main(args.fit_in, args.expression_in, args.samples_out,
+         [args.box[0:3], args.box[3:6]], args.max_level, args.prune_level,
+         args.mesh_out)
@@ -1,5 +1,7 @@
 #include <algorithm>
 
+#include "operations.h"
+
 
 double set_union(double f, double g) {
     return std::max(f, g);
@@ -21,3 +23,26 @@ double set_negation(double f) {
 }
 
 
+// same selection as std::max(f, g)
+value_gradient set_union(const value_gradient& f, const value_gradient& g) {
+    return (f.value < g.value) ? g : f;
+}
+
+
+// same selection as std::min(f, g)
+value_gradient set_intersection(const value_gradient& f, const value_gradient& g) {
+    return (g.value < f.value) ? g : f;
+}
+
+
+value_gradient set_subtraction(const value_gradient& f, const value_gradient& g) {
+    return set_intersection(f, set_negation(g));
+}
+
+
+value_gradient set_negation(const value_gradient& f) {
+    value_gradient result = {-f.value, {-f.gradient[0], -f.gradient[1], -f.gradient[2]}};
+    return result;
+}
+
+
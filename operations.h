@@ -6,4 +6,17 @@ double set_intersection(double f, double g);
 double set_subtraction(double f, double g);
 double set_negation(double f);
 
+// Value of a field at a point and its gradient
+struct value_gradient {
+    double value;
+    double gradient[3];
+};
+
+// Same operations on values with their gradients: the gradient is the one of
+// the operand selected by the operation
+value_gradient set_union(const value_gradient& f, const value_gradient& g);
+value_gradient set_intersection(const value_gradient& f, const value_gradient& g);
+value_gradient set_subtraction(const value_gradient& f, const value_gradient& g);
+value_gradient set_negation(const value_gradient& f);
+
 #endif
@@ -0,0 +1,323 @@
+# Compact representation of a population of trees.
+#
+# All the trees of a population are stored in one contiguous array of codes,
+# in prefix order (the order of the string representation):
+# - a code >= 0 is the index of a primitive (leaf) in primitive_names
+# - a code < 0 is an operation (see OPERATION_CODES)
+# The codes of tree k are codes[offsets[k]:offsets[k+1]].
+# For each position i, ends[i] is the position following the subtree starting
+# at i, such that the subtree is codes[i:ends[i]], and heights[i] is the depth
+# of this subtree.
+# The arrays are array.array objects: they can be wrapped without copy in
+# NumPy arrays with numpy.frombuffer().
+
+
+import sys
+import array
+
+import random_tree
+import expression_parser
+
+
+# these values are part of the representation: do not change them
+OPERATION_CODES = {'union': -1, 'intersection': -2, 'negation': -3, 'subtraction': -4}
+
+OPERATION_NAMES = {-1: 'union', -2: 'intersection', -3: 'negation', -4: 'subtraction'}
+
+# number of children of each operation code
+OPERATION_ARITY = {-1: 2, -2: 2, -3: 1, -4: 2}
+
+
+def compute_ends_and_heights(codes, start, end, ends, heights):
+    '''
+    Fill ends[start:end] and heights[start:end] for the subtrees of the
+    trees stored in codes[start:end].
+    '''
+    # the subtrees are closed from the last position to the first one:
+    # the stack contains (end, height) of the subtrees following the
+    # current position, the first child on top
+    stack = []
+    for i in range(end-1, start-1, -1):
+        code = codes[i]
+        if code >= 0:
+            ends[i] = i + 1
+            heights[i] = 1
+        else:
+            arity = OPERATION_ARITY[code]
+            if len(stack) < arity:
+                raise Exception('Missing arguments for ' + OPERATION_NAMES[code])
+            height = 0
+            for _ in range(arity):
+                child_end, child_height = stack.pop()
+                height = max(height, child_height)
+            ends[i] = child_end
+            heights[i] = 1 + height
+        stack.append((ends[i], heights[i]))
+
+
+def create_primitive_index(primitive_names):
+    '''
+    Return the dictionary primitive name -> code.
+    '''
+    primitive_index = {}
+    for i in range(len(primitive_names)):
+        primitive_index[primitive_names[i]] = i
+    return primitive_index
+
+
+def symbol_code(name, is_operation, primitive_index):
+    if is_operation:
+        if name not in OPERATION_CODES:
+            raise Exception('Unknown operation: ' + name)
+        return OPERATION_CODES[name]
+    if name not in primitive_index:
+        raise Exception('Unknown primitive: ' + name)
+    return primitive_index[name]
+
+
+def tree_to_codes(tree, primitive_index):
+    '''
+    Return the list of the codes of a tree made of node and terminalnode
+    objects.
+    '''
+    codes = []
+    # pre-order traversal with an explicit stack
+    stack = [tree]
+    while stack:
+        current = stack.pop()
+        codes.append(symbol_code(current.name, len(current.children) > 0, primitive_index))
+        for c in reversed(current.children):
+            stack.append(c)
+    return codes
+
+
+def expression_to_codes(expression, primitive_index):
+    '''
+    Return the list of the codes of a tree given by its string
+    representation.
+    '''
+    return [symbol_code(symbol, expression_parser.is_operation(symbol), primitive_index)
+            for symbol in expression_parser.parse_prefix(expression)]
+
+
+def codes_to_string(codes, primitive_names):
+    '''
+    Return the string representation of a tree given by its codes.
+    '''
+    # the strings of the subtrees are built from the last position to
+    # the first one; the stack contains the strings of the subtrees
+    # following the current position, the first child on top
+    stack = []
+    for code in reversed(codes):
+        if code >= 0:
+            stack.append(primitive_names[code])
+        else:
+            arity = OPERATION_ARITY[code]
+            children = [stack.pop() for _ in range(arity)]
+            stack.append(OPERATION_NAMES[code] + '[' + ','.join(children) + ']')
+    return stack[0]
+
+
+def codes_to_tree(codes, primitive_names):
+    '''
+    Return a tree made of node and terminalnode objects from its codes.
+    '''
+    operations_map = {}
+    for fw in random_tree.create_list_operations():
+        operations_map[fw.name] = fw
+    leaves = {}
+    stack = []
+    for code in reversed(codes):
+        if code >= 0:
+            if code not in leaves:
+                leaves[code] = random_tree.terminalnode(primitive_names[code])
+            stack.append(leaves[code])
+        else:
+            arity = OPERATION_ARITY[code]
+            children = [stack.pop() for _ in range(arity)]
+            stack.append(random_tree.node(operations_map[OPERATION_NAMES[code]], children))
+    return stack[0]
+
+
+class PopulationBuilder(object):
+    '''
+    Append trees, one at a time, to a growing array of codes.
+    '''
+    def __init__(self, primitive_names):
+        self.primitive_names = list(primitive_names)
+        self.primitive_index = create_primitive_index(self.primitive_names)
+        self.codes = array.array('i')
+        self.offsets = array.array('q', [0])
+
+    def append_tree(self, tree):
+        '''
+        Append a tree made of node and terminalnode objects.
+        '''
+        self.codes.extend(tree_to_codes(tree, self.primitive_index))
+        self.offsets.append(len(self.codes))
+
+    def append_expression(self, expression):
+        '''
+        Append a tree given by its string representation.
+        '''
+        self.codes.extend(expression_to_codes(expression, self.primitive_index))
+        self.offsets.append(len(self.codes))
+
+    def build(self):
+        return PopulationStore(self.codes, self.offsets, self.primitive_names)
+
+
+class PopulationStore(object):
+    '''
+    A population of trees stored in contiguous arrays (see the top of the
+    file).
+    '''
+    def __init__(self, codes, offsets, primitive_names):
+        '''
+        Args:
+            codes: array.array('i') of codes
+            offsets: array.array('q') with the start of each tree, followed
+            by the total number of codes
+            primitive_names: names of the primitives (leaves)
+        '''
+        self.codes = codes
+        self.offsets = offsets
+        self.primitive_names = list(primitive_names)
+        num_codes = len(codes)
+        self.ends = array.array('q', bytes(8 * num_codes))
+        self.heights = array.array('i', bytes(4 * num_codes))
+        for k in range(len(offsets) - 1):
+            start = offsets[k]
+            end = offsets[k+1]
+            compute_ends_and_heights(codes, start, end, self.ends, self.heights)
+            if start < end and self.ends[start] != end:
+                raise Exception('Tree %d is not a single expression' % k)
+
+    @staticmethod
+    def from_trees(trees, primitive_names):
+        builder = PopulationBuilder(primitive_names)
+        for tree in trees:
+            builder.append_tree(tree)
+        return builder.build()
+
+    @staticmethod
+    def from_expressions(expressions, primitive_names):
+        builder = PopulationBuilder(primitive_names)
+        for expression in expressions:
+            builder.append_expression(expression)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def tree_span(self, k):
+        '''
+        Return (start, end) such that tree k is codes[start:end].
+        '''
+        return self.offsets[k], self.offsets[k+1]
+
+    def tree_codes(self, k):
+        start, end = self.tree_span(k)
+        return self.codes[start:end]
+
+    def subtree_codes(self, position):
+        '''
+        Return the codes of the subtree starting at the given position (index
+        in codes).
+        '''
+        return self.codes[position:self.ends[position]]
+
+    def number_nodes(self, k):
+        '''
+        Number of nodes of tree k.
+        '''
+        return self.offsets[k+1] - self.offsets[k]
+
+    def max_depth(self, k):
+        '''
+        Depth of tree k.
+        '''
+        return self.heights[self.offsets[k]]
+
+    def subtree_number_nodes(self, position):
+        return self.ends[position] - position
+
+    def subtree_max_depth(self, position):
+        return self.heights[position]
+
+    def codes_to_string(self, codes):
+        '''
+        Return the string representation of a tree given by its codes.
+        '''
+        return codes_to_string(codes, self.primitive_names)
+
+    def to_string(self, k):
+        return self.codes_to_string(self.tree_codes(k))
+
+    def codes_to_tree(self, codes):
+        '''
+        Return a tree made of node and terminalnode objects.
+        '''
+        return codes_to_tree(codes, self.primitive_names)
+
+    def to_tree(self, k):
+        return self.codes_to_tree(self.tree_codes(k))
+
+    def save(self, file_name):
+        '''
+        Save the population as text, one expression per line (the format of
+        random_tree.save_population_to_file).
+        '''
+        with open(file_name, 'w') as f:
+            for k in range(len(self)):
+                f.write(self.to_string(k))
+                f.write('\n')
+
+
+def read_population(file_name, primitive_names):
+    '''
+    Read a population saved as text (one expression per line).
+    '''
+    builder = PopulationBuilder(primitive_names)
+    with random_tree.open_population_file(file_name) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            builder.append_expression(line)
+    return builder.build()
+
+
+def main(population_filename, primitives_filename):
+    with open(primitives_filename) as f:
+        primitive_names = f.readline().strip().split(',')
+    population = read_population(population_filename, primitive_names)
+    num_trees = len(population)
+    if num_trees == 0:
+        print('Empty population')
+        return
+    number_nodes = [population.number_nodes(k) for k in range(num_trees)]
+    max_depths = [population.max_depth(k) for k in range(num_trees)]
+    print('Number of trees: %d' % num_trees)
+    print('Total number of nodes: %d' % sum(number_nodes))
+    print('Number of nodes: min %d, mean %.1f, max %d' % (
+        min(number_nodes), float(sum(number_nodes)) / num_trees, max(number_nodes)))
+    print('Depth: min %d, mean %.1f, max %d' % (
+        min(max_depths), float(sum(max_depths)) / num_trees, max(max_depths)))
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' expressions.txt list_primitives.txt')
+    print('Where:')
+    print('\t expressions.txt: a file containing one expression per line')
+    print('\t list_primitives.txt: the list of primitive names')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 3:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2])
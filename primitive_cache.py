@@ -0,0 +1,148 @@
+# Cache of the values of the primitives at a fixed set of points.
+#
+# All the trees of a population use the same primitives (the ones of the .fit
+# file): when a population is evaluated at the same points, the value of each
+# primitive at these points is computed once and kept in a row of a P x N
+# matrix (P primitives, N points), from which the evaluators read it instead
+# of calling the primitive functions.
+#
+# The matrix has as many rows as the memory budget allows (at most one per
+# primitive). When all the rows are used, the least recently used row is
+# evicted. The rows are filled chunk by chunk, as the evaluators read them:
+# a miss only computes the points that are read, such that a cache that is
+# too small for a tree costs no more than no cache at all. The values can be stored in single precision to halve the memory
+# (they are then rounded: the results are not identical to the ones of the
+# C++ code anymore).
+# A cache can also store the values with the gradients of the primitives (see
+# evaluate.py): each row is then an array of shape (4, N).
+
+
+import collections
+
+import numpy as np
+
+import evaluate
+
+
+# default memory budget (in bytes) for the matrix of values
+MAX_MEMORY = 1024 * 1024 * 1024
+
+
+class PrimitiveCache(object):
+    '''
+    Values of the primitives of a table at the points of an (N,3) array.
+    Member variables:
+        hits, misses, evictions: statistics of the accesses to the rows
+    '''
+    def __init__(self, table, points, max_memory=MAX_MEMORY, dtype=np.float64,
+                 gradient=False):
+        '''
+        Args:
+            table: primitive table returned by evaluate.create_primitive_table()
+            points: array of shape (N,3)
+            max_memory: memory budget in bytes for the matrix of values
+            dtype: type of the stored values, np.float64 or np.float32
+            gradient: if True, the gradients are stored with the values
+        '''
+        points = evaluate.check_points(points)
+        self.table = table
+        self.x, self.y, self.z = evaluate.split_coordinates(points)
+        self.num_points = points.shape[0]
+        self.gradient = gradient
+        row_shape = (self.num_points,)
+        if gradient:
+            row_shape = (4, self.num_points)
+        row_size = max(1, int(np.prod(row_shape)) * np.dtype(dtype).itemsize)
+        self.num_rows = int(max(1, min(len(table), max_memory // row_size)))
+        # np.empty does not write the memory: the pages of a row are only
+        # used once it is filled
+        self.matrix = np.empty((self.num_rows,) + row_shape, dtype=dtype)
+        self.free_rows = list(range(self.num_rows - 1, -1, -1))
+        # primitive name -> row, from the least to the most recently used
+        self.rows = collections.OrderedDict()
+        # (start, stop) ranges of points already computed in each row
+        self.filled = [set() for i in range(self.num_rows)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _allocate(self, name):
+        '''
+        Return a row for a primitive that is not in the cache.
+        '''
+        if name not in self.table:
+            raise Exception('Unknown primitive: ' + name)
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            # evict the least recently used row
+            evicted, row = self.rows.popitem(last=False)
+            self.evictions = self.evictions + 1
+            self.filled[row].clear()
+        self.rows[name] = row
+        return row
+
+    def values(self, name, start=0, stop=None):
+        '''
+        Return the values of a primitive at points[start:stop] (with the
+        gradients, if the cache stores them). The returned array is a view
+        of a row of the matrix: it must not be modified, and it is
+        overwritten when the row is evicted (copy it to keep it).
+        '''
+        if stop is None or stop > self.num_points:
+            stop = self.num_points
+        row = self.rows.get(name)
+        if row is not None:
+            self.rows.move_to_end(name)
+            filled = self.filled[row]
+            if (start, stop) in filled or (0, self.num_points) in filled:
+                self.hits = self.hits + 1
+                return self.matrix[row][..., start:stop]
+        else:
+            row = self._allocate(name)
+
+        self.misses = self.misses + 1
+        prim_type, parameters = self.table[name]
+        primitive_function = evaluate.evaluate_primitive
+        if self.gradient:
+            primitive_function = evaluate.evaluate_primitive_gradient
+        self.matrix[row][..., start:stop] = primitive_function(
+            prim_type, parameters, self.x[start:stop], self.y[start:stop], self.z[start:stop])
+        self.filled[row].add((start, stop))
+        return self.matrix[row][..., start:stop]
+
+    def row(self, name):
+        '''
+        Return the values of a primitive at all the points (see values()).
+        '''
+        return self.values(name)
+
+    def holds(self, names):
+        '''
+        Return True if the rows of all the given primitives fit in the cache
+        at once. Otherwise, a program loading them evicts its own rows before
+        they are read again, and should not use the cache.
+        '''
+        return len(names) <= self.num_rows
+
+    def clear(self):
+        self.free_rows = list(range(self.num_rows - 1, -1, -1))
+        self.rows.clear()
+        for filled in self.filled:
+            filled.clear()
+
+    def memory(self):
+        '''
+        Size in bytes of the matrix of values.
+        '''
+        return self.matrix.nbytes
+
+    def to_string(self):
+        accesses = self.hits + self.misses
+        hit_rate = 0.0
+        if accesses > 0:
+            hit_rate = 100.0 * self.hits / accesses
+        return ('Primitive cache: %d rows of %d values (%.1f MB), %d hits, %d misses, '
+                '%d evictions (%.1f%% hits)' % (
+                    self.num_rows, self.matrix[0].size, self.memory() / 1e6, self.hits,
+                    self.misses, self.evictions, hit_rate))
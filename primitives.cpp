@@ -3,6 +3,8 @@
 #include <cmath>
 #include <cassert>
 
+#include "primitives.h"
+
 
 static double compute_dot_product(double v1[], double v2[]) {
   return v1[0]*v2[0] + v1[1]*v2[1] + v1[2]*v2[2];
@@ -111,6 +113,37 @@ double primitive_cone(double x, double y, double z,
   return -d;
 }
 
+double primitive_cone_precomputed(double x, double y, double z, 
+                                  const double parameters[8]) 
+{
+  double axis_dir[] = {parameters[0], parameters[1], parameters[2]};
+  double center[] = {parameters[3], parameters[4], parameters[5]};
+  double cos_angle = parameters[6];
+  double msin_angle = parameters[7];
+    
+  double s[] = {x-center[0], y-center[1], z-center[2]};
+  double g = compute_dot_product(s, axis_dir);
+  double slen = compute_norm2(s);
+  double sqrs = slen*slen;
+  double f = sqrs - g*g;
+    
+  f = std::max(f, 0.0);
+  f = sqrt(f);
+
+  double da = cos_angle * f;
+  double db = msin_angle * g;
+    
+  double d;
+    
+  if (g<0.0 && (da-db)<0.0) {
+    d = sqrt(sqrs);
+  } else {
+    d = da + db;
+  }
+    
+  return -d;
+}
+
 void
 apply_inverse_rotation(
     double p[3], double theta, double phi, double psi, double pt[3])
@@ -154,3 +187,229 @@ double primitive_ellipsoid(
 
   return val;
 }
+
+double primitive_ellipsoid_precomputed(
+    double x, double y, double z, const double parameters[15])
+{
+  double cx = parameters[0];
+  double cy = parameters[1];
+  double cz = parameters[2];
+
+  double rx = parameters[3];
+  double ry = parameters[4];
+  double rz = parameters[5];
+
+  const double* m = parameters + 6;
+  
+  double xi = x - cx;
+  double yi = y - cy;
+  double zi = z - cz;
+
+  double pt[3];
+  pt[0] = m[0]*xi + m[1]*yi + m[2]*zi;
+  pt[1] = m[3]*xi + m[4]*yi + m[5]*zi;
+  pt[2] = m[6]*xi + m[7]*yi + m[8]*zi;
+
+  double val = (pt[0]/rx)*(pt[0]/rx) + (pt[1]/ry)*(pt[1]/ry) + (pt[2]/rz)*(pt[2]/rz) - 1.0;
+
+  return val;
+}
+
+
+// Gradients.
+// The values are computed with the same operations as in the functions
+// above. quotient(a, b) is a/b, or 0 where the gradient is not defined
+// (b == 0).
+
+
+static double quotient(double a, double b) {
+  return (b != 0.0) ? a/b : 0.0;
+}
+
+
+value_gradient primitive_plane_gradient(double x, double y, double z, 
+                                        const double parameters[4])
+{
+  value_gradient result;
+  result.value = primitive_plane(x, y, z, parameters);
+  result.gradient[0] = -parameters[0];
+  result.gradient[1] = -parameters[1];
+  result.gradient[2] = -parameters[2];
+  return result;
+}
+
+
+value_gradient primitive_sphere_gradient(double x, double y, double z, 
+                                         const double parameters[4])
+{
+  double center[] = {parameters[0], parameters[1], parameters[2]};
+  double radius = parameters[3];
+  double X = center[0] - x;
+  double Y = center[1] - y;
+  double Z = center[2] - z;
+  double len = sqrt(X*X + Y*Y + Z*Z);
+  double d = len - radius;
+  value_gradient result;
+  result.value = -d;
+  result.gradient[0] = quotient(X, len);
+  result.gradient[1] = quotient(Y, len);
+  result.gradient[2] = quotient(Z, len);
+  return result;
+}
+
+
+value_gradient primitive_cylinder_gradient(double x, double y, double z, 
+                                           const double parameters[7])
+{
+  double axis_dir[] = {parameters[0], parameters[1], parameters[2]};
+  double axis_pos[] = {parameters[3], parameters[4], parameters[5]};
+  double radius = parameters[6];
+  double diff[] = {x-axis_pos[0], y-axis_pos[1], z-axis_pos[2]};
+  double lamb = compute_dot_product(axis_dir, diff);
+  double v[] = {diff[0] - lamb*axis_dir[0], diff[1] - lamb*axis_dir[1],
+                diff[2] - lamb*axis_dir[2]};
+  double axis_dist = compute_norm2(v);
+  double d = axis_dist - radius;
+  // gradient of axis_dist: (v - (axis_dir.v) axis_dir) / axis_dist
+  double av = compute_dot_product(axis_dir, v);
+  value_gradient result;
+  result.value = -d;
+  for (int i = 0; i < 3; ++i) {
+    result.gradient[i] = -quotient(v[i] - av*axis_dir[i], axis_dist);
+  }
+  return result;
+}
+
+
+value_gradient primitive_torus_gradient(double x, double y, double z, 
+                                        const double parameters[8])
+{
+  double normalvec[] = {parameters[0], parameters[1], parameters[2]};
+  double center[] = {parameters[3], parameters[4], parameters[5]};
+  double rminor = parameters[6];
+  double rmajor = parameters[7];
+  double s[] = {x-center[0], y-center[1], z-center[2]};
+  double spin1 = compute_dot_product(normalvec, s);
+  double spin0vec[] = {s[0] - spin1*normalvec[0], 
+                       s[1] - spin1*normalvec[1],
+                       s[2] - spin1*normalvec[2]};
+  double spin0norm = compute_norm2(spin0vec);
+  double spin0 = spin0norm - rmajor;
+  double len = sqrt(spin0*spin0 + spin1*spin1);
+  double d = len - rminor;
+  // gradient of d: (spin0 grad(spin0norm) + spin1 normalvec) / len
+  double nv = compute_dot_product(normalvec, spin0vec);
+  value_gradient result;
+  result.value = -d;
+  for (int i = 0; i < 3; ++i) {
+    double u = quotient(spin0vec[i] - nv*normalvec[i], spin0norm);
+    result.gradient[i] = -quotient(spin0*u + spin1*normalvec[i], len);
+  }
+  return result;
+}
+
+
+value_gradient primitive_cone_precomputed_gradient(double x, double y, double z, 
+                                                   const double parameters[8])
+{
+  double axis_dir[] = {parameters[0], parameters[1], parameters[2]};
+  double center[] = {parameters[3], parameters[4], parameters[5]};
+  double cos_angle = parameters[6];
+  double msin_angle = parameters[7];
+    
+  double s[] = {x-center[0], y-center[1], z-center[2]};
+  double g = compute_dot_product(s, axis_dir);
+  double slen = compute_norm2(s);
+  double sqrs = slen*slen;
+  double f = sqrs - g*g;
+    
+  f = std::max(f, 0.0);
+  f = sqrt(f);
+
+  double da = cos_angle * f;
+  double db = msin_angle * g;
+    
+  value_gradient result;
+    
+  if (g<0.0 && (da-db)<0.0) {
+    // distance to the apex
+    result.value = -sqrt(sqrs);
+    for (int i = 0; i < 3; ++i) {
+      result.gradient[i] = -quotient(s[i], slen);
+    }
+  } else {
+    // gradient of f: (s - g axis_dir) / f
+    result.value = -(da + db);
+    for (int i = 0; i < 3; ++i) {
+      double df = quotient(s[i] - g*axis_dir[i], f);
+      result.gradient[i] = -(cos_angle*df + msin_angle*axis_dir[i]);
+    }
+  }
+    
+  return result;
+}
+
+
+value_gradient primitive_cone_gradient(double x, double y, double z, 
+                                       const double parameters[7])
+{
+  double precomputed[] = {parameters[0], parameters[1], parameters[2],
+                          parameters[3], parameters[4], parameters[5],
+                          cos(parameters[6]), -sin(parameters[6])};
+  return primitive_cone_precomputed_gradient(x, y, z, precomputed);
+}
+
+
+value_gradient primitive_ellipsoid_precomputed_gradient(
+    double x, double y, double z, const double parameters[15])
+{
+  double cx = parameters[0];
+  double cy = parameters[1];
+  double cz = parameters[2];
+
+  double rx = parameters[3];
+  double ry = parameters[4];
+  double rz = parameters[5];
+
+  const double* m = parameters + 6;
+  
+  double xi = x - cx;
+  double yi = y - cy;
+  double zi = z - cz;
+
+  double pt[3];
+  pt[0] = m[0]*xi + m[1]*yi + m[2]*zi;
+  pt[1] = m[3]*xi + m[4]*yi + m[5]*zi;
+  pt[2] = m[6]*xi + m[7]*yi + m[8]*zi;
+
+  double q[] = {pt[0]/rx, pt[1]/ry, pt[2]/rz};
+
+  value_gradient result;
+  result.value = q[0]*q[0] + q[1]*q[1] + q[2]*q[2] - 1.0;
+  // gradient: 2 M^T (pt / r^2)
+  double k[] = {q[0]/rx, q[1]/ry, q[2]/rz};
+  for (int i = 0; i < 3; ++i) {
+    result.gradient[i] = 2.0*(k[0]*m[i] + k[1]*m[3+i] + k[2]*m[6+i]);
+  }
+  return result;
+}
+
+
+value_gradient primitive_ellipsoid_gradient(
+    double x, double y, double z, const double parameters[9])
+{
+  double ctheta = std::cos(parameters[6]);
+  double stheta = std::sin(parameters[6]);
+  double cphi = std::cos(parameters[7]);
+  double sphi = std::sin(parameters[7]);
+  double cpsi = std::cos(parameters[8]);
+  double spsi = std::sin(parameters[8]);
+  // the matrix applied by apply_inverse_rotation()
+  double precomputed[] = {
+    parameters[0], parameters[1], parameters[2],
+    parameters[3], parameters[4], parameters[5],
+    ctheta*cphi, spsi*stheta*cphi - cpsi*sphi, spsi*stheta*cphi + spsi*sphi,
+    ctheta*sphi, spsi*stheta*sphi + cpsi*cphi, spsi*stheta*cphi - cpsi*sphi,
+    -stheta, spsi*ctheta, cpsi*ctheta};
+  return primitive_ellipsoid_precomputed_gradient(x, y, z, precomputed);
+}
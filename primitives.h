@@ -1,6 +1,8 @@
 #ifndef PRIMITIVES_H
 #define PRIMITIVES_H
 
+#include "operations.h"
+
 double
 primitive_plane(double x, double y, double z, const double parameters[4]);
 double
@@ -14,4 +16,37 @@ primitive_cone(double x, double y, double z, const double parameters[7]);
 double
 primitive_ellipsoid(double x, double y, double z, const double parameters[9]);
 
+// Variants with the parameters that do not depend on the point precomputed
+// (see precompute_parameters() in create_eval_source.py):
+// cone: axis_dir, center, cos(angle), -sin(angle)
+// ellipsoid: center, radii, inverse rotation matrix (row major)
+double
+primitive_cone_precomputed(double x, double y, double z, 
+                           const double parameters[8]);
+double
+primitive_ellipsoid_precomputed(double x, double y, double z, 
+                                const double parameters[15]);
+
+// Value and analytic gradient of the primitives; the value is the one
+// returned by the functions above. Where the gradient is not defined (e.g.
+// at the center of a sphere), it is 0.
+value_gradient
+primitive_plane_gradient(double x, double y, double z, const double parameters[4]);
+value_gradient
+primitive_sphere_gradient(double x, double y, double z, const double parameters[4]);
+value_gradient
+primitive_cylinder_gradient(double x, double y, double z, const double parameters[7]);
+value_gradient
+primitive_torus_gradient(double x, double y, double z, const double parameters[8]);
+value_gradient
+primitive_cone_gradient(double x, double y, double z, const double parameters[7]);
+value_gradient
+primitive_ellipsoid_gradient(double x, double y, double z, const double parameters[9]);
+value_gradient
+primitive_cone_precomputed_gradient(double x, double y, double z, 
+                                    const double parameters[8]);
+value_gradient
+primitive_ellipsoid_precomputed_gradient(double x, double y, double z, 
+                                         const double parameters[15]);
+
 #endif
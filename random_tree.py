@@ -2,6 +2,17 @@ import random
 import sys
 import warnings
 import argparse
+import hashlib
+import gzip
+import collections
+import multiprocessing
+
+import simplify
+import expression_parser
+import fit_loader
+import dedup
+import binary_population
+import instrumentation
 
 
 #------------------------------------------------------------------------------
@@ -14,6 +25,30 @@ MAX_DEPTH = 10
 # default value for the number generated random trees:
 POP_SIZE = 10
 
+# probability to draw an operation instead of a leaf (grow method)
+OPERATION_PROBABILITY = 0.7
+
+# strategies used to generate the trees (see generate_tree())
+STRATEGIES = ('grow', 'full', 'ramped', 'max_nodes', 'uniform')
+
+# default budget of nodes of the max_nodes strategy (and number of nodes of
+# the trees of the uniform strategy)
+MAX_NODES = 100
+
+# smallest depth of the trees of the ramped strategy
+MIN_RAMPED_DEPTH = 2
+
+# number of trees generated with the same random number generator
+# (changing it changes the trees generated for a given seed)
+BLOCK_SIZE = 256
+
+# maximum number of blocks being generated or waiting to be written, per
+# worker process
+BLOCKS_PER_WORKER = 4
+
+# size of the buffer used when writing the trees
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
 
 # These variables keep the list of available nodes and operations.
 # They are set at the beginning of the program and only read by the functions
@@ -21,6 +56,11 @@ POP_SIZE = 10
 g_list_terminalnodes = []
 g_list_operations = []
 
+# number of trees of each size, used by makeuniformtree():
+# (number of leaves, unary operations, binary operations) -> (trees, pairs)
+# (see count_trees())
+g_tree_counts = {}
+
 
 #------------------------------------------------------------------------------
 
@@ -136,50 +176,95 @@ class fwrapper(object):
         self.name = name
 
 
+# operations whose children can be swapped without changing the value
+# (max and min, up to the sign of a zero value)
+COMMUTATIVE_OPERATIONS = frozenset(['union', 'intersection'])
+
+
+def compute_structural_hash(name, children):
+    '''
+    Return the structural hash (16 bytes) of a node from its name and the
+    structural hashes of its children. Two subtrees have the same hash if
+    they are identical, up to the order of the children of the commutative
+    operations.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(name.encode('utf-8'))
+    h.update(b'\0')
+    child_hashes = [c.structural_hash for c in children]
+    if name in COMMUTATIVE_OPERATIONS:
+        child_hashes.sort()
+    for child_hash in child_hashes:
+        h.update(child_hash)
+    return h.digest()
+
+
 class node(object):
     '''
     The class for function nodes (nodes with children). This is 
     initialized with an fwrapper. When evaluate is called, it 
     evaluates the child nodes and then applies the function
     to their results.
+    The structural hash, number of nodes and depth of the node are computed
+    once, from the ones of its children: the children must not be modified
+    after the construction.
     '''
+    __slots__ = ('name', 'children', 'structural_hash', 'number_nodes', 'depth')
+
     def __init__(self, fw, children):
         self.name = fw.name
         self.children = children
+        self.structural_hash = compute_structural_hash(self.name, children)
+        number_nodes = 1
+        depth = 0
+        for c in children:
+            number_nodes = number_nodes + c.number_nodes
+            depth = max(depth, c.depth)
+        self.number_nodes = number_nodes
+        self.depth = 1 + depth
 
     def display(self, indent=0):
-        print (' ' * indent) + self.name
-        for c in self.children:
-            c.display(indent+1)
+        # the stack contains the nodes still to be printed, with their
+        # indentation, the next one on top
+        stack = [(self, indent)]
+        while stack:
+            current, current_indent = stack.pop()
+            print('%s%s' % (' '*current_indent, current.name))
+            for i in range(len(current.children)-1, -1, -1):
+                stack.append((current.children[i], current_indent+1))
 
     def to_string(self):
-        str_to_display = self.name + '['
-        num_children = len(self.children)
-        for i in range(num_children-1):
-            str_to_display = str_to_display + self.children[i].to_string() + ','
-
-        last_child = self.children[num_children-1]
-        str_to_display = str_to_display + last_child.to_string()
-        str_to_display = str_to_display + ']'
-        return str_to_display
+        # the pieces of the string are collected in a list and joined once;
+        # the stack contains the nodes and separators still to be written
+        pieces = []
+        stack = [self]
+        while stack:
+            current = stack.pop()
+            if isinstance(current, str):
+                pieces.append(current)
+            elif len(current.children) == 0:
+                pieces.append(current.name)
+            else:
+                pieces.append(current.name + '[')
+                stack.append(']')
+                children = current.children
+                for i in range(len(children)-1, -1, -1):
+                    stack.append(children[i])
+                    if i > 0:
+                        stack.append(',')
+        return ''.join(pieces)
 
     def compute_number_nodes(self):
         ''' Compute the number of nodes (internal nodes and leaves) for 
-        the tree.
+        the tree. Shared subtrees are counted each time they appear.
         '''
-        number_nodes = 0
-        for c in self.children:
-            number_nodes = number_nodes + c.compute_number_nodes()
-        return 1 + number_nodes
+        return self.number_nodes
 
     def max_depth(self):
         '''
         Returns the depth of the deepest branch of the tree
         '''
-        max_depth_children = 0
-        for c in self.children:
-            max_depth_children = max(max_depth_children, c.max_depth())
-        return 1 + max_depth_children
+        return self.depth
 
 
 class terminalnode(object):
@@ -190,8 +275,17 @@ class terminalnode(object):
     This class serves as a wrapper to the fitted primitives.
     TODO: rename, e.g. primitive?
     '''
+    __slots__ = ('name', 'structural_hash')
+
+    # leaves have no children (this is how they are told apart from node
+    # objects by the traversals)
+    children = ()
+    number_nodes = 1
+    depth = 1
+
     def __init__(self, name):
         self.name = name
+        self.structural_hash = compute_structural_hash(name, ())
 
     def display(self, indent=0):
         print ('%s%s' % (' '*indent, self.name))
@@ -213,7 +307,7 @@ class terminalnode(object):
 #------------------------------------------------------------------------
 
 
-def makerandomtree(maxdepth=4, opr=0.7):
+def makerandomtree(maxdepth=4, opr=0.7, rng=random):
     '''
     Create a random program.
     Return a new tree.
@@ -221,14 +315,188 @@ def makerandomtree(maxdepth=4, opr=0.7):
         Is it needed anymore??
         maxdepth: maximum depth for the random tree
         opr: probability to draw an operation
+        rng: random number generator (the random module or an instance of
+        random.Random)
     '''
-    if random.random() < opr and maxdepth > 0:
-        f = random.choice(g_list_operations)
-        children = [makerandomtree(maxdepth-1, opr) for i in range(f.childcount)]
-        return node(f, children)
-    else:
-        leaf = random.choice(g_list_terminalnodes)
-        return leaf
+    # the symbols are drawn in prefix order, without recursion; pending
+    # contains the maximum depths of the subtrees still to be drawn, the
+    # next one on top
+    symbols = []
+    pending = [maxdepth]
+    while pending:
+        depth = pending.pop()
+        if rng.random() < opr and depth > 0:
+            f = rng.choice(g_list_operations)
+            symbols.append(f)
+            pending.extend([depth-1] * f.childcount)
+        else:
+            symbols.append(rng.choice(g_list_terminalnodes))
+    return _tree_from_prefix(symbols)
+
+
+def _tree_from_prefix(symbols):
+    '''
+    Build a tree from the list of its symbols in prefix order (fwrapper
+    objects for the operations and terminalnode objects for the leaves).
+    '''
+    stack = []
+    for symbol in reversed(symbols):
+        if isinstance(symbol, fwrapper):
+            children = [stack.pop() for _ in range(symbol.childcount)]
+            stack.append(node(symbol, children))
+        else:
+            stack.append(symbol)
+    return stack[0]
+
+
+def makefulltree(maxdepth=4, rng=random):
+    '''
+    Create a random tree whose leaves are all at depth maxdepth (full
+    method).
+    '''
+    symbols = []
+    # remaining depth of the symbols still to draw, the next one on top
+    stack = [maxdepth]
+    while stack:
+        depth = stack.pop()
+        if depth > 0:
+            f = rng.choice(g_list_operations)
+            symbols.append(f)
+            stack.extend([depth-1] * f.childcount)
+        else:
+            symbols.append(rng.choice(g_list_terminalnodes))
+    return _tree_from_prefix(symbols)
+
+
+def makeboundedtree(maxdepth=4, max_nodes=MAX_NODES, opr=OPERATION_PROBABILITY,
+                    rng=random):
+    '''
+    Create a random tree as makerandomtree() (grow method) with at most
+    max_nodes nodes: an operation is only drawn if its children still fit in
+    the budget.
+    '''
+    if max_nodes < 1:
+        raise Exception('The budget of nodes must be positive')
+    symbols = []
+    stack = [maxdepth]
+    # number of symbols drawn or still to draw
+    reserved = 1
+    while stack:
+        depth = stack.pop()
+        if rng.random() < opr and depth > 0:
+            fitting = [f for f in g_list_operations if reserved + f.childcount <= max_nodes]
+            if fitting:
+                f = rng.choice(fitting)
+                symbols.append(f)
+                reserved = reserved + f.childcount
+                stack.extend([depth-1] * f.childcount)
+                continue
+        symbols.append(rng.choice(g_list_terminalnodes))
+    return _tree_from_prefix(symbols)
+
+
+def count_trees(size, num_leaves, num_unary, num_binary):
+    '''
+    Count the trees made of num_leaves leaves and num_unary (num_binary)
+    operations with one (two) children.
+    Return the lists (trees, pairs) where, for n <= size, trees[n] is the
+    number of trees with n nodes and pairs[n] the number of ordered pairs of
+    trees with n nodes in total.
+    '''
+    key = (num_leaves, num_unary, num_binary)
+    trees, pairs = g_tree_counts.setdefault(key, ([0], [0]))
+    for n in range(len(trees), size + 1):
+        # the pairs (a, n-a) and (n-a, a) are counted together
+        count = 2 * sum(trees[a] * trees[n-a] for a in range(1, (n + 1) // 2))
+        if n % 2 == 0:
+            count = count + trees[n // 2] * trees[n // 2]
+        pairs.append(count)
+        count = num_unary * trees[n-1] + num_binary * pairs[n-1]
+        if n == 1:
+            count = count + num_leaves
+        trees.append(count)
+    return trees, pairs
+
+
+def makeuniformtree(size=MAX_NODES, rng=random):
+    '''
+    Draw a tree with exactly size nodes, uniformly among all the trees with
+    size nodes (the number of trees of each size is counted by
+    count_trees()). The depth is not bounded.
+    '''
+    leaves = g_list_terminalnodes
+    unary = [f for f in g_list_operations if f.childcount == 1]
+    binary = [f for f in g_list_operations if f.childcount == 2]
+    if len(unary) + len(binary) != len(g_list_operations):
+        raise Exception('Only operations with one or two children are supported')
+    trees, pairs = count_trees(size, len(leaves), len(unary), len(binary))
+    if size < 1 or trees[size] == 0:
+        raise Exception('There is no tree with %d nodes' % size)
+
+    symbols = []
+    # sizes of the subtrees still to draw, the next one on top
+    stack = [size]
+    while stack:
+        n = stack.pop()
+        # index of the subtree among the trees[n] ones: the leaves, then the
+        # unary operations, then the binary operations
+        r = rng.randrange(trees[n])
+        if n == 1:
+            symbols.append(leaves[r])
+            continue
+        if r < len(unary) * trees[n-1]:
+            symbols.append(unary[r // trees[n-1]])
+            stack.append(n-1)
+            continue
+        r = r - len(unary) * trees[n-1]
+        symbols.append(binary[r // pairs[n-1]])
+        r = r % pairs[n-1]
+        # size of the first child, among the sizes 1, n-2, 2, n-3, ...: the
+        # most unbalanced pairs of sizes are the most likely ones
+        m = n - 1
+        for i in range(m - 1):
+            if i % 2 == 0:
+                a = 1 + i // 2
+            else:
+                a = m - 1 - i // 2
+            weight = trees[a] * trees[m-a]
+            if r < weight:
+                break
+            r = r - weight
+        stack.append(m-a)
+        stack.append(a)
+    return _tree_from_prefix(symbols)
+
+
+def generate_tree(strategy, index, max_depth, max_nodes, rng):
+    '''
+    Create a random tree with one of the STRATEGIES:
+        grow: makerandomtree()
+        full: makefulltree()
+        ramped: ramped half-and-half; the depth cycles from
+        MIN_RAMPED_DEPTH to max_depth with the index of the tree, and each
+        depth is used alternately with the grow and full methods
+        max_nodes: makeboundedtree(), at most max_nodes nodes
+        uniform: makeuniformtree(), exactly max_nodes nodes
+    Args:
+        index: index of the tree in the population
+    '''
+    if strategy == 'grow':
+        return makerandomtree(max_depth, OPERATION_PROBABILITY, rng)
+    if strategy == 'full':
+        return makefulltree(max_depth, rng)
+    if strategy == 'ramped':
+        min_depth = min(MIN_RAMPED_DEPTH, max_depth)
+        num_depths = max_depth - min_depth + 1
+        depth = min_depth + index % num_depths
+        if (index // num_depths) % 2 == 0:
+            return makerandomtree(depth, OPERATION_PROBABILITY, rng)
+        return makefulltree(depth, rng)
+    if strategy == 'max_nodes':
+        return makeboundedtree(max_depth, max_nodes, OPERATION_PROBABILITY, rng)
+    if strategy == 'uniform':
+        return makeuniformtree(max_nodes, rng)
+    raise Exception('Unknown strategy: ' + strategy)
 
 
 #------------------------------------------------------------------------
@@ -244,6 +512,38 @@ def create_list_operations():
     return list_operations
 
 
+def tree_from_string(expression):
+    '''
+    Build a tree (node and terminalnode objects) from its string
+    representation, as returned by to_string().
+    Leaves with the same name share the same terminalnode object, as
+    they do in the trees created by makerandomtree().
+    Args:
+        expression: string such as 'union[sphere2,negation[plane0]]'
+    '''
+    operations_map = {}
+    for fw in create_list_operations():
+        operations_map[fw.name] = fw
+
+    prefix = expression_parser.parse_prefix(expression)
+
+    leaves = {}
+    # the subtrees are built from the last symbol to the first one; the stack
+    # contains the subtrees following the current symbol, the first child on
+    # top
+    stack = []
+    for symbol in reversed(prefix):
+        if symbol in operations_map:
+            fw = operations_map[symbol]
+            children = [stack.pop() for _ in range(fw.childcount)]
+            stack.append(node(fw, children))
+        else:
+            if symbol not in leaves:
+                leaves[symbol] = terminalnode(symbol)
+            stack.append(leaves[symbol])
+    return stack[0]
+
+
 def create_list_terminalnodes(list_primitives):
     ''' Create a list of terminal nodes from a list of primitive shapes.'''
 
@@ -346,26 +646,12 @@ def read_fit(fit_filename):
         file_name: name of the .fit file with the primitives information
     '''
 
-    f = open(fit_filename)
-
+    # the file is parsed (and the parameters checked) by fit_loader
+    table = fit_loader.load_fit(fit_filename)
     list_primitives = []
-
-    for line in f:
-        elements = line.strip().split()
-        if len(elements)==0:
-            # empty line
-            continue
-        # elements will look like:
-        # primitive_name parameter_1 parameter_2 ... parameter_n
-        primitive_name = elements[0]
-        parameters = []
-        for i in range(1, len(elements)):
-            parameters.append(float(elements[i]))
-
+    for i in range(len(table)):
         list_primitives.append(
-            create_primitive_instance(primitive_name, parameters))
-
-    f.close()
+            create_primitive_instance(table.type(i), table.primitive_parameters(i)))
     return list_primitives
 
 
@@ -394,19 +680,294 @@ def save_primitives_list_to_file(tnodes, filename):
 #------------------------------------------------------------------------
 
 
-def main(fit_file, trees_file="expressions.txt", 
-         primitives_file="list_primitives.txt",
-         popsize=POP_SIZE, max_depth=MAX_DEPTH):
+def setup(fit_file):
+    '''
+    Set the lists of available nodes and operations from a .fit file.
+    '''
     global g_list_terminalnodes
     global g_list_operations
     list_primitives = read_fit(fit_file)
     g_list_terminalnodes = create_list_terminalnodes(list_primitives)
     g_list_operations = create_list_operations()
 
-    population = [makerandomtree(maxdepth=max_depth, opr=0.7) for _ in range(popsize)]
 
-    save_population_to_file(population, trees_file)
-    save_primitives_list_to_file(g_list_terminalnodes, primitives_file)
+def derive_seed(seed, block):
+    '''
+    Seed of the random number generator used for a block of trees. It only
+    depends on the global seed and the index of the block.
+    '''
+    digest = hashlib.sha256(('%d:%d' % (seed, block)).encode('ascii')).digest()
+    return int.from_bytes(digest[0:8], 'little')
+
+
+class SizeDistribution(object):
+    '''
+    Accumulate the number of nodes of the generated trees, with a histogram
+    by powers of two.
+    '''
+    def __init__(self):
+        self.num_trees = 0
+        self.total = 0
+        self.min_size = 0
+        self.max_size = 0
+        # k -> number of trees with 2^k to 2^(k+1)-1 nodes
+        self.bins = {}
+
+    def add(self, size):
+        if self.num_trees == 0 or size < self.min_size:
+            self.min_size = size
+        self.max_size = max(self.max_size, size)
+        self.num_trees = self.num_trees + 1
+        self.total = self.total + size
+        k = size.bit_length() - 1
+        self.bins[k] = self.bins.get(k, 0) + 1
+
+    def to_string(self):
+        mean = 0.0
+        if self.num_trees > 0:
+            mean = float(self.total) / self.num_trees
+        lines = ['Size of %d trees: %d nodes, min %d, max %d, mean %.1f' % (
+            self.num_trees, self.total, self.min_size, self.max_size, mean)]
+        for k in sorted(self.bins):
+            lines.append('%8d - %8d nodes: %d trees (%.1f%%)' % (
+                2**k, 2**(k+1) - 1, self.bins[k], 100.0 * self.bins[k] / self.num_trees))
+        return '\n'.join(lines)
+
+
+def generate_block(block, seed, num_trees, max_depth, simplified,
+                   strategy='grow', max_nodes=MAX_NODES, with_depths=False):
+    '''
+    Generate a block of trees with its own random number generator.
+    Return the list of the string representations of the trees, the
+    simplification report, and the lists of the numbers of nodes, of the
+    structural hashes and of the depths (empty if with_depths is False) of
+    the trees.
+    '''
+    rng = random.Random(derive_seed(seed, block))
+    expressions = []
+    report = simplify.SimplificationReport()
+    sizes = []
+    hashes = []
+    depths = []
+    for i in range(num_trees):
+        creature = generate_tree(strategy, block * BLOCK_SIZE + i, max_depth, max_nodes, rng)
+        if simplified:
+            simplified_creature = simplify.simplify(creature)
+            report.add(creature, simplified_creature)
+            creature = simplified_creature
+        sizes.append(simplify.count_nodes(creature))
+        hashes.append(creature.structural_hash)
+        if with_depths:
+            depths.append(creature.max_depth())
+        expressions.append(creature.to_string())
+    return expressions, report, sizes, hashes, depths
+
+
+def _generate_block_task(arguments):
+    return generate_block(*arguments)
+
+
+def _profile_block_task(arguments):
+    return instrumentation.profile_call(generate_block, arguments)
+
+
+def generate_blocks(popsize, max_depth, seed, workers=1, simplified=False,
+                    fit_file=None, strategy='grow', max_nodes=MAX_NODES,
+                    unbounded=False, with_depths=False,
+                    metrics=instrumentation.DISABLED):
+    '''
+    Generate popsize random trees, by blocks of BLOCK_SIZE trees.
+    The trees only depend on the seed, whatever the number of workers.
+    This is a generator: it yields, in order, the result of generate_block()
+    for each block. At most a few blocks per worker are kept in memory.
+    Args:
+        workers: number of processes; each process reads fit_file
+        strategy, max_nodes: see generate_tree()
+        unbounded: if True, full blocks are generated after the popsize
+        first trees, until the generator is closed
+        with_depths: see generate_block()
+        metrics: if it profiles the generation stage, the blocks are
+        profiled in the worker processes and their statistics are merged in
+        metrics
+    '''
+    num_blocks = (popsize + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    def more_blocks(block):
+        return unbounded or block < num_blocks
+
+    def task(block):
+        num_trees = BLOCK_SIZE
+        if not unbounded:
+            num_trees = min(BLOCK_SIZE, popsize - block * BLOCK_SIZE)
+        return (block, seed, num_trees, max_depth, simplified, strategy, max_nodes,
+                with_depths)
+
+    if workers <= 1:
+        block = 0
+        while more_blocks(block):
+            yield generate_block(*task(block))
+            block = block + 1
+        return
+
+    profile = metrics.profiles('generation')
+    block_task = _generate_block_task
+    if profile:
+        block_task = _profile_block_task
+    pool = multiprocessing.Pool(workers, initializer=setup, initargs=(fit_file,))
+    try:
+        pending = collections.deque()
+        next_block = 0
+        while more_blocks(next_block) or pending:
+            # keep a bounded number of blocks in flight
+            while more_blocks(next_block) and len(pending) < BLOCKS_PER_WORKER * workers:
+                pending.append(pool.apply_async(block_task, (task(next_block),)))
+                next_block = next_block + 1
+            result = pending.popleft().get()
+            if profile:
+                result, stats = result
+                metrics.add_worker_profile(stats)
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def open_population_file(file_name, mode='r', compress=False):
+    '''
+    Open a population file (one expression per line) in text mode. Files
+    whose name ends with .gz (or any file if compress is True) are gzip
+    compressed.
+    '''
+    if compress or file_name.endswith('.gz'):
+        return gzip.open(file_name, mode + 't')
+    return open(file_name, mode, buffering=OUTPUT_BUFFER_SIZE)
+
+
+def _write_blocks(blocks, write_expression, metrics):
+    '''
+    Call write_expression() for each expression yielded by
+    generate_blocks(). Return the simplification report and the
+    distribution of the sizes of the trees.
+    The time spent waiting for the blocks is recorded in the generation
+    stage of metrics, the time spent writing them in the serialization
+    stage.
+    '''
+    report = simplify.SimplificationReport()
+    sizes = SizeDistribution()
+    generation = metrics.stage('generation')
+    serialization = metrics.stage('serialization')
+    generation.start()
+    for expressions, block_report, block_sizes, block_hashes, block_depths in blocks:
+        generation.stop()
+        serialization.start()
+        for expression in expressions:
+            write_expression(expression)
+        serialization.stop()
+        report.merge(block_report)
+        for size in block_sizes:
+            sizes.add(size)
+        if metrics.enabled:
+            for size in block_sizes:
+                metrics.add_to_histogram('number_nodes', size)
+            for depth in block_depths:
+                metrics.add_to_histogram('depth', depth)
+        generation.start()
+    generation.stop()
+    return report, sizes
+
+
+def save_blocks_to_file(blocks, file_name, compress=False,
+                        metrics=instrumentation.DISABLED):
+    '''
+    Write the expressions yielded by generate_blocks() as soon as they are
+    available. Return the simplification report and the distribution of the
+    sizes of the trees.
+    '''
+    with open_population_file(file_name, 'w', compress) as f:
+        def write_expression(expression):
+            f.write(expression)
+            f.write('\n')
+        return _write_blocks(blocks, write_expression, metrics)
+
+
+def save_blocks_to_binary_file(blocks, file_name, fit_file,
+                               metrics=instrumentation.DISABLED):
+    '''
+    Same as save_blocks_to_file() for a binary population file (see
+    binary_population.py), whose header references fit_file and contains
+    the names of the primitives.
+    '''
+    primitive_names = [tn.name for tn in g_list_terminalnodes]
+    digest = binary_population.fit_digest(fit_file)
+    with binary_population.BinaryPopulationWriter(file_name, primitive_names,
+                                                  digest) as writer:
+        return _write_blocks(blocks, writer.append_expression, metrics)
+
+
+def main(fit_file, trees_file="expressions.txt", 
+         primitives_file="list_primitives.txt",
+         popsize=POP_SIZE, max_depth=MAX_DEPTH, simplified=False,
+         seed=None, workers=1, compress=False, strategy='grow',
+         max_nodes=MAX_NODES, dedup_mode=None, dedup_memory=dedup.MAX_MEMORY,
+         binary=False, metrics=instrumentation.DISABLED):
+    '''
+    Args:
+        metrics: instrumentation.Metrics recording the stages of the run
+        (read_fit, generation, serialization, write_primitives)
+    '''
+    if strategy not in STRATEGIES:
+        raise Exception('Unknown strategy: ' + strategy)
+    if max_nodes < 1:
+        raise Exception('The number of nodes must be positive')
+    if binary and compress:
+        raise Exception('Binary population files cannot be compressed')
+    with metrics.stage('read_fit'):
+        setup(fit_file)
+
+    if seed is None:
+        seed = random.SystemRandom().randrange(2**63)
+        print('Seed: %d' % seed)
+
+    # the trees are written as they are generated: the memory usage does not
+    # depend on the size of the population
+    deduplicator = None
+    if dedup_mode is None:
+        blocks = generate_blocks(popsize, max_depth, seed, workers, simplified, fit_file,
+                                 strategy, max_nodes, with_depths=metrics.enabled,
+                                 metrics=metrics)
+    else:
+        # the duplicates are replaced by the trees generated after the popsize
+        # first ones
+        deduplicator = dedup.Deduplicator(dedup_mode, dedup_memory)
+        blocks = generate_blocks(popsize, max_depth, seed, workers, simplified, fit_file,
+                                 strategy, max_nodes, unbounded=True,
+                                 with_depths=metrics.enabled, metrics=metrics)
+        blocks = deduplicator.filter_blocks(blocks, popsize)
+    if binary:
+        report, sizes = save_blocks_to_binary_file(blocks, trees_file, fit_file, metrics)
+    else:
+        report, sizes = save_blocks_to_file(blocks, trees_file, compress, metrics)
+
+    if simplified:
+        print(report.to_string())
+    if deduplicator is not None:
+        print(deduplicator.to_string())
+    print(sizes.to_string())
+
+    # the header of a binary population file has the names of the primitives
+    if not binary:
+        with metrics.stage('write_primitives'):
+            save_primitives_list_to_file(g_list_terminalnodes, primitives_file)
+
+    metrics.set('trees', sizes.num_trees)
+    metrics.set('nodes', sizes.total)
+    elapsed = metrics.stage_seconds('generation') + metrics.stage_seconds('serialization')
+    if elapsed > 0:
+        metrics.set('trees_per_second', sizes.num_trees / elapsed)
+    if deduplicator is not None:
+        metrics.set('rejected_duplicates', deduplicator.rejected)
+    metrics.finish()
 
 
 # ----------------------------------------------------------------------
@@ -438,6 +999,54 @@ if __name__ == "__main__":
     parser.add_argument(
         "--pop_size", 
         help="number of generated random trees; Default: 10", type=int)
+    parser.add_argument(
+        "--simplify", action="store_true",
+        help="remove redundant operations from the trees before saving them")
+    parser.add_argument(
+        "--seed", 
+        help="seed of the random number generator; the generated trees "
+        "only depend on the seed (and not on the number of workers)", type=int)
+    parser.add_argument(
+        "--workers", 
+        help="number of processes used to generate the trees; Default: 1", 
+        type=int, default=1)
+    parser.add_argument(
+        "--compress", action="store_true",
+        help="gzip compress the file with the trees (always done if its "
+        "name ends with .gz)")
+    parser.add_argument(
+        "--strategy", choices=STRATEGIES, default='grow',
+        help="how the trees are generated: grow (each node is an operation "
+        "with probability 0.7), full (all the leaves at max depth), ramped "
+        "(ramped half-and-half of grow and full trees with depths from 2 to "
+        "max depth), max_nodes (grow with at most max_nodes nodes), uniform "
+        "(drawn uniformly among the trees with exactly max_nodes nodes, "
+        "whatever their depth); Default: grow")
+    parser.add_argument(
+        "--max_nodes", type=int, default=MAX_NODES,
+        help="budget of nodes of the max_nodes strategy and size of the trees "
+        "of the uniform strategy; Default: 100")
+    parser.add_argument(
+        "--dedup", choices=dedup.MODES,
+        help="reject the trees identical (up to the order of the children of "
+        "union and intersection) to a tree already generated, and generate "
+        "other trees until pop_size distinct trees are saved; exact: the "
+        "hashes are kept in a hash set (16 bytes per tree), bloom: they are "
+        "kept in a Bloom filter of fixed size (a few distinct trees are "
+        "rejected too)")
+    parser.add_argument(
+        "--dedup_memory", type=int, default=dedup.MAX_MEMORY // (1024 * 1024),
+        help="memory budget in MB of the hash set or Bloom filter of --dedup; "
+        "Default: 256")
+    parser.add_argument(
+        "--binary", action="store_true",
+        help="save the trees in a binary population file with random access "
+        "to the trees (see binary_population.py); its header contains the "
+        "names of the primitives (the list of primitives is not saved)")
+    instrumentation.add_arguments(
+        parser, 'generation',
+        "; with --workers > 1, the generation is profiled in the worker "
+        "processes and their statistics are merged")
 
 
     args = parser.parse_args()
@@ -466,4 +1075,10 @@ if __name__ == "__main__":
         
     main(args.fit_in, trees_file=trees_filename,
          primitives_file=primitives_filename,
-         popsize=pop_size, max_depth=max_depth)
+         popsize=pop_size, max_depth=max_depth, simplified=args.simplify,
+         seed=args.seed, workers=args.workers, compress=args.compress,
+         strategy=args.strategy, max_nodes=args.max_nodes,
+         dedup_mode=args.dedup, dedup_memory=args.dedup_memory * 1024 * 1024,
+         binary=args.binary,
+         metrics=instrumentation.create_metrics('random_tree.py', args.metrics, args.profile,
+                                                'generation'))
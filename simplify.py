@@ -0,0 +1,247 @@
+# Simplification of the trees created by random_tree.makerandomtree().
+#
+# The operations are implemented in operations.cpp as:
+#   union(f,g) = max(f,g), intersection(f,g) = min(f,g),
+#   subtraction(f,g) = min(f,-g), negation(f) = -f
+# The following identities hold exactly for these functions and are used to
+# remove redundant nodes:
+#   negation[negation[a]]             -> a
+#   union[a,a], intersection[a,a]     -> a
+#   subtraction[a,negation[b]]        -> intersection[a,b]
+#   negation[union[negation[a],negation[b]]]        -> intersection[a,b]
+#   negation[intersection[negation[a],negation[b]]] -> union[a,b]
+#   union[a,intersection[a,b]], intersection[a,union[a,b]] -> a
+#   union[a,union[a,b]] -> union[a,b]
+#   intersection[a,intersection[a,b]] -> intersection[a,b]
+# (and the same with the children of union and intersection swapped).
+# Note that subtraction[a,a] = min(a,-a) = -|a| has no simpler equivalent
+# with these operations and is kept.
+#
+# Identical subtrees are also shared (hash-consing): the result is a DAG in
+# which each distinct subtree is represented by a single object, such that
+# evaluators can compute it only once.
+
+
+import sys
+
+import random_tree
+
+
+class HashConsTable(object):
+    '''
+    Return a unique object for each distinct (sub)tree.
+    '''
+    def __init__(self):
+        self.operations = {}
+        for fw in random_tree.create_list_operations():
+            self.operations[fw.name] = fw
+        self.nodes = {}
+
+    def leaf(self, name):
+        key = name
+        if key not in self.nodes:
+            self.nodes[key] = random_tree.terminalnode(name)
+        return self.nodes[key]
+
+    def operation(self, name, children):
+        key = (name,) + tuple(id(c) for c in children)
+        if key not in self.nodes:
+            self.nodes[key] = random_tree.node(self.operations[name], list(children))
+        return self.nodes[key]
+
+
+def _is_operation(tree, name):
+    return len(tree.children) > 0 and tree.name == name
+
+
+def _simplify_node(table, name, children):
+    '''
+    Apply the identities listed at the top of the file to an operation whose
+    children are already simplified and hash-consed.
+    '''
+    if name == 'negation':
+        a = children[0]
+        if _is_operation(a, 'negation'):
+            return a.children[0]
+        for op, dual in (('union', 'intersection'), ('intersection', 'union')):
+            if (_is_operation(a, op) and _is_operation(a.children[0], 'negation')
+                    and _is_operation(a.children[1], 'negation')):
+                return _simplify_node(table, dual, [a.children[0].children[0],
+                                                    a.children[1].children[0]])
+        return table.operation(name, children)
+
+    a, b = children
+    if name == 'subtraction':
+        if _is_operation(b, 'negation'):
+            return _simplify_node(table, 'intersection', [a, b.children[0]])
+        return table.operation(name, children)
+
+    # union or intersection
+    if a is b:
+        return a
+    dual = 'intersection' if name == 'union' else 'union'
+    for x, y in ((a, b), (b, a)):
+        if _is_operation(y, dual) and x in y.children:
+            # absorption
+            return x
+        if _is_operation(y, name) and x in y.children:
+            # idempotence
+            return y
+    return table.operation(name, children)
+
+
+def simplify(tree, table=None):
+    '''
+    Return a simplified version of the tree, where identical subtrees are
+    shared. The input tree is not modified.
+    Args:
+        tree: a tree made of node and terminalnode objects
+        table: optional HashConsTable, to share subtrees between several trees
+    '''
+    if table is None:
+        table = HashConsTable()
+
+    # post-order traversal with an explicit stack
+    # simplified[id(n)] is the simplified version of the subtree n
+    simplified = {}
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        if id(current) in simplified:
+            continue
+        if len(current.children) == 0:
+            simplified[id(current)] = table.leaf(current.name)
+        elif visited:
+            children = [simplified[id(c)] for c in current.children]
+            simplified[id(current)] = _simplify_node(table, current.name, children)
+        else:
+            stack.append((current, True))
+            for c in reversed(current.children):
+                stack.append((c, False))
+
+    return simplified[id(tree)]
+
+
+def count_distinct_nodes(tree):
+    '''
+    Number of distinct node objects in a tree (shared subtrees are counted
+    once).
+    '''
+    seen = set()
+    stack = [tree]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        stack.extend(current.children)
+    return len(seen)
+
+
+def count_nodes(tree):
+    '''
+    Number of nodes of a tree, as returned by compute_number_nodes(): shared
+    subtrees are counted each time they appear. The number is stored in the
+    nodes when they are built.
+    '''
+    return tree.number_nodes
+
+
+def count_references(tree):
+    '''
+    Return a dictionary mapping the id of each node object of the tree to its
+    number of parents (the root has 0).
+    '''
+    references = {id(tree): 0}
+    stack = [tree]
+    while stack:
+        current = stack.pop()
+        for c in current.children:
+            if id(c) in references:
+                references[id(c)] = references[id(c)] + 1
+            else:
+                references[id(c)] = 1
+                stack.append(c)
+    return references
+
+
+def shared_subtrees(tree):
+    '''
+    Return the set of ids of the node objects with several parents.
+    '''
+    references = count_references(tree)
+    return set(k for k in references if references[k] > 1)
+
+
+class SimplificationReport(object):
+    '''
+    Accumulate the number of nodes before and after simplification.
+    '''
+    def __init__(self):
+        self.num_trees = 0
+        self.nodes_before = 0
+        self.nodes_after = 0
+        self.distinct_nodes_after = 0
+
+    def add(self, tree, simplified_tree):
+        self.num_trees = self.num_trees + 1
+        self.nodes_before = self.nodes_before + count_nodes(tree)
+        self.nodes_after = self.nodes_after + count_nodes(simplified_tree)
+        self.distinct_nodes_after = (self.distinct_nodes_after
+                                     + count_distinct_nodes(simplified_tree))
+
+    def merge(self, other):
+        self.num_trees = self.num_trees + other.num_trees
+        self.nodes_before = self.nodes_before + other.nodes_before
+        self.nodes_after = self.nodes_after + other.nodes_after
+        self.distinct_nodes_after = self.distinct_nodes_after + other.distinct_nodes_after
+
+    def to_string(self):
+        reduction = 0.0
+        if self.nodes_before > 0:
+            reduction = 100.0 * (1.0 - float(self.distinct_nodes_after) / self.nodes_before)
+        return ('Simplified %d trees: %d nodes -> %d nodes (%d distinct nodes), '
+                '%.1f%% fewer nodes to evaluate' % (
+                    self.num_trees, self.nodes_before, self.nodes_after,
+                    self.distinct_nodes_after, reduction))
+
+
+def simplify_expression(expression):
+    '''
+    Simplify an expression given as a string. The returned string describes
+    a tree (shared subtrees are written in full).
+    '''
+    return simplify(random_tree.tree_from_string(expression)).to_string()
+
+
+def main(exp_filename, simplified_filename):
+    report = SimplificationReport()
+    with open(exp_filename) as fin:
+        with open(simplified_filename, 'w') as fout:
+            for line in fin:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                tree = random_tree.tree_from_string(line)
+                simplified_tree = simplify(tree)
+                report.add(tree, simplified_tree)
+                fout.write(simplified_tree.to_string())
+                fout.write('\n')
+    print(report.to_string())
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' expressions.txt simplified.txt')
+    print('Where:')
+    print('\t expressions.txt: a file containing one expression per line')
+    print('\t simplified.txt: the file where the simplified expressions are saved')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 3:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,211 @@
+# Evaluate a population with a memo of the values of the subtrees shared by
+# several trees.
+#
+# Random populations (and the offspring in genetic programming) contain many
+# identical subtrees. Each node carries a structural hash (see
+# random_tree.compute_structural_hash()), equal for identical subtrees up to
+# the order of the children of union and intersection. The value of each
+# evaluated subtree is kept in a memo keyed by this hash: when the same
+# subtree appears again, in the same tree or in another one, its value is read
+# from the memo and its nodes are not visited. The work is then proportional
+# to the number of distinct subtrees of the population instead of its total
+# number of nodes.
+#
+# The memo has a memory budget; when it is full, the least recently used
+# values are evicted. The points are evaluated in chunks and the memo is
+# emptied between chunks.
+
+
+import sys
+import collections
+
+import numpy as np
+
+import random_tree
+import evaluate
+import bytecode
+import create_eval_source
+
+
+# default memory budget (in bytes) for the memo
+MAX_MEMORY = 512 * 1024 * 1024
+
+# number of points evaluated at once
+CHUNK_SIZE = 65536
+
+
+class SubtreeMemo(object):
+    '''
+    Values of subtrees keyed by their structural hash, with a memory budget
+    and LRU eviction.
+    Member variables:
+        hits, misses, evictions: statistics of the accesses
+    '''
+    def __init__(self, max_memory=MAX_MEMORY):
+        self.max_memory = max_memory
+        self.values = collections.OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''
+        Return the value stored for key, or None.
+        '''
+        value = self.values.get(key)
+        if value is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self.values.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        '''
+        Store a value (which must not be modified afterwards).
+        '''
+        if key in self.values or value.nbytes > self.max_memory:
+            return
+        while self.memory + value.nbytes > self.max_memory:
+            evicted_key, evicted = self.values.popitem(last=False)
+            self.memory = self.memory - evicted.nbytes
+            self.evictions = self.evictions + 1
+        self.values[key] = value
+        self.memory = self.memory + value.nbytes
+
+    def clear(self):
+        '''
+        Remove the values (the statistics are kept).
+        '''
+        self.values.clear()
+        self.memory = 0
+
+    def to_string(self):
+        accesses = self.hits + self.misses
+        hit_rate = 0.0
+        if accesses > 0:
+            hit_rate = 100.0 * self.hits / accesses
+        return ('Subtree memo: %d hits, %d misses, %d evictions (%.1f%% hits)' % (
+            self.hits, self.misses, self.evictions, hit_rate))
+
+
+def evaluate_tree(tree, table, x, y, z, memo):
+    '''
+    Evaluate a tree at the points with coordinates x, y, z, reading and
+    storing the values of its subtrees in a SubtreeMemo (all the calls with
+    the same memo must use the same points).
+    '''
+    # post-order traversal with an explicit stack of (node, visited) pairs,
+    # as evaluate.evaluate_tree()
+    values = []
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        if not visited:
+            value = memo.get(current.structural_hash)
+            if value is not None:
+                values.append(value)
+                continue
+
+        if len(current.children) == 0:
+            if current.name not in table:
+                raise Exception('Unknown primitive: ' + current.name)
+            prim_type, parameters = table[current.name]
+            value = evaluate.evaluate_primitive(prim_type, parameters, x, y, z)
+        elif visited:
+            num_children = len(current.children)
+            arguments = values[-num_children:]
+            del values[-num_children:]
+            value = evaluate.OPERATION_FUNCTIONS[current.name](*arguments)
+        else:
+            stack.append((current, True))
+            for c in reversed(current.children):
+                stack.append((c, False))
+            continue
+
+        # the operations of evaluate.py return new arrays: the value can be
+        # shared without copy
+        memo.put(current.structural_hash, value)
+        values.append(value)
+
+    return values[0]
+
+
+def evaluate_population(trees, table, points, dtype=np.float64, memo=None,
+                        chunk_size=CHUNK_SIZE):
+    '''
+    Evaluate a list of trees at each point of an (N,3) array.
+    Return an array of shape (number of trees, N).
+    Args:
+        trees: list of trees made of node and terminalnode objects
+        table: primitive table returned by evaluate.create_primitive_table()
+        points: array of shape (N,3)
+        dtype: np.float64 (identical to the C++ code) or np.float32
+        memo: optional SubtreeMemo (to read its statistics or set its memory
+        budget); it is emptied before each chunk of points
+        chunk_size: number of points evaluated at once
+    '''
+    if memo is None:
+        memo = SubtreeMemo()
+    points = evaluate.check_points(points)
+    num_points = points.shape[0]
+    result = np.empty((len(trees), num_points), dtype=dtype)
+    for start in range(0, num_points, chunk_size):
+        chunk = np.asarray(points[start:start+chunk_size], dtype=dtype)
+        x, y, z = evaluate.split_coordinates(chunk)
+        memo.clear()
+        for i in range(len(trees)):
+            result[i, start:start+chunk_size] = evaluate_tree(trees[i], table, x, y, z, memo)
+    memo.clear()
+    return result
+
+
+def count_distinct_subtrees(trees):
+    '''
+    Return (number of nodes, number of distinct subtrees) of a list of trees.
+    '''
+    number_nodes = 0
+    distinct = set()
+    for tree in trees:
+        stack = [tree]
+        while stack:
+            current = stack.pop()
+            number_nodes = number_nodes + 1
+            distinct.add(current.structural_hash)
+            stack.extend(current.children)
+    return number_nodes, len(distinct)
+
+
+def main(fit_filename, population_filename, points_filename, values_filename):
+    prim_list = create_eval_source.read_fit(fit_filename)
+    trees = [random_tree.tree_from_string(e)
+             for e in bytecode.read_population(population_filename)]
+    points = np.loadtxt(points_filename, ndmin=2)
+    table = evaluate.create_primitive_table(prim_list)
+    memo = SubtreeMemo()
+    values = evaluate_population(trees, table, points[:, 0:3], memo=memo)
+    # one line per expression, one column per point
+    np.savetxt(values_filename, values, fmt='%.17g')
+    number_nodes, distinct = count_distinct_subtrees(trees)
+    print('Number of nodes: %d, distinct subtrees: %d' % (number_nodes, distinct))
+    print(memo.to_string())
+
+
+def usage(progname):
+    print('Usage: ')
+    print(progname + ' model.fit expressions.txt points.txt values.txt')
+    print('Where:')
+    print('\t model.fit: a file containing a list of fitted primitives')
+    print('\t expressions.txt: a file containing one expression per line')
+    print('\t points.txt: a file with one point (x y z) per line')
+    print('\t values.txt: the file where the values are saved (one line per expression)')
+
+
+if __name__ == '__main__':
+    num_args = len(sys.argv)
+    if num_args != 5:
+        usage(sys.argv[0])
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
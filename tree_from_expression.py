@@ -1,7 +1,10 @@
-import sys
+import argparse
 import collections
-import tokenize
-import io # io.StringIO
+
+import random_tree
+import expression_parser
+import binary_population
+import instrumentation
 
 
 # TODO
@@ -10,15 +13,15 @@ import io # io.StringIO
 #
 
 
-# parse() needs a list of operations (OPERATIONS) and primitives (PRIMITIVES) 
+# construct_tree() needs a list of operations (OPERATIONS) and primitives (PRIMITIVES) 
 # used in the expression. The list of operations is fixed so it can be hard-
 # coded, but the list of primitives depends on the data being processed.
 # Solutions: 1) read it from the .fit file used by the gp or 2) make the gp 
 # output a list of primitives and operations
 
-UNARY_OPERATIONS = ['negation']
-BINARY_OPERATIONS = ['union', 'intersection', 'subtraction']
-OPERATIONS = ['union', 'intersection', 'subtraction', 'negation']
+UNARY_OPERATIONS = expression_parser.UNARY_OPERATIONS
+BINARY_OPERATIONS = expression_parser.BINARY_OPERATIONS
+OPERATIONS = expression_parser.OPERATIONS
 
 PRIMITIVES = []
 
@@ -39,56 +42,28 @@ def read_primitives_list(primitives_list_filename):
     return list_prim
 
 
-def read_expression_from_file(filename):
-    # Given a filename, create a string with containing the expression read in 
-    # the file
-    f = open(filename)
-    line = f.readline()
-    expression = line.strip()
-    f.close()
-    return expression
+def read_expression_from_file(filename, index=0):
+    # Given a filename, create a string with containing the expression of tree
+    # index in the file (one expression per line, or a binary population file)
+    return binary_population.read_expression(filename, index)
 
 
 def construct_tree(expression):
     # Given the expression as a string, construct a parse tree corresponding to 
     # a pre-order traversal of the tree corresponding to the expression
-    src = io.StringIO(expression).readline
-    src = tokenize.generate_tokens(src)
-    
     # Tree as a list of symbols corresponding to a prefix order traversal of 
     # the tree
-    tree = []
-    tree = parse(src)
-
-    return tree
-
-
-def parse(token_src):
-    '''
-    Given an iterator to a list of tokens, returns a list of operations and 
-    primitives.
-    '''
-    expression = []
-    token = next(token_src)
-
-    while token[1]:
-        
-        token_type = token[0]
-
-        if token[1] in PRIMITIVES or token[1] in OPERATIONS:
-            # if it is a primitive or an operation
-            label = token[1]
-            expression.append(label)
-
-        token = next(token_src)
-
-    return expression
+    primitives = None
+    if PRIMITIVES:
+        primitives = set(PRIMITIVES)
+    return expression_parser.parse_prefix(expression, primitives)
 
 
 def count_operations(tree_preorder):
     num_operations = 0
-    for op in OPERATIONS:
-        num_operations = num_operations + tree_preorder.count(op)
+    for symbol in tree_preorder:
+        if symbol in OPERATIONS:
+            num_operations = num_operations + 1
     return num_operations
 
 
@@ -113,104 +88,287 @@ def build_tree(prefix):
     '''
     global g_operation_count
 
-    label = prefix.popleft()
-    if label in PRIMITIVES:
-        # a leaf
+    root = None
+    # nodes whose children are not all built yet: [node, missing children]
+    stack = []
+    while prefix:
+        label = prefix.popleft()
         g_operation_count = g_operation_count + 1
-        return Node(g_operation_count, label)
-    elif label in UNARY_OPERATIONS:
-        g_operation_count = g_operation_count + 1
-        return Node(g_operation_count, label, build_tree(prefix), None)
-    else:
-        g_operation_count = g_operation_count + 1
-        return Node(g_operation_count, label, build_tree(prefix), build_tree(prefix))
+        current = Node(g_operation_count, label)
+
+        if stack:
+            parent = stack[-1]
+            if parent[0].left is None:
+                parent[0].left = current
+            else:
+                parent[0].right = current
+            parent[1] = parent[1] - 1
+            if parent[1] == 0:
+                stack.pop()
+        else:
+            root = current
+
+        if label in UNARY_OPERATIONS:
+            stack.append([current, 1])
+        elif label in BINARY_OPERATIONS:
+            stack.append([current, 2])
+
+        if not stack:
+            # the tree is complete
+            break
+
+    return root
+
+
+#------------------------------------------------------------------------------
+# DOT export
+#
+# The trees are written as DAGs: identical subtrees are declared once, and
+# their parents have an edge to the same node. Deep or large trees can be
+# folded: the subtrees below collapse_depth, or beyond the first max_nodes
+# nodes declared in breadth-first order, are replaced by a summary node with
+# the operation at their root and their number of nodes.
 
 
-def save_tree_to_file(tree, figure_filename):
-    tree_string = binary_tree_to_dot_string(tree)
-    f = open(figure_filename, 'w')
-    f.write(tree_string)
-    f.close()
+class Dag(object):
+    '''
+    A tree where the identical subtrees are stored once.
+    Member variables:
+        labels: label of each node
+        children: tuple of the indices of the children of each node
+        sizes: number of nodes of the subtree of each node (shared subtrees
+        are counted each time they appear)
+        root: index of the root
+    '''
+    def __init__(self):
+        self.labels = []
+        self.children = []
+        self.sizes = []
+        self.root = None
 
 
-def binary_tree_to_dot_string(tree):
+def build_dag(prefix):
     '''
-    Generate a string using the graphviz syntax that describes the tree passed
-    as argument.
+    Build a Dag from a list of tokens corresponding to a pre-order traversal
+    of the tree (as returned by construct_tree()).
     '''
-    stream = io.StringIO()
-    binary_tree_to_dot(tree, stream)
-    return stream.getvalue()
+    dag = Dag()
+    # (label, children) -> index of the node
+    index = {}
+    # the subtrees are built from the last token to the first one; the stack
+    # contains the indices of the subtrees following the current token, the
+    # first child on top
+    stack = []
+    for label in reversed(prefix):
+        if label in UNARY_OPERATIONS:
+            arity = 1
+        elif label in BINARY_OPERATIONS:
+            arity = 2
+        else:
+            arity = 0
+        children = tuple(stack.pop() for _ in range(arity))
+        key = (label, children)
+        if key not in index:
+            index[key] = len(dag.labels)
+            dag.labels.append(label)
+            dag.children.append(children)
+            dag.sizes.append(1 + sum(dag.sizes[c] for c in children))
+        stack.append(index[key])
+    dag.root = stack[0]
+    return dag
 
 
 def escape(text):
     return '"%s"' % text
 
 
-# TODO isn't print >>s, "something" deprecated? fix it
-def binary_tree_to_dot(tree, stream):
+def write_dot_header(stream):
     style = 'fontname="Arial"'
-
     print("digraph BST {", file=stream)
     # See http://stackoverflow.com/questions/9215803/graphviz-binary-tree-left-and-right-child
     print(' graph [ordering="out"];', file=stream)
-    print("    node [%s];" % style,  file=stream) 
-
-    if tree is None:
-        # print >>stream
-        pass
-    elif tree.left is None and tree.right is None:
-        print("     %s [label=%s];" % (escape(tree.key), escape(tree.label)), file=stream)
-        print("     %s;" % escape(tree.key), file=stream)
-    else:
-        node_to_dot(tree, stream)
-
-    print("}", file=stream)
+    print("    node [%s];" % style,  file=stream)
 
 
-# In order to have different nodes with the same label, see:
-# http://stackoverflow.com/questions/10579041/graphviz-create-new-node-with-this-same-label
-def node_to_dot(node, stream):
-    # recursively print the nodes
-    if node.left is not None:
-        print("    %s [label=%s];" % (escape(node.key), escape(node.label)), file=stream)
-        print("    %s [label=%s];" % (escape((node.left).key), escape((node.left).label)), file=stream)
-        print("    %s -> %s;" % (escape(node.key), escape((node.left).key)), file=stream)
-        node_to_dot(node.left, stream)
-
-    if node.right is not None:
-        print("    %s [label=%s];" % (escape(node.key), escape(node.label)), file=stream)
-        print("    %s [label=%s];" % (escape((node.right).key), escape((node.right).label)), file=stream)
-        print("     %s -> %s;" % (escape(node.key), escape((node.right).key)), file=stream)
-        node_to_dot(node.right, stream)
-
+def write_dot_footer(stream):
+    print("}", file=stream)
 
-def main():
-    try:
-        expression_filename = sys.argv[1]
-        primitives_list_filename = sys.argv[2]
-        figure_filename = sys.argv[3]
-    except IndexError:
-        sys.exit("Usage: %s expression_file.txt primitives_list.txt figure_file.dot\n" % (sys.argv[0]))
 
-    # Read the expression as a string
-    expression = read_expression_from_file(expression_filename)
+def dag_to_dot(dag, stream, key_prefix='n', collapse_depth=None, max_nodes=None,
+               indent='    '):
+    '''
+    Write the nodes and edges of a Dag in the graphviz syntax, in
+    breadth-first order. Return the number of nodes declared.
+    Args:
+        key_prefix: prefix of the names of the nodes, unique for each tree
+        of a file
+        collapse_depth: the nodes at this depth (the root is at depth 0)
+        are summary nodes, their subtrees are not written; None for no limit
+        max_nodes: maximum number of nodes declared (at least 1): the nodes
+        whose children would exceed it are summary nodes; None for no limit
+    '''
+    def key(n):
+        return escape('%s%d' % (key_prefix, n))
+
+    # each node is declared once, when it is first reached (at its minimum
+    # depth)
+    queue = collections.deque([(dag.root, 0)])
+    declared = set([dag.root])
+    while queue:
+        n, depth = queue.popleft()
+        children = dag.children[n]
+        expand = len(children) > 0
+        if expand and collapse_depth is not None and depth >= collapse_depth:
+            expand = False
+        if expand and max_nodes is not None:
+            num_new = len(set(c for c in children if c not in declared))
+            expand = len(declared) + num_new <= max_nodes
+
+        if expand or len(children) == 0:
+            print("%s%s [label=%s];" % (indent, key(n), escape(dag.labels[n])), file=stream)
+        else:
+            label = '%s\\n(%d nodes)' % (dag.labels[n], dag.sizes[n])
+            print("%s%s [label=%s, shape=box, style=dashed];" % (
+                indent, key(n), escape(label)), file=stream)
+            continue
+
+        for c in children:
+            if c not in declared:
+                declared.add(c)
+                queue.append((c, depth + 1))
+            print("%s%s -> %s;" % (indent, key(n), key(c)), file=stream)
+    return len(declared)
+
+
+def save_trees_to_file(expressions, figure_filename, clustered=False,
+                       collapse_depth=None, max_nodes=None,
+                       metrics=instrumentation.DISABLED):
+    '''
+    Write the trees of expressions (an iterable of strings, read as they are
+    needed) to a .dot file, each tree in its own cluster if clustered is
+    True (the trees are otherwise drawn as a single graph). Return the number
+    of trees and the total number of operations (internal nodes) of the
+    trees.
+    Args:
+        collapse_depth, max_nodes: see dag_to_dot(), applied to each tree
+        metrics: the time spent in each stage (read_expression, parsing,
+        build_dag, write_dot) is accumulated in it
+    '''
+    num_trees = 0
+    num_operations = 0
+    reading = metrics.stage('read_expression')
+    with open(figure_filename, 'w') as f:
+        write_dot_header(f)
+        reading.start()
+        for expression in expressions:
+            reading.stop()
+            # Transform the expression in a pre-order traversal of the tree
+            with metrics.stage('parsing'):
+                tree_preorder = construct_tree(expression)
+            num_operations = num_operations + count_operations(tree_preorder)
+            with metrics.stage('build_dag'):
+                dag = build_dag(tree_preorder)
+            with metrics.stage('write_dot'):
+                if clustered:
+                    print("    subgraph cluster_%d {" % num_trees, file=f)
+                    print("        label=%s;" % escape('tree %d' % num_trees), file=f)
+                    dag_to_dot(dag, f, 't%d_n' % num_trees, collapse_depth, max_nodes,
+                               indent='        ')
+                    print("    }", file=f)
+                else:
+                    dag_to_dot(dag, f, 'n', collapse_depth, max_nodes)
+            metrics.add('nodes', len(tree_preorder))
+            if metrics.enabled:
+                metrics.add_tree(random_tree.tree_from_string(expression))
+            num_trees = num_trees + 1
+            reading.start()
+        reading.stop()
+        write_dot_footer(f)
+    return num_trees, num_operations
+
+
+def main(expression_filename, primitives_list_filename, figure_filename, index=0,
+         batch=False, collapse_depth=None, max_nodes=None,
+         metrics=instrumentation.DISABLED):
+    '''
+    Args:
+        batch: if True, all the trees of expression_filename are written, in
+        one cluster each (instead of tree index only)
+        collapse_depth, max_nodes: see dag_to_dot()
+    '''
+    if collapse_depth is not None and collapse_depth < 0:
+        raise Exception('The collapse depth must not be negative')
+    if max_nodes is not None and max_nodes < 1:
+        raise Exception('The maximum number of nodes must be at least 1')
 
-    # Build the list of primitives
+    # Build the list of primitives (the header of a binary population file
+    # contains it)
     global PRIMITIVES
-    PRIMITIVES = read_primitives_list(primitives_list_filename)
-    
-    # Transform the expression in a pre-order traversal of the tree
-    tree_preorder = construct_tree(expression)
-    number_operations = count_operations(tree_preorder)
-    print('Number of operations in the tree (internal nodes): ')
-    print(number_operations)
+    with metrics.stage('read_primitives'):
+        if binary_population.is_binary_population(expression_filename):
+            population = binary_population.BinaryPopulation(expression_filename)
+            PRIMITIVES = population.primitive_names
+        else:
+            PRIMITIVES = read_primitives_list(primitives_list_filename)
+
+    # the expressions of a batch are read while the file is written
+    if batch:
+        expressions = binary_population.read_expressions(expression_filename)
+    else:
+        with metrics.stage('read_expression'):
+            expressions = [read_expression_from_file(expression_filename, index)]
+    num_trees, num_operations = save_trees_to_file(expressions, figure_filename, batch,
+                                                   collapse_depth, max_nodes, metrics)
+    if batch:
+        print('Number of trees: ')
+        print(num_trees)
+        print('Number of operations in the trees (internal nodes): ')
+    else:
+        print('Number of operations in the tree (internal nodes): ')
+    print(num_operations)
 
-    # Construct a tree from the pre-order traversal
-    tree = build_tree(collections.deque(tree_preorder))
-    save_tree_to_file(tree, figure_filename)
+    metrics.set('trees', num_trees)
+    metrics.set('operations', num_operations)
+    metrics.finish()
 
 
 if __name__ == "__main__":
-    main()
-    
+    parser = argparse.ArgumentParser()
+
+    # necessary
+    parser.add_argument(
+        "expression_in",
+        help="a file containing one expression per line, or a binary "
+        "population file")
+    parser.add_argument(
+        "primitives_in",
+        help="the list of primitive names (list_primitives.txt); not read "
+        "for a binary population file")
+    parser.add_argument("figure_out", help="the .dot file created")
+
+    # optional
+    parser.add_argument(
+        "--index", type=int, default=0,
+        help="index of the expression of expression_in; Default: 0 (the "
+        "first one)")
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="write all the trees of expression_in, one cluster per tree "
+        "(instead of the tree --index only)")
+    parser.add_argument(
+        "--collapse_depth", type=int,
+        help="replace the subtrees at this depth (the root is at depth 0) by "
+        "a node with their number of nodes; Default: no limit")
+    parser.add_argument(
+        "--max_nodes", type=int,
+        help="maximum number of nodes drawn for each tree: the subtrees "
+        "beyond it (in breadth-first order) are replaced by a node with their "
+        "number of nodes; Default: no limit")
+    instrumentation.add_arguments(parser, 'parsing')
+
+    args = parser.parse_args()
+
+    main(args.expression_in, args.primitives_in, args.figure_out, args.index,
+         args.batch, args.collapse_depth, args.max_nodes,
+         instrumentation.create_metrics('tree_from_expression.py', args.metrics,
+                                        args.profile, 'parsing'))
@@ -0,0 +1,309 @@
+# Variation operators for genetic programming (subtree mutation and
+# crossover) and incremental evaluation of the offspring.
+#
+# A position in a tree is given by its path: the list of the indices of the
+# children followed from the root (the root is the empty path). The
+# operators replace the subtree at a random path and return the offspring
+# with this path. The offspring is built by path copying: only the nodes on
+# the path are new, all the other subtrees are shared with the parents, which
+# are not modified.
+#
+# The values of the nodes of the evaluated trees are kept in a NodeValueCache
+# (keyed by node object). To evaluate an offspring, only the new subtree and
+# the nodes on the path are computed; the values of the other children of the
+# nodes on the path are the ones of the parents, read from the cache. The cost
+# is then about (depth + size of the new subtree) x N instead of
+# (size of the tree) x N for N points.
+
+
+import random
+import argparse
+import collections
+
+import random_tree
+import evaluate
+import bytecode
+
+
+# default memory budget (in bytes) for the values of the nodes
+MAX_MEMORY = 512 * 1024 * 1024
+
+# operation name -> fwrapper, to copy the nodes on a path
+OPERATIONS = dict((fw.name, fw) for fw in random_tree.create_list_operations())
+
+
+def node_paths(tree):
+    '''
+    Return the list of (path, node) of all the positions of a tree, in
+    prefix order.
+    '''
+    result = []
+    stack = [((), tree)]
+    while stack:
+        path, current = stack.pop()
+        result.append((path, current))
+        for i in range(len(current.children)-1, -1, -1):
+            stack.append((path + (i,), current.children[i]))
+    return result
+
+
+def subtree_at(tree, path):
+    current = tree
+    for i in path:
+        current = current.children[i]
+    return current
+
+
+def replace_subtree(tree, path, subtree):
+    '''
+    Return a new tree where the subtree at path is replaced by subtree. The
+    nodes on the path are copied, the other ones are shared with tree.
+    '''
+    # nodes on the path, from the root
+    ancestors = []
+    current = tree
+    for i in path:
+        ancestors.append(current)
+        current = current.children[i]
+    new_node = subtree
+    for depth in range(len(path)-1, -1, -1):
+        parent = ancestors[depth]
+        children = list(parent.children)
+        children[path[depth]] = new_node
+        new_node = random_tree.node(OPERATIONS[parent.name], children)
+    return new_node
+
+
+def random_path(tree, rng=random):
+    '''
+    Return the path of a node of the tree chosen uniformly.
+    '''
+    return rng.choice(node_paths(tree))[0]
+
+
+def subtree_mutation(tree, rng=random, max_depth=4, opr=0.7):
+    '''
+    Replace a random subtree by a new random tree (see
+    random_tree.makerandomtree(); random_tree.setup() must have been called).
+    Return (offspring, path of the new subtree).
+    '''
+    path = random_path(tree, rng)
+    subtree = random_tree.makerandomtree(max_depth, opr, rng)
+    return replace_subtree(tree, path, subtree), path
+
+
+def crossover(tree1, tree2, rng=random):
+    '''
+    Replace a random subtree of tree1 by a random subtree of tree2 (shared,
+    not copied).
+    Return (offspring, path of the new subtree).
+    '''
+    path = random_path(tree1, rng)
+    donor = subtree_at(tree2, random_path(tree2, rng))
+    return replace_subtree(tree1, path, donor), path
+
+
+#------------------------------------------------------------------------------
+
+
+class NodeValueCache(object):
+    '''
+    Values of the nodes of evaluated trees at a fixed set of points, keyed by
+    node object, with a memory budget and LRU eviction. The nodes are kept
+    alive while their value is in the cache (such that their id is not
+    reused).
+    Member variables:
+        hits, misses, evictions: statistics of the accesses
+    '''
+    def __init__(self, max_memory=MAX_MEMORY):
+        self.max_memory = max_memory
+        # id(node) -> (node, value)
+        self.values = collections.OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tree):
+        '''
+        Return the value stored for a node, or None.
+        '''
+        entry = self.values.get(id(tree))
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        self.values.move_to_end(id(tree))
+        return entry[1]
+
+    def put(self, tree, value):
+        '''
+        Store the value of a node (the value must not be modified afterwards).
+        '''
+        if id(tree) in self.values or value.nbytes > self.max_memory:
+            return
+        while self.memory + value.nbytes > self.max_memory:
+            evicted_key, evicted = self.values.popitem(last=False)
+            self.memory = self.memory - evicted[1].nbytes
+            self.evictions = self.evictions + 1
+        self.values[id(tree)] = (tree, value)
+        self.memory = self.memory + value.nbytes
+
+    def clear(self):
+        '''
+        Remove the values (the statistics are kept).
+        '''
+        self.values.clear()
+        self.memory = 0
+
+    def to_string(self):
+        accesses = self.hits + self.misses
+        hit_rate = 0.0
+        if accesses > 0:
+            hit_rate = 100.0 * self.hits / accesses
+        return ('Node value cache: %d hits, %d misses, %d evictions (%.1f%% hits)' % (
+            self.hits, self.misses, self.evictions, hit_rate))
+
+
+def _node_value(current, table, x, y, z, child_values):
+    if len(current.children) == 0:
+        if current.name not in table:
+            raise Exception('Unknown primitive: ' + current.name)
+        prim_type, parameters = table[current.name]
+        return evaluate.evaluate_primitive(prim_type, parameters, x, y, z)
+    return evaluate.OPERATION_FUNCTIONS[current.name](*child_values)
+
+
+def evaluate_cached(tree, table, x, y, z, cache):
+    '''
+    Evaluate a tree at the points with coordinates x, y, z, reading the
+    values of its nodes from the cache when they are there, and storing the
+    values of the other ones (all the calls with the same cache must use the
+    same points).
+    '''
+    # post-order traversal with an explicit stack, as evaluate.evaluate_tree()
+    values = []
+    stack = [(tree, False)]
+    while stack:
+        current, visited = stack.pop()
+        if not visited:
+            value = cache.get(current)
+            if value is not None:
+                values.append(value)
+                continue
+            if len(current.children) > 0:
+                stack.append((current, True))
+                for c in reversed(current.children):
+                    stack.append((c, False))
+                continue
+
+        num_children = len(current.children)
+        arguments = []
+        if num_children > 0:
+            arguments = values[-num_children:]
+            del values[-num_children:]
+        # the operations of evaluate.py return new arrays: the value can be
+        # shared without copy
+        value = _node_value(current, table, x, y, z, arguments)
+        cache.put(current, value)
+        values.append(value)
+
+    return values[0]
+
+
+def evaluate_offspring(offspring, path, table, x, y, z, cache):
+    '''
+    Evaluate an offspring returned by subtree_mutation() or crossover(),
+    whose parents were evaluated with the same cache: only the new subtree
+    at path and the nodes on the path are computed (the other nodes are
+    shared with the parents and read from the cache, or computed if they
+    were evicted).
+    '''
+    ancestors = []
+    current = offspring
+    for i in path:
+        ancestors.append(current)
+        current = current.children[i]
+    value = evaluate_cached(current, table, x, y, z, cache)
+    for depth in range(len(path)-1, -1, -1):
+        parent = ancestors[depth]
+        child_values = []
+        for i in range(len(parent.children)):
+            if i == path[depth]:
+                child_values.append(value)
+            else:
+                child_values.append(evaluate_cached(parent.children[i], table, x, y, z,
+                                                    cache))
+        value = _node_value(parent, table, x, y, z, child_values)
+        cache.put(parent, value)
+    return value
+
+
+#------------------------------------------------------------------------------
+
+
+def create_offspring(trees, num_offspring, rng=random, crossover_rate=0.9,
+                     max_depth=4):
+    '''
+    Return a list of num_offspring (offspring, path, parent indices) created
+    from random parents of a list of trees, by crossover with probability
+    crossover_rate and by subtree mutation otherwise.
+    '''
+    offspring = []
+    for _ in range(num_offspring):
+        i = rng.randrange(len(trees))
+        if rng.random() < crossover_rate:
+            j = rng.randrange(len(trees))
+            child, path = crossover(trees[i], trees[j], rng)
+            offspring.append((child, path, (i, j)))
+        else:
+            child, path = subtree_mutation(trees[i], rng, max_depth)
+            offspring.append((child, path, (i,)))
+    return offspring
+
+
+def main(fit_filename, population_filename, offspring_filename, num_offspring,
+         crossover_rate=0.9, max_depth=4, seed=None):
+    random_tree.setup(fit_filename)
+    trees = [random_tree.tree_from_string(e)
+             for e in bytecode.read_population(population_filename)]
+    if len(trees) == 0:
+        raise Exception('Empty population')
+    rng = random.Random(seed)
+    offspring = create_offspring(trees, num_offspring, rng, crossover_rate, max_depth)
+    with open(offspring_filename, 'w') as f:
+        for child, path, parents in offspring:
+            f.write(child.to_string())
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    # necessary
+    parser.add_argument(
+        "fit_in", help="a file containing a list of fitted primitives")
+    parser.add_argument(
+        "population_in", help="a file containing one expression per line")
+    parser.add_argument(
+        "offspring_out",
+        help="the file where the offspring are saved (one expression per line)")
+
+    # optional
+    parser.add_argument(
+        "--num_offspring", type=int, default=random_tree.POP_SIZE,
+        help="number of offspring")
+    parser.add_argument(
+        "--crossover_rate", type=float, default=0.9,
+        help="probability to create an offspring by crossover (by subtree "
+        "mutation otherwise)")
+    parser.add_argument(
+        "--max_depth", type=int, default=4,
+        help="max depth of the random subtrees of the mutations")
+    parser.add_argument(
+        "--seed", type=int, help="seed of the random number generator")
+
+    args = parser.parse_args()
+
+    main(args.fit_in, args.population_in, args.offspring_out, args.num_offspring,
+         args.crossover_rate, args.max_depth, args.seed)